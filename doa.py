@@ -1,16 +1,188 @@
-from tuning import Tuning
+import sys
+import time
+import argparse
+import collections
+
 import usb.core
 import usb.util
-import time
 
-dev = usb.core.find(idVendor=0x2886, idProduct=0x0018)
+from tuning import Tuning
+from kalman_tracker import KalmanTracker
+from stream_server import StreamServer
+from doa_log import DOALogWriter
+import tuning_daemon
+
+
+DOAEvent = collections.namedtuple('DOAEvent', ['timestamp', 'direction', 'rate', 'tracked'])
+
+
+class AdaptiveDOAPoller:
+    """
+    Poll DOAANGLE only while the firmware reports voice activity
+
+    Every tick reads the cheap VAD flag. While it is set, DOAANGLE is read too:
+    the first voiced tick after silence jumps straight to max_rate so the onset of
+    an utterance is densely sampled, later ticks ramp back up towards it after
+    the tracker slowed them down. In silence the rate decays back to idle_rate
+    and no DOA is read at all.
+
+    VOICEACTIVITY is an instantaneous flag, so idle_rate bounds both the onset
+    latency and the shortest burst that is reliably seen: at the default 5 Hz a
+    silent room costs five one-byte control reads per second and speech is
+    noticed within 200 ms. Lower it to save bus traffic at the price of missing
+    short utterances.
+
+    With a tracker, the voiced rate is further capped to what the tracker's
+    prediction needs to stay within tolerance degrees.
+    """
+
+    def __init__(self, tuning, idle_rate=5.0, max_rate=50.0, ramp=2.0, decay=0.8, vad='VOICEACTIVITY',
+                 tracker=None, tolerance=5.0):
+        """
+        Args:
+            tuning: Tuning instance of the array
+            idle_rate: polling rate in Hz when the room is silent
+            max_rate: highest polling rate in Hz while speech is present
+            ramp: rate multiplier applied on every voiced tick after the first
+            decay: rate multiplier applied on every silent tick
+            vad: 'VOICEACTIVITY' or 'SPEECHDETECTED'
+            tracker: optional KalmanTracker fed with every DOA read
+            tolerance: predicted DOA standard deviation in degrees the tracker may reach between reads
+        """
+        if vad not in ('VOICEACTIVITY', 'SPEECHDETECTED'):
+            raise ValueError('{} is not a voice activity parameter'.format(vad))
+
+        self.tuning = tuning
+        self.idle_rate = float(idle_rate)
+        self.max_rate = float(max_rate)
+        self.ramp = ramp
+        self.decay = decay
+        self.vad = vad
+        self.tracker = tracker
+        self.tolerance = tolerance
+        self.rate = self.idle_rate
+        self.voiced = False
+
+    def poll(self):
+        """
+        Run one tick, return a DOAEvent if voice is present, otherwise None
+        """
+        if self.tuning.read(self.vad):
+            direction = self.tuning.direction
+            timestamp = time.time()
+            if self.voiced:
+                self.rate = min(self.max_rate, self.rate * self.ramp)
+            else:
+                self.rate = self.max_rate
+            self.voiced = True
+
+            tracked = None
+            if self.tracker is not None:
+                tracks = self.tracker.update([direction], timestamp)
+                if tracks:
+                    tracked = float(tracks[0].position[0])
+                interval = self.tracker.next_interval(self.tolerance, 1.0 / self.idle_rate, 1.0 / self.max_rate)
+                self.rate = max(self.idle_rate, min(self.rate, 1.0 / interval))
 
-if dev:
-    Mic_tuning = Tuning(dev)
-    print(Mic_tuning.direction)
-    while True:
+            return DOAEvent(timestamp, direction, self.rate, tracked)
+
+        self.voiced = False
+        self.rate = max(self.idle_rate, self.rate * self.decay)
+
+    def events(self, idle=None):
+        """
+        Generate DOAEvent forever, sleeping between ticks according to the current rate
+
+        Args:
+            idle: called on every tick without voice, e.g. to flush buffered output
+        """
+        deadline = time.monotonic()
+        while True:
+            event = self.poll()
+            if event is not None:
+                yield event
+            elif idle is not None:
+                idle()
+
+            deadline += 1.0 / self.rate
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # fell behind, restart the schedule from now instead of bursting
+                deadline = time.monotonic()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print the direction of arrival of a ReSpeaker array')
+    parser.add_argument('--adaptive', action='store_true', help='poll DOA only during voice activity')
+    parser.add_argument('--idle-rate', type=float, default=5.0, help='polling rate in Hz in silence')
+    parser.add_argument('--max-rate', type=float, default=50.0, help='maximum polling rate in Hz during speech')
+    parser.add_argument('--vad', default='VOICEACTIVITY', choices=['VOICEACTIVITY', 'SPEECHDETECTED'])
+    parser.add_argument('--track', action='store_true', help='smooth DOA with a Kalman tracker and poll by its predictions')
+    parser.add_argument('--tolerance', type=float, default=5.0, help='tracker prediction tolerance in degrees')
+    parser.add_argument('--publish', default=None, help='publish DOA records on PORT (TCP) or a Unix socket path')
+    parser.add_argument('--format', default='json', choices=['json', 'binary'], help='framing of published records')
+    parser.add_argument('--log', default=None, help='append DOA records to a binary log file')
+    parser.add_argument('--daemon', nargs='?', const=tuning_daemon.SOCKET, default=None, metavar='SOCKET',
+                        help='read through tuning_daemon.py instead of claiming the device')
+    args = parser.parse_args()
+
+    if args.daemon:
+        Mic_tuning = tuning_daemon.find(path=args.daemon)
+        if Mic_tuning is None:
+            print('No tuning daemon on {}'.format(args.daemon))
+            sys.exit(1)
+    else:
+        dev = usb.core.find(idVendor=0x2886, idProduct=0x0018)
+        if not dev:
+            print('No device found')
+            sys.exit(1)
+
+        Mic_tuning = Tuning(dev)
+
+    server = None
+    if args.publish:
+        address = ('127.0.0.1', int(args.publish)) if args.publish.isdigit() else args.publish
+        server = StreamServer(address, fmt=args.format)
+        server.start()
+
+    log = DOALogWriter(args.log) if args.log else None
+
+    def publish(timestamp, direction):
+        if server is not None:
+            server.publish({'timestamp': timestamp, 'device': 0, 'doa': direction})
+        if log is not None:
+            log.append(timestamp, 0, direction)
+
+    if args.adaptive:
+        tracker = KalmanTracker(dim=1, angular=True) if args.track else None
+        poller = AdaptiveDOAPoller(Mic_tuning, idle_rate=args.idle_rate, max_rate=args.max_rate, vad=args.vad,
+                                   tracker=tracker, tolerance=args.tolerance)
         try:
-            print(Mic_tuning.direction)
-            time.sleep(1)
+            for event in poller.events(idle=log.tick if log is not None else None):
+                tracked = '' if event.tracked is None else '\t{:.1f}'.format(event.tracked)
+                sys.stdout.write('{:.3f}\t{}\t{:.1f}Hz{}\n'.format(event.timestamp, event.direction, event.rate, tracked))
+                sys.stdout.flush()
+                publish(event.timestamp, event.direction)
         except KeyboardInterrupt:
-            break
\ No newline at end of file
+            pass
+    else:
+        print(Mic_tuning.direction)
+        while True:
+            try:
+                direction = Mic_tuning.direction
+                print(direction)
+                publish(time.time(), direction)
+                time.sleep(1)
+            except KeyboardInterrupt:
+                break
+
+    if server is not None:
+        server.stop()
+    if log is not None:
+        log.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+
+"""
+Append-only binary log of DOA and position time series
+
+File layout:
+
+    header   b'DOALOG1\\0', record size (u4), reserved (u4)
+    chunk    CHUNK header (magic, count, crc32, first and last timestamp)
+             followed by count fixed-width RECORD entries
+    chunk    ...
+
+The writer buffers records in a preallocated array and appends each chunk with
+one write call (looping over short writes), so a crash can at most leave a
+torn last chunk. Producers that go quiet call tick() from their idle path, so
+buffered records reach the disk within flush_interval even without appends. It is detected
+by its count or crc32 and cut off the next time the log is opened for writing;
+readers simply stop before it. The reader memory-maps the file and only walks
+the chunk headers, so a time range comes back as NumPy record arrays without
+any parsing.
+"""
+
+import os
+import sys
+import mmap
+import time
+import zlib
+import struct
+
+import numpy as np
+
+
+MAGIC = b'DOALOG1\0'
+HEADER = struct.Struct('<8sII')
+CHUNK = struct.Struct('<4sIIdd')
+CHUNK_MAGIC = b'CHNK'
+
+RECORD = np.dtype([('timestamp', '<f8'), ('device', '<u2'), ('doa', '<i2'),
+                   ('position', '<f4', (3,)), ('confidence', '<f4')])
+
+
+def scan(buffer, verify=True):
+    """
+    Walk the chunks of a log held in buffer
+
+    Returns:
+        (offsets, counts, t_first, t_last, end): payload offsets and chunk
+        summaries of every valid chunk, and the offset where valid data ends
+    """
+    offsets, counts, first, last = [], [], [], []
+    size = len(buffer)
+    if size < HEADER.size:
+        return offsets, counts, first, last, 0
+
+    magic, record_size, _ = HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC or record_size != RECORD.itemsize:
+        raise ValueError('not a DOA log or incompatible record layout')
+
+    pos = HEADER.size
+    while pos + CHUNK.size <= size:
+        magic, count, crc, t_first, t_last = CHUNK.unpack_from(buffer, pos)
+        payload = pos + CHUNK.size
+        end = payload + count * RECORD.itemsize
+        if magic != CHUNK_MAGIC or end > size:
+            break
+        if verify and zlib.crc32(buffer[payload:end]) & 0xffffffff != crc:
+            break
+
+        offsets.append(payload)
+        counts.append(count)
+        first.append(t_first)
+        last.append(t_last)
+        pos = end
+
+    return offsets, counts, first, last, pos
+
+
+class DOALogWriter:
+    def __init__(self, path, chunk_records=4096, flush_interval=1.0, fsync=False):
+        """
+        Args:
+            path: log file, created if missing, otherwise appended to
+            chunk_records: records buffered before a chunk is written
+            flush_interval: also write a chunk when its oldest record is this many seconds old
+            fsync: fsync after every chunk
+        """
+        self.path = path
+        self.chunk_records = chunk_records
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.buffer = np.zeros(chunk_records, dtype=RECORD)
+        self.count = 0
+        self.started = None
+
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = os.fstat(self.fd).st_size
+        end = 0
+        if size:
+            with open(path, 'rb') as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    offsets, counts, _, _, end = scan(buffer, verify=False)
+                    # only the last chunk can be torn, check its crc32 alone
+                    if offsets:
+                        payload = offsets[-1]
+                        _, _, crc, _, _ = CHUNK.unpack_from(buffer, payload - CHUNK.size)
+                        if zlib.crc32(buffer[payload:end]) & 0xffffffff != crc:
+                            end = payload - CHUNK.size
+                finally:
+                    buffer.close()
+            if end < size:
+                # cut off a chunk torn by a crash
+                os.ftruncate(self.fd, end)
+        if end < HEADER.size:
+            # new file, or a crash while it was being created
+            os.ftruncate(self.fd, 0)
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            os.write(self.fd, HEADER.pack(MAGIC, RECORD.itemsize, 0))
+        os.lseek(self.fd, 0, os.SEEK_END)
+
+    def append(self, timestamp, device=0, doa=-1, position=(np.nan, np.nan, np.nan), confidence=np.nan):
+        record = self.buffer[self.count]
+        record['timestamp'] = timestamp
+        record['device'] = device
+        record['doa'] = doa
+        record['position'] = position
+        record['confidence'] = confidence
+        self.count += 1
+
+        if self.started is None:
+            self.started = time.monotonic()
+        if self.count == self.chunk_records or time.monotonic() - self.started >= self.flush_interval:
+            self.flush()
+
+    def tick(self):
+        """
+        Write the buffered records if the oldest one is flush_interval old, for idle producers
+        """
+        if self.started is not None and time.monotonic() - self.started >= self.flush_interval:
+            self.flush()
+
+    def extend(self, records):
+        """
+        Append a RECORD array
+        """
+        records = np.asarray(records, dtype=RECORD)
+        while len(records):
+            n = min(len(records), self.chunk_records - self.count)
+            self.buffer[self.count:self.count + n] = records[:n]
+            self.count += n
+            records = records[n:]
+            if self.started is None:
+                self.started = time.monotonic()
+            if self.count == self.chunk_records:
+                self.flush()
+
+    def flush(self):
+        if not self.count:
+            return
+
+        records = self.buffer[:self.count]
+        payload = records.tobytes()
+        header = CHUNK.pack(CHUNK_MAGIC, self.count, zlib.crc32(payload) & 0xffffffff,
+                            records['timestamp'][0], records['timestamp'][-1])
+        data = memoryview(header + payload)
+        start = os.lseek(self.fd, 0, os.SEEK_CUR)
+        try:
+            while len(data):
+                data = data[os.write(self.fd, data):]
+        except OSError:
+            # drop the torn chunk, the records stay buffered for the next flush
+            os.ftruncate(self.fd, start)
+            os.lseek(self.fd, start, os.SEEK_SET)
+            raise
+        if self.fsync:
+            os.fsync(self.fd)
+
+        self.count = 0
+        self.started = None
+
+    def close(self):
+        self.flush()
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class DOALog:
+    def __init__(self, path, verify=False):
+        """
+        Memory-mapped reader
+
+        Args:
+            path: log file
+            verify: check the crc32 of every chunk when indexing
+        """
+        self.path = path
+        self.verify = verify
+        self.file = None
+        self.buffer = None
+        self.refresh()
+
+    def refresh(self):
+        """
+        Re-map the file to see chunks appended since it was opened
+        """
+        self.close()
+        self.file = open(self.path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+
+        offsets, counts, first, last, _ = scan(self.buffer, self.verify)
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.counts = np.array(counts, dtype=np.int64)
+        self.first = np.array(first)
+        self.last = np.array(last)
+
+    def __len__(self):
+        return int(self.counts.sum())
+
+    def _chunk(self, i):
+        return np.frombuffer(self.buffer, dtype=RECORD, count=int(self.counts[i]), offset=int(self.offsets[i]))
+
+    def records(self):
+        """
+        Every record, concatenated
+        """
+        return self.slice(-np.inf, np.inf)
+
+    def slice(self, start, stop, device=None):
+        """
+        Records with start <= timestamp < stop, optionally of one device
+
+        Chunks are located from their first/last timestamps without touching the
+        records; a range inside one chunk is returned as a view of the mapping.
+        """
+        selected = np.flatnonzero((self.last >= start) & (self.first < stop))
+        if not len(selected):
+            return np.zeros(0, dtype=RECORD)
+
+        chunks = [self._chunk(i) for i in selected]
+        records = chunks[0] if len(chunks) == 1 else np.concatenate(chunks)
+
+        t = records['timestamp']
+        if np.all(t[1:] >= t[:-1]):
+            records = records[np.searchsorted(t, start, 'left'):np.searchsorted(t, stop, 'left')]
+        else:
+            records = records[(t >= start) & (t < stop)]
+
+        if device is not None:
+            records = records[records['device'] == device]
+        return records
+
+    def close(self):
+        if self.buffer is not None and not isinstance(self.buffer, bytes):
+            try:
+                self.buffer.close()
+            except BufferError:
+                # slices handed out still view the mapping, it is released with them
+                pass
+        if self.file is not None:
+            self.file.close()
+        self.buffer = None
+        self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main():
+    """
+    Benchmark: write a month of 10 Hz records from 3 devices, then slice an hour
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark the DOA log')
+    parser.add_argument('path', nargs='?', default='doa_benchmark.log')
+    parser.add_argument('--days', type=float, default=30)
+    parser.add_argument('--rate', type=float, default=10.0, help='records per second per device')
+    parser.add_argument('--devices', type=int, default=3)
+    args = parser.parse_args()
+
+    n = int(args.days * 86400 * args.rate) * args.devices
+    block = 1 << 20
+    start = time.time()
+    with DOALogWriter(args.path, chunk_records=1 << 16) as writer:
+        for begin in range(0, n, block):
+            records = np.zeros(min(block, n - begin), dtype=RECORD)
+            index = np.arange(begin, begin + len(records))
+            records['timestamp'] = index // args.devices / args.rate
+            records['device'] = index % args.devices
+            records['doa'] = index % 360
+            writer.extend(records)
+    elapsed = time.time() - start
+    sys.stdout.write("wrote {} records ({:.0f} MB) in {:.2f}s: {:.0f} records/s\n".format(
+        n, os.path.getsize(args.path) / 1e6, elapsed, n / elapsed))
+
+    start = time.time()
+    log = DOALog(args.path)
+    hour = log.slice(86400 * args.days / 2, 86400 * args.days / 2 + 3600, device=1)
+    elapsed = time.time() - start
+    sys.stdout.write("opened {} chunks and sliced {} records of one hour in {:.1f} ms\n".format(
+        len(log.counts), len(hour), elapsed * 1000))
+    log.close()
+
+
+if __name__ == '__main__':
+    main()
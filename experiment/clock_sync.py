@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+"""
+Clock synchronization between arrays from ambient sound
+
+Every array samples on its own crystal, so the same sound lands at different
+sample indices on each array and the gap slowly grows. For each array a linear
+clock model maps reference sample indices to its own:
+
+    n_a = n_ref + offset + drift * n_ref
+
+It is estimated from ambient sound: every hop a window of each array's mono
+signal is decimated and cross-correlated with the reference array by FFT to
+find the coarse lag, which is then refined at the full rate around it. The
+measured lags are fitted with a weighted linear regression with exponential
+forgetting, measurements far from the current model are rejected once it has
+settled. The offset also holds the acoustic path difference between the arrays,
+which averages out for diffuse ambient sound but not for a single dominant
+source.
+
+DriftCorrector resamples an array's stream onto the reference clock block by
+block with cubic interpolation, so the aligned streams can feed TDOA processing.
+
+    python clock_sync.py                              # simulated arrays with offsets and drift
+    python clock_sync.py --bus respeaker0 --bus respeaker1   # live, from audio_bus.py
+"""
+import sys
+import os
+import time
+import argparse
+
+import numpy as np
+
+# Add parent directory to sys.path
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, parent_dir)
+
+
+def decimate(x, factor):
+    """
+    Low-pass and decimate along the last axis by cutting the spectrum
+    """
+    n = x.shape[-1] // factor * factor
+    spectrum = np.fft.rfft(x[..., :n], axis=-1)
+    return np.fft.irfft(spectrum[..., :n // factor // 2 + 1], n // factor, axis=-1) / factor
+
+
+def cross_correlate(ref, sig, max_lag, phat=False, center=None):
+    """
+    Lag of sig behind ref by FFT cross-correlation, batched over leading axes
+
+    Args:
+        ref, sig: (..., n) signals
+        max_lag: largest lag searched, in samples
+        phat: whiten the cross spectrum (GCC-PHAT), sharper peaks in reverberation
+        center: (...,) lags to search around instead of 0
+
+    Returns:
+        lag: (...,) fractional lag in samples (parabolic peak interpolation), positive when sig is late
+        peak: (...,) normalized correlation at the peak
+    """
+    n = ref.shape[-1] + sig.shape[-1]
+    nfft = 1 << int(np.ceil(np.log2(n)))
+    R = np.fft.rfft(ref, nfft, axis=-1)
+    S = np.fft.rfft(sig, nfft, axis=-1)
+    cross = S * np.conj(R)
+    if phat:
+        cross /= np.maximum(np.abs(cross), 1e-12)
+    cc = np.fft.irfft(cross, nfft, axis=-1)
+
+    # lags -max_lag .. max_lag around center, gathered from the circular correlation
+    center = np.zeros(ref.shape[:-1], dtype=int) if center is None else np.rint(center).astype(int)
+    lags = center[..., None] + np.arange(-max_lag, max_lag + 1)
+    window = np.take_along_axis(cc, lags % nfft, axis=-1)
+
+    best = np.argmax(window, axis=-1)
+    inner = np.clip(best, 1, window.shape[-1] - 2)
+    y0, y1, y2 = [np.take_along_axis(window, (inner + k)[..., None], axis=-1)[..., 0] for k in (-1, 0, 1)]
+    denominator = y0 - 2 * y1 + y2
+    shift = np.where(np.abs(denominator) > 1e-12, 0.5 * (y0 - y2) / np.where(denominator == 0, 1, denominator), 0.0)
+    shift = np.where(best == inner, np.clip(shift, -0.5, 0.5), 0.0)
+
+    lag = np.take_along_axis(lags, best[..., None], axis=-1)[..., 0] + shift
+    if phat:
+        # whitened spectra correlate to 1 at a perfect match
+        peak = np.max(window, axis=-1)
+    else:
+        energy = np.sqrt(np.sum(ref ** 2, axis=-1) * np.sum(sig ** 2, axis=-1))
+        peak = np.max(window, axis=-1) / np.maximum(energy, 1e-12)
+    return lag, peak
+
+
+class ClockModel:
+    def __init__(self, forgetting=0.98, gate=4.0, min_updates=5, noise=0.5):
+        """
+        Linear clock n_a - n_ref = offset + drift * n_ref, fitted to lag measurements
+
+        Args:
+            forgetting: weight of the history kept per measurement
+            gate: reject measurements more than this many standard deviations off once settled
+            min_updates: measurements before the gate applies
+            noise: floor of the measurement noise in samples
+        """
+        self.forgetting = forgetting
+        self.gate = gate
+        self.min_updates = min_updates
+        self.noise = noise
+        # weighted sums in centered units: t is scaled to keep the normal equations well conditioned
+        self.S = np.zeros((2, 2))
+        self.y = np.zeros(2)
+        self.yy = 0.0
+        self.W = 0.0
+        self.scale = 1.0
+        self.updates = 0
+        self.rejected = 0
+        self.offset = 0.0
+        self.drift = 0.0
+        self.sigma = None
+
+    def predict(self, t):
+        return self.offset + self.drift * t
+
+    def update(self, t, lag, weight=1.0):
+        """
+        Fold in the lag measured at reference sample t, returns False when rejected
+        """
+        if self.updates >= self.min_updates and self.sigma is not None:
+            if abs(lag - self.predict(t)) > self.gate * max(self.sigma, self.noise):
+                self.rejected += 1
+                return False
+
+        if not self.updates:
+            self.scale = max(abs(t), 1.0)
+        u = np.array([1.0, t / self.scale])
+        lam = self.forgetting
+        self.S = lam * self.S + weight * np.outer(u, u)
+        self.y = lam * self.y + weight * lag * u
+        self.yy = lam * self.yy + weight * lag * lag
+        self.W = lam * self.W + weight
+        self.updates += 1
+
+        if self.updates == 1 or abs(np.linalg.det(self.S)) < 1e-12:
+            self.offset = lag
+            return True
+
+        a, b = np.linalg.solve(self.S, self.y)
+        self.offset, self.drift = a, b / self.scale
+        sse = max(self.yy - float(self.y @ np.array([a, b])), 0.0)
+        self.sigma = np.sqrt(sse / max(self.W - 2, 1.0))
+        return True
+
+
+class ClockSync:
+    def __init__(self, arrays, rate=16000, decimation=4, window=2.0, hop=1.0, max_offset=0.1,
+                 refine=8, min_peak=0.1, **model):
+        """
+        Args:
+            arrays: number of arrays, array 0 is the reference clock
+            rate: nominal sample rate
+            decimation: factor of the streams the coarse correlation runs on
+            window: seconds correlated per measurement
+            hop: seconds between measurements
+            max_offset: largest offset searched, in seconds
+            refine: full-rate samples searched around the coarse lag
+            min_peak: measurements with a weaker normalized correlation are skipped
+            model: ClockModel arguments
+        """
+        self.arrays = arrays
+        self.rate = rate
+        self.decimation = decimation
+        self.window = int(window * rate)
+        self.hop = int(hop * rate)
+        self.max_lag = int(max_offset * rate)
+        self.refine = refine
+        self.min_peak = min_peak
+        self.models = [ClockModel(**model) for _ in range(arrays)]
+
+        # per array: samples kept and the index of the first one
+        self.buffers = [np.zeros(0, dtype=np.float32) for _ in range(arrays)]
+        self.starts = [0] * arrays
+        self.next = self.window + self.max_lag
+        self.measurements = 0
+
+    def _guess(self, array, t):
+        """
+        Predicted lag of an array at reference sample t, whole samples
+        """
+        model = self.models[array]
+        return int(round(model.predict(t))) if model.updates else 0
+
+    def feed(self, array, samples):
+        """
+        Append mono samples of one array, returns the measurement results once all arrays cover the next window
+        """
+        self.buffers[array] = np.concatenate([self.buffers[array], np.asarray(samples, dtype=np.float32)])
+        results = []
+        while all(self.starts[a] + len(self.buffers[a]) >= self.next + self._guess(a, self.next)
+                  for a in range(self.arrays)):
+            results.append(self._measure(self.next))
+            self.next += self.hop
+            self._trim()
+        return results
+
+    def _window(self, array, stop):
+        index = stop - self.window - self.starts[array]
+        window = self.buffers[array][max(index, 0):index + self.window]
+        # the start of a stream lagging behind the reference
+        return np.concatenate([np.zeros(self.window - len(window), dtype=np.float32), window])
+
+    def _measure(self, stop):
+        """
+        Lag of every array behind the reference for the window ending at reference sample stop
+        """
+        D = self.decimation
+        ref = self._window(0, stop)
+        lags = np.zeros(self.arrays)
+        peaks = np.ones(self.arrays)
+        for a in range(1, self.arrays):
+            # search around the prediction, so a drifting clock stays inside max_offset
+            guess = self._guess(a, stop)
+            sig = self._window(a, stop + guess)
+
+            coarse, peak = cross_correlate(decimate(ref, D), decimate(sig, D), self.max_lag // D)
+            fine, peak = cross_correlate(ref, sig, self.refine, center=np.array(coarse * D))
+            lag = guess + float(fine)
+            peaks[a] = float(peak)
+            if peak >= self.min_peak:
+                # the lag holds at the middle of the window
+                self.models[a].update(stop - self.window // 2, lag, float(peak))
+            lags[a] = lag
+
+        self.measurements += 1
+        return stop, lags, peaks
+
+    def _trim(self):
+        for a in range(self.arrays):
+            drop = self.next + self._guess(a, self.next) - self.window - self.max_lag - self.starts[a]
+            if drop > 0:
+                self.buffers[a] = self.buffers[a][drop:]
+                self.starts[a] += drop
+
+    def offsets(self):
+        """
+        (offset in samples, drift in ppm) of every array against the reference
+        """
+        return [(m.offset, m.drift * 1e6) for m in self.models]
+
+
+class DriftCorrector:
+    def __init__(self, model):
+        """
+        Resample one array's stream onto the reference clock
+
+        Args:
+            model: ClockModel of the array, or any object with predict(t) in samples
+        """
+        self.model = model
+        self.history = np.zeros(0, dtype=np.float32)
+        self.history_start = 0
+        self.output = 0
+
+    def process(self, samples):
+        """
+        Feed input samples, returns the reference-clock samples they complete
+        """
+        self.history = np.concatenate([self.history, np.asarray(samples, dtype=np.float32)])
+        end = self.history_start + len(self.history)
+
+        # reference sample k sits at input position k + lag(k); the clock model is
+        # near-identity, so solve for the last complete output from the input end
+        last = end - 3 - self.model.predict(end)
+        count = int(np.floor(last)) - self.output + 1
+        if count <= 0:
+            return np.zeros(0, dtype=np.float32)
+
+        k = np.arange(self.output, self.output + count, dtype=float)
+        position = k + self.model.predict(k) - self.history_start
+        valid = position >= 1
+        out = np.zeros(count, dtype=np.float32)
+        out[valid] = self._cubic(position[valid])
+        self.output += count
+
+        # keep what the next block still needs
+        first = int(np.floor(self.output + self.model.predict(self.output))) - 2 - self.history_start
+        if first > 0:
+            self.history = self.history[first:]
+            self.history_start += first
+        return out
+
+    def _cubic(self, position):
+        i = np.floor(position).astype(int)
+        f = (position - i).astype(np.float32)
+        h = self.history
+        p0, p1, p2, p3 = h[i - 1], h[i], h[np.minimum(i + 1, len(h) - 1)], h[np.minimum(i + 2, len(h) - 1)]
+        # Catmull-Rom
+        return p1 + 0.5 * f * (p2 - p0 + f * (2 * p0 - 5 * p1 + 4 * p2 - p3 + f * (3 * (p1 - p2) + p3 - p0)))
+
+
+def simulate(args):
+    random = np.random.default_rng(args.seed)
+    rate = args.rate
+    n = int(args.seconds * rate)
+    offsets = np.concatenate([[0.0], random.uniform(-0.03, 0.03, args.arrays - 1)]) * rate
+    drifts = np.concatenate([[0.0], random.uniform(-50, 50, args.arrays - 1)]) * 1e-6
+
+    # ambient sound: low-passed noise with some bursts
+    source = decimate(random.standard_normal(2 * (n + 4 * rate)), 2)
+    source *= 1 + 4 * (random.random(len(source) // rate + 1)[np.arange(len(source)) // rate] > 0.7)
+
+    sync = ClockSync(args.arrays, rate)
+    elapsed = 0.0
+    block = 1024
+    streams = []
+    for a in range(args.arrays):
+        # a sound at reference sample t reaches array a at t + offset + drift * t
+        t = np.arange(n, dtype=float)
+        position = t - offsets[a] - drifts[a] * t + 2 * rate
+        i = np.floor(position).astype(int)
+        f = position - i
+        streams.append((1 - f) * source[i] + f * source[i + 1] + 0.05 * random.standard_normal(n))
+
+    for start in range(0, n, block):
+        begin = time.time()
+        for a in range(args.arrays):
+            sync.feed(a, streams[a][start:start + block])
+        elapsed += time.time() - begin
+
+    sys.stdout.write("{} measurements of {} arrays in {:.2f}s ({:.1f} ms each)\n".format(
+        sync.measurements, args.arrays, elapsed, elapsed / max(sync.measurements, 1) * 1000))
+    for a, (offset, drift) in enumerate(sync.offsets()):
+        sys.stdout.write("array {}: offset {:9.2f} (true {:9.2f}) samples, drift {:7.2f} (true {:7.2f}) ppm, "
+                         "{} rejected\n".format(a, offset, offsets[a], drift, drifts[a] * 1e6, sync.models[a].rejected))
+
+    # align array 1 on the reference and compare
+    if args.arrays > 1:
+        corrector = DriftCorrector(sync.models[1])
+        aligned = np.concatenate([corrector.process(streams[1][s:s + block]) for s in range(0, n, block)])
+        m = min(len(aligned), n) - rate
+        ref, out = streams[0][rate:m], aligned[rate:m]
+        sys.stdout.write("array 1 after drift correction: correlation with the reference {:.3f} (before {:.3f})\n".format(
+            np.corrcoef(ref, out)[0, 1], np.corrcoef(ref, streams[1][rate:m])[0, 1]))
+
+
+def live(args):
+    sys.path.insert(0, os.path.join(parent_dir, 'test'))
+    from audio_bus import BusReader
+
+    readers = [BusReader(name) for name in args.bus]
+    sync = ClockSync(len(readers), readers[0].rate)
+    try:
+        while True:
+            for a, reader in enumerate(readers):
+                _, _, view = reader.read()
+                for stop, lags, peaks in sync.feed(a, view[:, 1:5].mean(axis=1)):
+                    sys.stdout.write("{:.1f}s {}\n".format(stop / float(sync.rate), ' | '.join(
+                        '{:+.2f} smp {:+.1f} ppm'.format(offset, drift) for offset, drift in sync.offsets()[1:])))
+                    sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    for reader in readers:
+        reader.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Estimate offset and drift between array clocks')
+    parser.add_argument('--bus', action='append', help='audio bus of an array (audio_bus.py), the first is the reference')
+    parser.add_argument('--arrays', type=int, default=3, help='simulated arrays')
+    parser.add_argument('--seconds', type=float, default=120.0, help='simulated duration')
+    parser.add_argument('--rate', type=int, default=16000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.bus:
+        live(args)
+    else:
+        simulate(args)
+
+
+if __name__ == '__main__':
+    main()
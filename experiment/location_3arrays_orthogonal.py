@@ -20,6 +20,8 @@ try:
 except ImportError:
     print("Warning: tuning module not found. Make sure tuning.py is in parent directory.")
 
+from kalman_tracker import KalmanTracker
+
 class ThreeArrayLocalization3D:
     def __init__(self, array_distance=1.0):
         """
@@ -165,6 +167,9 @@ class ThreeArrayLocalization3D:
 def main():
     # Initialize the 3D localization system
     localizer = ThreeArrayLocalization3D(array_distance=1.0)
+
+    # Smooth the per-sample solutions, a wrong angle from one array then only nudges the track
+    tracker = KalmanTracker(dim=3, angular=False, sigma_q=1.0, sigma_r=0.2)
     
     # Find USB devices (assuming you have 3 arrays, each represented by one device)
     devices = usb.core.find(find_all=True, idVendor=0x2886, idProduct=0x0018)
@@ -208,14 +213,20 @@ def main():
                     doa1_xy, doa2_xz, doa3_yz
                 )
                 
+                tracks = tracker.update(position_ls[None, :], time.time())
+                tracked = ""
+                if tracks:
+                    tracked = " | KF: ({:.2f},{:.2f},{:.2f})".format(*tracks[0].position)
+
                 # Display results
                 sys.stdout.write(
                     "DOA: XY={:.1f}° XZ={:.1f}° YZ={:.1f}° | "
                     "3D_LS: ({:.2f},{:.2f},{:.2f}) conf={:.3f} | "
-                    "3D_Geom: ({:.2f},{:.2f},{:.2f}) err={:.3f}\n".format(
+                    "3D_Geom: ({:.2f},{:.2f},{:.2f}) err={:.3f}{}\n".format(
                         doa1_xy, doa2_xz, doa3_yz,
                         position_ls[0], position_ls[1], position_ls[2], confidence_ls,
-                        position_geom[0], position_geom[1], position_geom[2], error_geom
+                        position_geom[0], position_geom[1], position_geom[2], error_geom,
+                        tracked
                     )
                 )
                 sys.stdout.flush()
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""
+Localization from any number of arrays with arbitrary poses
+
+Every array has a center and a local-to-world rotation (6-DoF pose) and reports
+a DOAANGLE in its own plane. An angle constrains the source to a line through
+the center (2D, or 3D when an elevation is known) or, for a planar array in 3D,
+to the plane spanned by the in-plane direction and the array normal. Either
+constraint is a projector P_i with distance |P_i (x - c_i)|, so the weighted
+least squares point solves the closed-form normal equations
+
+    sum_i w_i P_i x = sum_i w_i P_i c_i
+
+which cost O(arrays) to build for any number of frames at once. Outliers (a
+reflection, a wrong DOA) are rejected with RANSAC: minimal subsets of arrays
+give hypotheses for every frame in one batched solve, each array is scored by
+its distance to each hypothesis, and the best consensus set is solved again.
+
+    python location_n_arrays.py --arrays 6 --outliers 0.1   # benchmark on synthetic scenes
+    python location_n_arrays.py --poses poses.json          # live, one pose per device
+"""
+import sys
+import os
+import json
+import time
+import argparse
+import itertools
+from math import comb
+
+import numpy as np
+
+# Add parent directory to sys.path
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, parent_dir)
+
+from location_3arrays_orthogonal import ThreeArrayLocalization3D
+from scene_generator import ARRAY_ROTATIONS, ideal_doa
+
+
+def rotation_from_euler(roll, pitch, yaw):
+    """
+    Local-to-world rotation from roll, pitch and yaw in degrees (Z-Y-X order)
+    """
+    r, p, y = np.radians([roll, pitch, yaw])
+    rx = np.array([[1, 0, 0], [0, np.cos(r), -np.sin(r)], [0, np.sin(r), np.cos(r)]])
+    ry = np.array([[np.cos(p), 0, np.sin(p)], [0, 1, 0], [-np.sin(p), 0, np.cos(p)]])
+    rz = np.array([[np.cos(y), -np.sin(y), 0], [np.sin(y), np.cos(y), 0], [0, 0, 1]])
+    return rz @ ry @ rx
+
+
+class MultiArrayLocalizer:
+    def __init__(self, centers, rotations, model=None, threshold=0.1, iterations=64,
+                 min_inliers=None, seed=None):
+        """
+        Args:
+            centers: (A, D) array centers, D = 2 or 3
+            rotations: (A, D, D) local-to-world rotations, columns are the array's x, y (and normal) axes
+            model: 'ray' (2D, or 3D with elevation) or 'plane' (3D from azimuth only), defaults by D
+            threshold: distance in meters within which an array agrees with a hypothesis
+            iterations: RANSAC hypotheses per frame, every subset when there are fewer, 0 to disable outlier rejection
+            min_inliers: arrays a solution needs, defaults to the minimal subset size
+            seed: random seed of the subset sampling
+        """
+        self.centers = np.asarray(centers, dtype=float)
+        self.rotations = np.asarray(rotations, dtype=float)
+        self.arrays, self.dim = self.centers.shape
+        if self.rotations.shape != (self.arrays, self.dim, self.dim):
+            raise ValueError('need one {0}x{0} rotation per array'.format(self.dim))
+
+        self.model = model or ('ray' if self.dim == 2 else 'plane')
+        if self.model not in ('ray', 'plane') or (self.model == 'plane' and self.dim != 3):
+            raise ValueError('unknown model {} for {}D'.format(self.model, self.dim))
+
+        # a point is fixed by 2 lines, or by 3 planes
+        self.subset = 2 if self.model == 'ray' else 3
+        self.threshold = threshold
+        self.iterations = iterations
+        self.min_inliers = self.subset if min_inliers is None else min_inliers
+        self.random = np.random.default_rng(seed)
+
+    @classmethod
+    def orthogonal(cls, **kwargs):
+        """
+        The 3 arrays on orthogonal planes of ThreeArrayLocalization3D
+        """
+        localizer = ThreeArrayLocalization3D()
+        centers = [localizer.array1_center, localizer.array2_center, localizer.array3_center]
+        return cls(centers, ARRAY_ROTATIONS, **kwargs)
+
+    @classmethod
+    def from_poses(cls, poses, **kwargs):
+        """
+        Build from a list of {"center": [x, y, z], "rpy": [roll, pitch, yaw]} in degrees
+        """
+        centers = [p['center'] for p in poses]
+        rotations = [rotation_from_euler(*p.get('rpy', (0, 0, 0))) for p in poses]
+        return cls(centers, rotations, **kwargs)
+
+    def directions(self, doa, elevation=None, rotations=None):
+        """
+        World direction of every DOA
+
+        Args:
+            doa: (..., A) azimuths in degrees, in each array's plane
+            elevation: (..., A) elevations in degrees above the array plane, for the 'ray' model in 3D
+            rotations: (A, D, D) rotation of each reading's array, defaults to one reading per array
+
+        Returns:
+            (..., A, D) unit vectors
+        """
+        rotations = self.rotations if rotations is None else rotations
+        azimuth = np.radians(np.asarray(doa, dtype=float))
+        if self.dim == 2:
+            local = np.stack([np.cos(azimuth), np.sin(azimuth)], axis=-1)
+        else:
+            elevation = np.zeros_like(azimuth) if elevation is None else np.radians(elevation)
+            local = np.stack([np.cos(elevation) * np.cos(azimuth), np.cos(elevation) * np.sin(azimuth),
+                              np.sin(elevation)], axis=-1)
+        return np.einsum('aij,...aj->...ai', rotations, local)
+
+    def projectors(self, directions, rotations=None):
+        """
+        (..., A, D, D) projectors onto the distance from each constraint
+        """
+        rotations = self.rotations if rotations is None else rotations
+        eye = np.eye(self.dim)
+        if self.model == 'ray':
+            return eye - directions[..., :, None] * directions[..., None, :]
+
+        # normal of the plane holding the direction and the array normal
+        normal = np.cross(rotations[:, :, 2], directions)
+        normal /= np.maximum(np.linalg.norm(normal, axis=-1, keepdims=True), 1e-12)
+        return normal[..., :, None] * normal[..., None, :]
+
+    def solve(self, P, Pc, weights):
+        """
+        Weighted least squares points, batched over the leading axes of weights (..., A)
+
+        Args:
+            P: (..., A, D, D) projectors of the constraints, see projectors()
+            Pc: (..., A, D) projectors applied to the array centers
+            weights: (..., A) weight of every constraint, 0 to leave it out
+
+        Returns:
+            (..., D) points, NaN where the weighted constraints do not fix one
+        """
+        M = np.einsum('...a,...aij->...ij', weights, P)
+        b = np.einsum('...a,...ai->...i', weights, Pc)
+
+        # flag subsets that do not fix a point, e.g. parallel rays
+        scale = np.trace(M, axis1=-2, axis2=-1)[..., None, None] / self.dim
+        ok = np.abs(np.linalg.det(M / np.maximum(scale, 1e-12))) > 1e-6
+        M = M + (~ok)[..., None, None] * np.eye(self.dim)
+        x = np.linalg.solve(M, b[..., None])[..., 0]
+        x[~ok] = np.nan
+        return x
+
+    def distances(self, x, directions, P):
+        """
+        (..., A) distance of x (..., D) from each constraint, inf when x is behind the array
+        """
+        rel = x[..., None, :] - self.centers
+        d = np.sqrt(np.maximum(np.einsum('...ai,...aij,...aj->...a', rel, P, rel), 0.0))
+        behind = np.einsum('...ai,...ai->...a', rel, directions) < 0
+        d[behind | np.isnan(d)] = np.inf
+        return d
+
+    def subsets(self, arrays):
+        """
+        (K, arrays) masks of the minimal subsets tried, shared by all frames
+
+        Every subset when there are at most iterations of them, otherwise iterations random ones.
+        """
+        if comb(arrays, self.subset) <= self.iterations:
+            order = np.array(list(itertools.combinations(range(arrays), self.subset)))
+        else:
+            order = np.argsort(self.random.random((self.iterations, arrays)), axis=1)[:, :self.subset]
+        subsets = np.zeros((len(order), arrays))
+        np.put_along_axis(subsets, order, 1.0, axis=1)
+        return subsets
+
+    def locate(self, doa, weights=None, elevation=None):
+        """
+        Localize a batch of frames
+
+        Args:
+            doa: (F, A) DOA angles in degrees, negative or NaN for arrays without a reading
+            weights: (F, A) or (A,) confidence of each reading, defaults to 1
+            elevation: (F, A) elevations for the 'ray' model in 3D
+
+        Returns:
+            positions: (F, D), NaN where no consensus was found
+            inliers: (F, A) bool mask of the arrays used
+            residual: (F,) weighted RMS distance of the inliers in meters
+        """
+        doa = np.atleast_2d(np.asarray(doa, dtype=float))
+        F, A = doa.shape
+        valid = np.isfinite(doa) & (doa >= 0)
+        doa = np.where(valid, doa, 0.0)
+        weights = np.ones((F, A)) if weights is None else np.broadcast_to(weights, (F, A)).astype(float)
+        weights = np.where(valid, weights, 0.0)
+
+        directions = self.directions(doa, elevation)
+        P = self.projectors(directions)
+        Pc = np.einsum('faij,aj->fai', P, self.centers)
+
+        inliers = valid.copy()
+        if self.iterations and A > self.subset:
+            subsets = self.subsets(A)
+            hypotheses = self.solve(P[:, None], Pc[:, None], weights[:, None, :] * subsets)
+            distance = self.distances(hypotheses, directions[:, None], P[:, None])
+            agree = (distance < self.threshold) & valid[:, None, :]
+
+            # most agreeing weight first, smallest spread among them to break ties
+            score = np.sum(agree * weights[:, None, :], axis=-1)
+            spread = np.sum(np.where(agree, distance, 0.0) ** 2, axis=-1)
+            best = np.argmax(score - 1e-6 * spread / self.threshold ** 2, axis=1)
+            inliers = agree[np.arange(F), best]
+
+        positions = self.solve(P, Pc, weights * inliers)
+
+        # final consensus around the refined point
+        if self.iterations and A > self.subset:
+            inliers = (self.distances(positions, directions, P) < self.threshold) & valid
+            positions = self.solve(P, Pc, weights * inliers)
+
+        count = inliers.sum(axis=1)
+        positions[count < self.min_inliers] = np.nan
+
+        distance = self.distances(positions, directions, P)
+        w = weights * inliers
+        with np.errstate(invalid='ignore', divide='ignore'):
+            residual = np.sqrt(np.sum(w * np.where(inliers, distance, 0.0) ** 2, axis=1) / np.sum(w, axis=1))
+        return positions, inliers, residual
+
+    def triangulate(self, doa, weights=None):
+        """
+        Single frame: (position, inliers, residual)
+        """
+        positions, inliers, residual = self.locate(np.asarray(doa, dtype=float)[None], weights)
+        return positions[0], inliers[0], residual[0]
+
+
+def random_poses(arrays, room, random):
+    """
+    Arrays anywhere in the room at least 10% of its size away from the walls, each with a random orientation
+    """
+    centers = random.uniform(0.1, 0.9, (arrays, 3)) * room
+    rotations = np.stack([rotation_from_euler(*random.uniform(-180, 180, 3)) for _ in range(arrays)])
+    return centers, rotations
+
+
+def benchmark(arrays, frames, outliers, noise, seed=0):
+    random = np.random.default_rng(seed)
+    room = np.array([5.0, 5.0, 3.0])
+    centers, rotations = random_poses(arrays, room, random)
+    sources = random.uniform(0.1, 0.9, (frames, 3)) * room
+
+    doa = ideal_doa(sources, centers, rotations).astype(float)
+    doa += random.normal(0, noise, doa.shape)
+    wrong = random.random(doa.shape) < outliers
+    doa[wrong] = random.uniform(0, 360, np.count_nonzero(wrong))
+    doa = np.mod(doa, 360)
+
+    results = []
+    for iterations in (0, 64):
+        localizer = MultiArrayLocalizer(centers, rotations, iterations=iterations, threshold=0.15, seed=seed)
+        start = time.time()
+        positions, inliers, residual = localizer.locate(doa)
+        elapsed = time.time() - start
+        error = np.linalg.norm(positions - sources, axis=1)
+        found = np.isfinite(error)
+        results.append((iterations, elapsed, np.median(error[found]) if found.any() else np.nan,
+                        np.mean(error[found] < 0.3) if found.any() else 0.0, np.mean(found)))
+    return results
+
+
+def live(poses, interval):
+    import usb.core
+    from tuning import Tuning
+
+    localizer = MultiArrayLocalizer.from_poses(poses)
+    devices = sorted(usb.core.find(find_all=True, idVendor=0x2886, idProduct=0x0018),
+                     key=lambda d: (d.bus, d.address))
+    if len(devices) < len(poses):
+        print("Error: {} poses but only {} arrays found".format(len(poses), len(devices)))
+        return
+
+    tunings = [Tuning(d) for d in devices[:len(poses)]]
+    print("Found \033[92m{} devices\033[0m, localizing with {}".format(len(devices), len(tunings)))
+    try:
+        while True:
+            doa = [t.direction for t in tunings]
+            position, inliers, residual = localizer.triangulate(doa)
+            sys.stdout.write("DOA: {} | pos: ({:.2f},{:.2f},{:.2f}) inliers={} res={:.3f}\n".format(
+                doa, position[0], position[1], position[2], ''.join('1' if i else '0' for i in inliers), residual))
+            sys.stdout.flush()
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("\nExiting localization...")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Localize with any number of arrays at arbitrary poses')
+    parser.add_argument('--poses', default=None, help='JSON list of {"center": [x,y,z], "rpy": [r,p,y]}, runs live')
+    parser.add_argument('--interval', type=float, default=0.1)
+    parser.add_argument('--arrays', type=int, default=None, help='benchmark this many arrays, default 3 to 8')
+    parser.add_argument('--frames', type=int, default=20000)
+    parser.add_argument('--outliers', type=float, default=0.1, help='fraction of random DOA readings')
+    parser.add_argument('--noise', type=float, default=2.0, help='DOA noise in degrees')
+    args = parser.parse_args()
+
+    if args.poses:
+        with open(args.poses) as f:
+            live(json.load(f), args.interval)
+        return
+
+    print('{:>6} {:>7} {:>10} {:>12} {:>10} {:>8}'.format(
+        'arrays', 'ransac', 'us/frame', 'median err', '<30cm', 'solved'))
+    for arrays in ([args.arrays] if args.arrays else range(3, 9)):
+        for iterations, elapsed, median, within, solved in benchmark(arrays, args.frames, args.outliers, args.noise):
+            print('{:6} {:7} {:10.2f} {:11.3f}m {:9.1%} {:8.1%}'.format(
+                arrays, iterations, elapsed / args.frames * 1e6, median, within, solved))
+
+
+if __name__ == '__main__':
+    main()
@@ -13,6 +13,7 @@ sys.path.insert(0, parent_dir)
 
 from tuning import Tuning
 
+# distance between the two arrays in meters
 L = 1
 
 devices = usb.core.find(find_all=True, idVendor=0x2886, idProduct=0x0018)
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Recursive least-squares position from a stream of DOA readings
+
+Instead of solving every DOA tuple on its own, each reading is folded into
+running normal-equation accumulators with exponential forgetting:
+
+    M <- lambda M + sum_i w_i P_i          b <- lambda b + sum_i w_i P_i c_i
+    s <- lambda s + sum_i w_i c_i'P_i c_i  W <- lambda W + sum_i w_i
+
+so an update costs the same whatever the history and the position is the
+solution of M x = b. The residual s - b'x gives the noise variance, hence the
+covariance sigma^2 M^-1. When the readings stop agreeing with the estimate for
+a few updates in a row (the source moved or another one started), the
+accumulators restart from the current reading.
+
+    python location_rls.py        # compare with per-sample solving on a synthetic stream
+"""
+import sys
+import os
+import time
+import argparse
+
+import numpy as np
+
+# Add parent directory to sys.path
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, parent_dir)
+
+from location_n_arrays import MultiArrayLocalizer, random_poses
+from scene_generator import ideal_doa
+
+
+class RLSPositionEstimator:
+    def __init__(self, localizer, forgetting=0.95, sigma_r=0.05, change_threshold=9.0, patience=3):
+        """
+        Args:
+            localizer: MultiArrayLocalizer providing the array poses and constraint model
+            forgetting: weight of the history kept per update, 1 for a stationary source
+            sigma_r: floor of the per-reading distance noise in meters
+            change_threshold: mean squared normalized distance of a reading that counts as a change
+            patience: consecutive changed readings before the accumulators are reset
+        """
+        self.localizer = localizer
+        self.forgetting = forgetting
+        self.sigma_r = sigma_r
+        self.change_threshold = change_threshold
+        self.patience = patience
+
+        D = localizer.dim
+        self.M = np.zeros((D, D))
+        self.b = np.zeros(D)
+        self.s = 0.0
+        self.W = 0.0
+        self.position = None
+        self.covariance = None
+        self.variance = sigma_r ** 2
+        self.noise = sigma_r ** 2
+        self.changes = 0
+        self.resets = 0
+
+    def reset(self):
+        self.M[...] = 0.0
+        self.b[...] = 0.0
+        self.s = 0.0
+        self.W = 0.0
+        self.position = None
+        self.covariance = None
+        self.variance = self.sigma_r ** 2
+        self.noise = self.sigma_r ** 2
+        self.changes = 0
+
+    def _terms(self, doa, weights):
+        doa = np.asarray(doa, dtype=float)
+        valid = np.isfinite(doa) & (doa >= 0)
+        w = np.where(valid, 1.0 if weights is None else np.asarray(weights, dtype=float), 0.0)
+
+        directions = self.localizer.directions(np.where(valid, doa, 0.0))
+        P = self.localizer.projectors(directions)
+        Pc = np.einsum('aij,aj->ai', P, self.localizer.centers)
+        return w, directions, P, Pc
+
+    def update(self, doa, weights=None):
+        """
+        Fold one reading of every array in
+
+        Args:
+            doa: (A,) DOA angles in degrees, negative or NaN for arrays without a reading
+            weights: (A,) confidence of each reading
+
+        Returns:
+            position estimate, None until the readings fix a point
+        """
+        w, directions, P, Pc = self._terms(doa, weights)
+        if not np.any(w):
+            return self.position
+
+        if self.position is not None:
+            # change-point test: the new rays against the current estimate
+            distance = self.localizer.distances(self.position, directions, P)
+            score = np.sum(w * np.minimum(distance, 1e3) ** 2) / (np.sum(w) * (self.noise + self.sigma_r ** 2))
+            self.changes = self.changes + 1 if score > self.change_threshold else 0
+            if self.changes >= self.patience:
+                self.reset()
+                self.resets += 1
+
+        lam = self.forgetting
+        self.M = lam * self.M + np.einsum('a,aij->ij', w, P)
+        self.b = lam * self.b + np.einsum('a,ai->i', w, Pc)
+        self.s = lam * self.s + float(np.einsum('a,ai,ai->', w, Pc, self.localizer.centers))
+        self.W = lam * self.W + float(np.sum(w))
+
+        D = self.localizer.dim
+        scale = np.trace(self.M) / D
+        if scale <= 0 or abs(np.linalg.det(self.M / scale)) < 1e-6:
+            return self.position
+
+        inverse = np.linalg.inv(self.M)
+        x = inverse @ self.b
+        # weighted sum of squared distances of every folded reading to x
+        sse = max(self.s - float(self.b @ x), 0.0)
+        self.variance = sse / max(self.W - D, 1.0)
+        if not self.changes:
+            # the change test keeps the noise level from before a suspected change
+            self.noise = self.variance
+        self.covariance = max(self.variance, self.sigma_r ** 2) * inverse
+        self.position = x
+        return x
+
+    @property
+    def std(self):
+        """
+        Per-axis standard deviation of the position
+        """
+        return None if self.covariance is None else np.sqrt(np.diag(self.covariance))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare RLS and per-sample solving on a synthetic DOA stream')
+    parser.add_argument('--arrays', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=50.0, help='readings per second')
+    parser.add_argument('--seconds', type=float, default=60.0)
+    parser.add_argument('--noise', type=float, default=3.0, help='DOA noise in degrees')
+    parser.add_argument('--forgetting', type=float, default=0.95)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random = np.random.default_rng(args.seed)
+    room = np.array([5.0, 5.0, 3.0])
+    centers, rotations = random_poses(args.arrays, room, random)
+    localizer = MultiArrayLocalizer(centers, rotations, iterations=0)
+
+    # a source hopping to a new place every 10 s and drifting slowly in between
+    n = int(args.seconds * args.rate)
+    t = np.arange(n) / args.rate
+    anchors = random.uniform(0.2, 0.8, (int(args.seconds // 10) + 1, 3)) * room
+    sources = anchors[(t // 10).astype(int)] + 0.05 * np.sin(2 * np.pi * 0.1 * t)[:, None]
+    doa = np.mod(ideal_doa(sources, centers, rotations) + random.normal(0, args.noise, (n, args.arrays)), 360)
+
+    start = time.time()
+    single, _, _ = localizer.locate(doa)
+    batch_time = time.time() - start
+
+    estimator = RLSPositionEstimator(localizer, forgetting=args.forgetting)
+    estimates = np.full((n, 3), np.nan)
+    stds = np.full((n, 3), np.nan)
+    start = time.time()
+    for i in range(n):
+        position = estimator.update(doa[i])
+        if position is not None:
+            estimates[i] = position
+            stds[i] = estimator.std
+    rls_time = time.time() - start
+
+    # skip the second after each hop, where both need to settle
+    settled = (t % 10) >= 1.0
+    single_error = np.linalg.norm(single - sources, axis=1)[settled]
+    rls_error = np.linalg.norm(estimates - sources, axis=1)[settled]
+    sys.stdout.write("per-sample solve: median error {:.3f}m, p95 {:.3f}m\n".format(
+        np.nanmedian(single_error), np.nanpercentile(single_error, 95)))
+    sys.stdout.write("RLS:              median error {:.3f}m, p95 {:.3f}m, median std {:.3f}m, {} resets for {} hops\n".format(
+        np.nanmedian(rls_error), np.nanpercentile(rls_error, 95), np.nanmedian(np.linalg.norm(stds, axis=1)),
+        estimator.resets, len(anchors) - 1))
+    sys.stdout.write("{:.1f} us per RLS update, {:.1f} us per sample batched solve\n".format(
+        rls_time / n * 1e6, batch_time / n * 1e6))
+
+
+if __name__ == '__main__':
+    main()
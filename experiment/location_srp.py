@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""
+Steered response power localization over a voxel grid of the room
+
+Instead of intersecting angles, every voxel of the room is scored by the sum
+over microphone pairs of the GCC-PHAT value at the lag the voxel implies
+(SRP-PHAT). The lags depend only on the geometry, so they are precomputed once
+per (microphones, room, resolution) as an (X, Y, Z, P) table of indices into
+the interpolated correlation, written to a cache directory and memory mapped by
+every process using it. The table is int16 unless the lag span needs int32: a
+5 x 5 x 3 m room at 5 cm with 10 pairs takes 12 MB.
+
+The search runs coarse to fine: the top level (every stride-th voxel) is
+scanned in full with each correlation max-spread over the lags a voxel's block
+covers, so a sharp PHAT peak cannot fall between coarse voxels. Only the blocks
+of the best few cells are searched at the next stride, down to the full
+resolution. The top-level scan is split in slabs over a process pool, whose
+workers map the table themselves, so only the correlations travel.
+
+    python location_srp.py --arrays 5 --frames 200 --workers 4
+"""
+import sys
+import os
+import time
+import hashlib
+import tempfile
+import argparse
+import multiprocessing
+
+import numpy as np
+
+# Add parent directory to sys.path
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, parent_dir)
+
+from location_n_arrays import random_poses
+from scene_generator import SceneGenerator
+
+
+CACHE_DIR = os.path.join(tempfile.gettempdir(), 'srp_tables')
+
+
+def voxel_centers(shape, resolution):
+    """
+    Per-axis voxel center coordinates of a grid
+    """
+    return [(np.arange(n) + 0.5) * resolution for n in shape]
+
+
+def build_table(path, mics, pairs, shape, resolution, rate, interp, speed_of_sound):
+    """
+    Write the (X, Y, Z, P) lag index table of every voxel and pair to path, one x slab at a time
+    """
+    max_lag = lag_range(mics, pairs, rate, interp, speed_of_sound)
+    dtype = lag_dtype(max_lag)
+    xs, ys, zs = voxel_centers(shape, resolution)
+    fd, tmp = tempfile.mkstemp(suffix='.npy', dir=os.path.dirname(path))
+    os.close(fd)
+    table = np.lib.format.open_memmap(tmp, mode='w+', dtype=dtype, shape=tuple(shape) + (len(pairs),))
+    grid = np.stack(np.meshgrid(ys, zs, indexing='ij'), axis=-1)
+    for i, x in enumerate(xs):
+        points = np.concatenate([np.full(grid.shape[:-1] + (1,), x), grid], axis=-1)
+        distance = np.linalg.norm(points[..., None, :] - mics, axis=-1)
+        lag = (distance[..., pairs[:, 1]] - distance[..., pairs[:, 0]]) / speed_of_sound * rate * interp
+        # |lag| <= max_lag by the triangle inequality, so every index fits dtype
+        table[i] = (np.rint(lag) + max_lag).astype(dtype)
+    table.flush()
+    del table
+    # write then rename, concurrent processes never see a partial table
+    os.replace(tmp, path)
+
+
+def lag_range(mics, pairs, rate, interp, speed_of_sound):
+    """
+    Largest interpolated lag of any pair
+    """
+    baselines = np.linalg.norm(mics[pairs[:, 1]] - mics[pairs[:, 0]], axis=1)
+    return int(np.ceil(np.max(baselines) / speed_of_sound * rate * interp)) + 1
+
+
+def lag_dtype(max_lag):
+    """
+    Smallest integer type holding lag indices in [0, 2 * max_lag]
+    """
+    for dtype in (np.int16, np.int32):
+        if 2 * max_lag <= np.iinfo(dtype).max:
+            return dtype
+    raise ValueError('lag span {} does not fit an int32 table'.format(2 * max_lag))
+
+
+def spread(gcc, half):
+    """
+    Max over lags within +-half, by doubling the window
+    """
+    if half <= 0:
+        return gcc
+    size = 2 * half + 1
+    padded = np.concatenate([np.full(gcc.shape[:-1] + (half,), -np.inf, dtype=gcc.dtype), gcc,
+                             np.full(gcc.shape[:-1] + (half,), -np.inf, dtype=gcc.dtype)], axis=-1)
+    out = padded
+    width = 1
+    while width * 2 <= size:
+        out = np.maximum(out[..., :-width], out[..., width:])
+        width *= 2
+    if width < size:
+        out = np.maximum(out[..., :out.shape[-1] - (size - width)], out[..., size - width:])
+    return out[..., :gcc.shape[-1]]
+
+
+_tables = {}
+_slabs = {}
+
+
+def _table(path):
+    table = _tables.get(path)
+    if table is None:
+        table = _tables[path] = np.load(path, mmap_mode='r')
+    return table
+
+
+def _scan(path, stride, start, stop, gcc, keep):
+    """
+    Top-level power of the x slab [start, stop) of the strided grid, returns the keep best cells of every frame
+
+    Module level, so a process pool can run it
+    """
+    key = (path, stride, start, stop)
+    slab = _slabs.get(key)
+    if slab is None:
+        # the top level is small enough to keep in memory once gathered from the map
+        offset = stride // 2
+        table = _table(path)[offset + start * stride:offset + stop * stride:stride, offset::stride, offset::stride]
+        slab = _slabs[key] = (table.shape[:3], np.ascontiguousarray(table).reshape(-1, table.shape[-1]).astype(np.intp))
+    shape, lags = slab
+
+    power = np.zeros((len(gcc), len(lags)), dtype=np.float32)
+    for p in range(lags.shape[1]):
+        power += gcc[:, p, lags[:, p]]
+
+    k = min(keep, power.shape[1])
+    best = np.argpartition(-power, k - 1, axis=1)[:, :k]
+    cells = np.stack(np.unravel_index(best, shape), axis=-1)
+    cells[..., 0] += start
+    return cells, np.take_along_axis(power, best, axis=1)
+
+
+class SRPLocalizer:
+    # load shedding steps of test/scheduler.py
+    quality_levels = ('full', 'fewer candidates', 'no fine refinement', 'coarse grid only')
+
+    def __init__(self, mics, arrays=None, room=(5.0, 5.0, 3.0), resolution=0.05, rate=16000, interp=4,
+                 strides=(8, 4, 2, 1), keep=16, workers=0, speed_of_sound=343.0, cache_dir=CACHE_DIR):
+        """
+        Args:
+            mics: (M, 3) microphone positions in the room
+            arrays: (M,) array of each microphone, only pairs across arrays are used; None for all pairs
+            room: room size in meters, the grid spans [0, room]
+            resolution: voxel edge in meters
+            rate: sample rate
+            interp: the correlations are interpolated this many times finer than a sample
+            strides: voxel strides of the search levels, from the coarse scan down to 1
+            keep: cells of a level whose blocks are searched at the next one
+            workers: processes scanning the top level, 0 to scan in this process
+            cache_dir: directory of the memory-mapped lag tables
+        """
+        self.mics = np.asarray(mics, dtype=float)
+        arrays = np.arange(len(self.mics)) if arrays is None else np.asarray(arrays)
+        i, j = np.triu_indices(len(self.mics), 1)
+        across = arrays[i] != arrays[j]
+        self.pairs = np.stack([i[across], j[across]], axis=1)
+        self.room = np.asarray(room, dtype=float)
+        self.resolution = resolution
+        self.shape = tuple(int(np.ceil(s / resolution)) for s in self.room)
+        self.rate = rate
+        self.interp = interp
+        self.strides = self.full_strides = tuple(strides)
+        self.keep = self.full_keep = keep
+        self.speed_of_sound = speed_of_sound
+        self.max_lag = lag_range(self.mics, self.pairs, rate, interp, speed_of_sound)
+
+        key = hashlib.sha1(np.ascontiguousarray(self.mics).tobytes() + self.pairs.tobytes() + repr(
+            (self.shape, resolution, rate, interp, speed_of_sound)).encode('utf-8')).hexdigest()
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.path = os.path.join(cache_dir, key + '.npy')
+        self.built = 0.0
+        if not os.path.exists(self.path):
+            start = time.time()
+            build_table(self.path, self.mics, self.pairs, self.shape, resolution, rate, interp, speed_of_sound)
+            self.built = time.time() - start
+        self.table = _table(self.path)
+
+        self.pool = multiprocessing.Pool(workers) if workers else None
+        self.workers = workers
+        # seconds from capture to result of the last located frames, read by LoadScheduler
+        self.lag = 0.0
+
+    def set_quality(self, level):
+        keep = self.full_keep if level < 1 else max(1, self.full_keep // 4)
+        strides = self.full_strides
+        if level >= 2:
+            strides = strides[:max(1, len(strides) - 1)]
+        if level >= 3:
+            strides = strides[:1]
+        self.strides, self.keep = strides, keep
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def correlations(self, frames):
+        """
+        Args:
+            frames: (F, M, n) samples of every microphone
+
+        Returns:
+            (F, P, 2 * max_lag + 1) interpolated GCC-PHAT of every pair, index max_lag is lag 0
+        """
+        frames = np.asarray(frames, dtype=np.float32)
+        n = frames.shape[-1]
+        nfft = 1 << int(np.ceil(np.log2(2 * n)))
+        spectra = np.fft.rfft(frames, nfft, axis=-1)
+        cross = spectra[:, self.pairs[:, 1]] * np.conj(spectra[:, self.pairs[:, 0]])
+        cross /= np.maximum(np.abs(cross), 1e-12)
+        # zero padding the spectrum interpolates the correlation
+        size = nfft * self.interp
+        cc = np.fft.irfft(cross, size, axis=-1) * self.interp
+        lags = np.arange(-self.max_lag, self.max_lag + 1) % size
+        return cc[..., lags].astype(np.float32)
+
+    def _half(self, stride):
+        """
+        Lags a block of stride voxels can span around its sampled voxel, in interpolated samples
+        """
+        if stride <= 1:
+            return 0
+        # a pair's lag changes at most twice as fast as the distance to a point
+        return int(np.ceil(2 * np.sqrt(3) * stride * self.resolution / 2 / self.speed_of_sound * self.rate * self.interp))
+
+    def _top(self, gcc):
+        stride = self.strides[0]
+        offset = stride // 2
+        width = len(range(offset, self.shape[0], stride))
+        gcc = spread(gcc, self._half(stride))
+        if self.pool is None:
+            cells, power = _scan(self.path, stride, 0, width, gcc, self.keep)
+        else:
+            bounds = np.linspace(0, width, min(self.workers, width) + 1).astype(int)
+            parts = self.pool.starmap(_scan, [(self.path, stride, a, b, gcc, self.keep)
+                                              for a, b in zip(bounds[:-1], bounds[1:])])
+            cells = np.concatenate([c for c, _ in parts], axis=1)
+            power = np.concatenate([p for _, p in parts], axis=1)
+            best = np.argsort(-power, axis=1)[:, :self.keep]
+            cells = np.take_along_axis(cells, best[..., None], axis=1)
+            power = np.take_along_axis(power, best, axis=1)
+        return offset + cells * stride, power
+
+    def _refine(self, gcc, voxels, parent, stride):
+        """
+        Best voxels at stride within the blocks of the parent stride around voxels (F, K, 3)
+        """
+        reach = -(-parent // stride)
+        steps = np.arange(-reach, reach + 1) * stride
+        offsets = np.stack(np.meshgrid(steps, steps, steps, indexing='ij'), axis=-1).reshape(-1, 3)
+        candidates = (voxels[:, :, None, :] + offsets).reshape(len(voxels), -1, 3)
+        candidates = np.clip(candidates, 0, np.array(self.shape) - 1)
+
+        lags = self.table[candidates[..., 0], candidates[..., 1], candidates[..., 2]].astype(np.intp)
+        g = spread(gcc, self._half(stride))
+        F, P = g.shape[:2]
+        power = g[np.arange(F)[:, None, None], np.arange(P), lags].sum(axis=-1)
+        k = self.keep if stride > 1 else 1
+        best = np.argsort(-power, axis=1)[:, :k]
+        return np.take_along_axis(candidates, best[..., None], axis=1), np.take_along_axis(power, best, axis=1)
+
+    def locate(self, frames, timestamp=None):
+        """
+        Args:
+            frames: (F, M, n) samples of every microphone
+            timestamp: capture time of the frames, e.g. Frame.timestamp, to measure lag
+
+        Returns:
+            positions: (F, 3) center of the best voxel
+            power: (F,) its steered response power, the number of pairs at most
+        """
+        gcc = self.correlations(frames)
+        voxels, power = self._top(gcc)
+        for parent, stride in zip(self.strides[:-1], self.strides[1:]):
+            voxels, power = self._refine(gcc, voxels, parent, stride)
+        best = np.argmax(power, axis=1)
+        voxel = voxels[np.arange(len(voxels)), best]
+        if timestamp is not None:
+            self.lag = time.time() - timestamp
+        return (voxel + 0.5) * self.resolution, power[np.arange(len(voxels)), best]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark SRP-PHAT voxel search on synthetic scenes')
+    parser.add_argument('--arrays', type=int, default=5)
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--frame-size', type=int, default=1024)
+    parser.add_argument('--batch', type=int, default=8, help='frames located together')
+    parser.add_argument('--resolution', type=float, default=0.05)
+    parser.add_argument('--strides', default='8,4,2,1', help='voxel stride of every search level')
+    parser.add_argument('--keep', type=int, default=16, help='cells of a level searched at the next one')
+    parser.add_argument('--workers', type=int, default=0, help='processes scanning the top level')
+    parser.add_argument('--all-mics', action='store_true', help='use the 4 microphones of every array')
+    parser.add_argument('--snr', type=float, default=10.0)
+    parser.add_argument('--rt60', type=float, default=0.3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random = np.random.default_rng(args.seed)
+    room = np.array([5.0, 5.0, 3.0])
+    centers, rotations = random_poses(args.arrays, room, random)
+    scenes = SceneGenerator(room, duration=args.frame_size / 16000.0, snr_db=args.snr, rt60=args.rt60,
+                            centers=centers, rotations=rotations, seed=args.seed)
+
+    mics = slice(None) if args.all_mics else slice(0, 1)
+    positions = scenes.mics[:, mics].reshape(-1, 3)
+    arrays = np.repeat(np.arange(args.arrays), scenes.mics[:, mics].shape[1])
+    channels = scenes.geometry.channels[mics]
+
+    localizer = SRPLocalizer(positions, arrays, room, args.resolution, scenes.rate,
+                             strides=[int(s) for s in args.strides.split(',')], keep=args.keep, workers=args.workers,
+                             speed_of_sound=scenes.speed_of_sound)
+    table = localizer.table
+    sys.stdout.write('{} voxels x {} pairs, table {:.1f} MB{}\n'.format(
+        int(np.prod(localizer.shape)), len(localizer.pairs), table.nbytes / 1e6,
+        ', built in {:.1f}s'.format(localizer.built) if localizer.built else ', mapped from cache'))
+
+    errors = []
+    elapsed = 0.0
+    for sources, audio, _ in scenes.generate(args.frames, args.batch):
+        frames = np.swapaxes(audio[..., channels], 2, 3).reshape(len(sources), -1, args.frame_size)
+        start = time.time()
+        found, _ = localizer.locate(frames)
+        elapsed += time.time() - start
+        errors.append(np.linalg.norm(found - sources, axis=1))
+    localizer.close()
+
+    errors = np.concatenate(errors)
+    budget = args.frame_size / float(scenes.rate)
+    per_frame = elapsed / args.frames
+    sys.stdout.write('strides {}, {} workers: {:.1f} ms per frame ({:.0%} of the {:.0f} ms frame)\n'.format(
+        args.strides, args.workers, per_frame * 1000, per_frame / budget, budget * 1000))
+    sys.stdout.write('median error {:.3f}m, p90 {:.3f}m, {:.1%} within 10cm\n'.format(
+        np.median(errors), np.percentile(errors, 90), np.mean(errors < 0.1)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Multilateration on time differences of arrival between arrays
+
+The DOA-ray localizers only see the integer DOAANGLE of every array, so their
+accuracy is bound by the 1 degree resolution times the distance to the source.
+With synchronized raw streams (one microphone of each array, aligned with
+clock_sync.py) the time difference of arrival between arrays is measured
+directly and every one of them puts the source on a hyperboloid:
+
+    |x - p_i| - |x - p_0| = c * tdoa_i
+
+The engine cuts the streams into frames, measures the delay of every array
+behind the reference array with GCC-PHAT (all frames and arrays in one FFT
+batch) and solves the hyperboloids in closed form with spherical intersection:
+with r the distance to the reference, x - p_0 = a - r b is linear in r and
+|x - p_0| = r leaves a quadratic in r. The root fitting the delays best is
+refined with a few Gauss-Newton steps on the weighted TDOA residuals, still
+batched over frames. 3D positions need 4 arrays not on one plane; with exactly
+4 both roots fit the delays and the room bounds only break some of the ties, so
+use 5 or more.
+
+    python location_tdoa.py --arrays 5 --frames 2000 --snr 20 --rt60 0.3
+"""
+import sys
+import os
+import time
+import argparse
+
+import numpy as np
+
+# Add parent directory to sys.path
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, parent_dir)
+
+from clock_sync import cross_correlate
+from location_n_arrays import MultiArrayLocalizer, random_poses
+from scene_generator import SceneGenerator
+
+
+class TDOALocalizer:
+    def __init__(self, positions, speed_of_sound=343.0, refine=3, room=None, margin=0.5):
+        """
+        Args:
+            positions: (A, D) positions of the microphone each array contributes, array 0 is the reference
+            speed_of_sound: meters per second
+            refine: Gauss-Newton steps after the closed form
+            room: (D,) room size; with A = D + 1 both roots fit exactly and the one inside
+                  [-margin, room + margin] is taken
+        """
+        self.positions = np.asarray(positions, dtype=float)
+        self.arrays, self.dim = self.positions.shape
+        if self.arrays < self.dim + 1:
+            raise ValueError('{} arrays cannot fix a {}D position from time differences'.format(self.arrays, self.dim))
+        self.speed_of_sound = speed_of_sound
+        self.refine = refine
+        self.room = None if room is None else np.asarray(room, dtype=float)
+        self.margin = margin
+
+        # (A-1, D) baselines to the reference and half their squared lengths
+        self.S = self.positions[1:] - self.positions[0]
+        self.half = 0.5 * np.sum(self.S ** 2, axis=1)
+
+    @property
+    def max_delay(self):
+        """
+        Largest possible delay behind the reference in seconds
+        """
+        return np.max(np.linalg.norm(self.S, axis=1)) / self.speed_of_sound
+
+    def residuals(self, x, distances):
+        """
+        (F, A-1) range differences of x minus the measured ones
+        """
+        ranges = np.linalg.norm(x[:, None, :] - self.positions[None], axis=-1)
+        return ranges[:, 1:] - ranges[:, :1] - distances
+
+    def solve(self, tdoa, weights=None):
+        """
+        Args:
+            tdoa: (F, A-1) delay of every array behind the reference in seconds, NaN when missing
+            weights: (F, A-1) confidence of each delay
+
+        Returns:
+            positions: (F, D), NaN for frames without enough delays
+            residual: (F,) weighted RMS range-difference residual in meters
+        """
+        tdoa = np.atleast_2d(np.asarray(tdoa, dtype=float))
+        F, D = len(tdoa), self.dim
+        valid = np.isfinite(tdoa)
+        w = np.where(valid, 1.0 if weights is None else np.asarray(weights, dtype=float), 0.0)
+        d = np.where(valid, tdoa, 0.0) * self.speed_of_sound
+
+        # S y = z - r d with y = x - p_0, weighted least squares for y = a - r b
+        SW = self.S[None] * w[..., None]
+        M = np.einsum('fni,nj->fij', SW, self.S)
+        enough = (np.count_nonzero(w, axis=1) >= D) & (np.abs(np.linalg.det(M)) > 1e-9)
+        M[~enough] = np.eye(D)
+        a = np.linalg.solve(M, np.einsum('fni,fn->fi', SW, self.half[None] - 0.5 * d ** 2)[..., None])[..., 0]
+        b = np.linalg.solve(M, np.einsum('fni,fn->fi', SW, d)[..., None])[..., 0]
+
+        # |a - r b| = r
+        c2 = np.sum(b * b, axis=1) - 1.0
+        c1 = -2.0 * np.sum(a * b, axis=1)
+        c0 = np.sum(a * a, axis=1)
+        linear = np.abs(c2) < 1e-9
+        root = np.sqrt(np.maximum(c1 ** 2 - 4 * c2 * c0, 0.0))
+        c2 = np.where(linear, 1.0, c2)
+        r = np.stack([(-c1 + root) / (2 * c2), (-c1 - root) / (2 * c2)], axis=1)
+        r[linear] = (-c0 / np.where(c1 == 0, 1.0, c1))[linear, None]
+        r = np.maximum(r, 0.0)
+
+        # the root whose point explains the delays best
+        candidates = self.positions[0] + a[:, None, :] - r[..., None] * b[:, None, :]
+        error = np.stack([np.sum(w * self.residuals(candidates[:, k], d) ** 2, axis=1) for k in range(2)], axis=1)
+        if self.room is not None:
+            outside = np.any((candidates < -self.margin) | (candidates > self.room + self.margin), axis=-1)
+            error += np.where(outside, np.inf, 0.0)
+            error[np.all(outside, axis=1)] = 0.0
+        x = candidates[np.arange(F), np.argmin(error, axis=1)]
+
+        for _ in range(self.refine):
+            rel = x[:, None, :] - self.positions[None]
+            u = rel / np.maximum(np.linalg.norm(rel, axis=-1, keepdims=True), 1e-9)
+            J = u[:, 1:] - u[:, :1]
+            e = self.residuals(x, d)
+            JW = J * w[..., None]
+            H = np.einsum('fni,fnj->fij', JW, J) + 1e-9 * np.eye(D)
+            x = x - np.linalg.solve(H, np.einsum('fni,fn->fi', JW, e)[..., None])[..., 0]
+
+        residual = np.sqrt(np.sum(w * self.residuals(x, d) ** 2, axis=1) / np.maximum(np.sum(w, axis=1), 1e-12))
+        x[~enough] = np.nan
+        residual[~enough] = np.nan
+        return x, residual
+
+
+class TDOAEngine:
+    # load shedding steps of test/scheduler.py
+    quality_levels = ('full rate', 'half rate', 'quarter rate')
+
+    def __init__(self, localizer, rate=16000, frame_size=2048, hop_size=1024, min_peak=0.05, margin=2):
+        """
+        Streaming GCC-PHAT and multilateration on synchronized array streams
+
+        Args:
+            localizer: TDOALocalizer with the microphone positions
+            rate: sample rate of the streams
+            frame_size: samples correlated per position
+            hop_size: samples between positions
+            min_peak: delays with a weaker PHAT peak are dropped
+            margin: samples searched beyond the largest possible delay
+        """
+        self.localizer = localizer
+        self.rate = rate
+        self.frame_size = frame_size
+        self.hop_size = self.full_hop = hop_size
+        self.min_peak = min_peak
+        self.max_lag = int(np.ceil(localizer.max_delay * rate)) + margin
+        self.buffer = np.zeros((0, localizer.arrays), dtype=np.float32)
+        self.frames = 0
+        # seconds from capture to result of the last located frames, read by LoadScheduler
+        self.lag = 0.0
+
+    def set_quality(self, level):
+        # a larger hop, fewer positions per second
+        self.hop_size = self.full_hop << level
+
+    def delays(self, frames):
+        """
+        Args:
+            frames: (F, A, frame_size) synchronized samples of every array
+
+        Returns:
+            tdoa: (F, A-1) delay behind the reference in seconds, NaN below min_peak
+            peak: (F, A-1) PHAT peak
+        """
+        frames = np.asarray(frames, dtype=np.float32)
+        ref = np.broadcast_to(frames[:, :1], frames[:, 1:].shape)
+        lag, peak = cross_correlate(ref, frames[:, 1:], self.max_lag, phat=True)
+        return np.where(peak >= self.min_peak, lag / float(self.rate), np.nan), peak
+
+    def locate(self, frames, timestamp=None):
+        """
+        (F, D) positions, (F,) residuals and (F, A-1) PHAT peaks of a batch of frames
+
+        timestamp is the capture time of the frames, e.g. Frame.timestamp, to measure lag.
+        """
+        tdoa, peak = self.delays(frames)
+        positions, residual = self.localizer.solve(tdoa, peak)
+        if timestamp is not None:
+            self.lag = time.time() - timestamp
+        return positions, residual, peak
+
+    def feed(self, samples, timestamp=None):
+        """
+        Append (n, A) synchronized samples, returns the results of the frames they complete
+        """
+        self.buffer = np.concatenate([self.buffer, np.asarray(samples, dtype=np.float32)])
+        count = (len(self.buffer) - self.frame_size) // self.hop_size + 1
+        if count <= 0:
+            return None
+
+        index = np.arange(count)[:, None] * self.hop_size + np.arange(self.frame_size)
+        frames = np.transpose(self.buffer[index], (0, 2, 1))
+        self.buffer = self.buffer[count * self.hop_size:]
+        self.frames += count
+        return self.locate(frames, timestamp)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare TDOA multilateration with DOA-ray localization on synthetic scenes')
+    parser.add_argument('--arrays', type=int, default=5)
+    parser.add_argument('--frames', type=int, default=2000)
+    parser.add_argument('--frame-size', type=int, default=2048)
+    parser.add_argument('--snr', type=float, default=20.0, help='SNR in dB')
+    parser.add_argument('--rt60', type=float, default=None, help='reverberation time in seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random = np.random.default_rng(args.seed)
+    room = np.array([5.0, 5.0, 3.0])
+    centers, rotations = random_poses(args.arrays, room, random)
+    scenes = SceneGenerator(room, duration=args.frame_size / 16000.0, snr_db=args.snr, rt60=args.rt60,
+                            centers=centers, rotations=rotations, seed=args.seed)
+
+    # the first microphone of every array takes part in the multilateration
+    channel = scenes.geometry.channels[0]
+    localizer = TDOALocalizer(scenes.mics[:, 0], scenes.speed_of_sound, room=room)
+    engine = TDOAEngine(localizer, scenes.rate, args.frame_size)
+    rays = MultiArrayLocalizer(centers, rotations, iterations=0)
+
+    sources, tdoa_positions, ray_positions = [], [], []
+    tdoa_time = ray_time = 0.0
+    for batch, audio, doa in scenes.generate(args.frames):
+        frames = audio[..., channel].astype(np.float32)
+
+        start = time.time()
+        positions, _, _ = engine.locate(frames)
+        tdoa_time += time.time() - start
+        tdoa_positions.append(positions)
+
+        start = time.time()
+        positions, _, _ = rays.locate(doa)
+        ray_time += time.time() - start
+        ray_positions.append(positions)
+        sources.append(batch)
+
+    sources = np.concatenate(sources)
+    sys.stdout.write('{} arrays, {} frames of {} samples, SNR {} dB, RT60 {}\n'.format(
+        args.arrays, args.frames, args.frame_size, args.snr, args.rt60))
+    sys.stdout.write('{:>10} {:>12} {:>10} {:>10} {:>8} {:>8}\n'.format(
+        'method', 'frames/s', 'median', 'p90', '<10cm', 'solved'))
+    for name, positions, elapsed in (('TDOA', tdoa_positions, tdoa_time), ('DOA rays', ray_positions, ray_time)):
+        error = np.linalg.norm(np.concatenate(positions) - sources, axis=1)
+        found = np.isfinite(error)
+        sys.stdout.write('{:>10} {:>12.0f} {:>9.3f}m {:>9.3f}m {:>8.1%} {:>8.1%}\n'.format(
+            name, args.frames / elapsed, np.median(error[found]), np.percentile(error[found], 90),
+            np.mean(error[found] < 0.1), np.mean(found)))
+
+
+if __name__ == '__main__':
+    main()
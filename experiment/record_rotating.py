@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+Continuous 6 channels capture to rotating segment files
+
+Unlike record.py, nothing is held in RAM: the PyAudio callback hands each block
+to a bounded queue, a background thread writes it to the current WAV segment
+and starts a new one after --segment-seconds or --segment-mb. Finished segments
+can be compressed to FLAC by a worker pool. Each segment is appended to
+index.jsonl with its start time, so read_range() can pull any time range back
+without scanning the recordings.
+
+    python record_rotating.py --dir recordings --segment-seconds 600 --flac
+"""
+import os
+import sys
+import json
+import time
+import wave
+import shutil
+import argparse
+import threading
+import subprocess
+import concurrent.futures
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+import pyaudio
+
+from get_index import get_mic_index
+
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+RESPEAKER_RATE = 16000
+RESPEAKER_CHANNELS = 6
+RESPEAKER_WIDTH = 2
+CHUNK = 1024
+
+INDEX = 'index.jsonl'
+
+
+def compress_segment(path):
+    """
+    Convert a WAV segment to FLAC next to it and remove the WAV, returns the new path
+    """
+    target = os.path.splitext(path)[0] + '.flac'
+    if soundfile is not None:
+        data, rate = soundfile.read(path, dtype='int16')
+        soundfile.write(target, data, rate, subtype='PCM_16')
+    else:
+        subprocess.check_call(['flac', '--silent', '--force', '-o', target, path])
+    os.remove(path)
+    return target
+
+
+def can_compress():
+    return soundfile is not None or shutil.which('flac') is not None
+
+
+class SegmentWriter:
+    def __init__(self, directory, rate=RESPEAKER_RATE, channels=RESPEAKER_CHANNELS, width=RESPEAKER_WIDTH,
+                 segment_seconds=600, segment_bytes=None, compress=False, workers=2, max_blocks=256):
+        """
+        Args:
+            directory: where segments and index.jsonl go
+            segment_seconds: start a new segment after this many seconds of audio
+            segment_bytes: or after this many bytes, whichever comes first
+            compress: compress finished segments to FLAC in a worker pool
+            workers: compression processes
+            max_blocks: capacity of the queue between the audio callback and the writer
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.directory = directory
+        self.rate = rate
+        self.channels = channels
+        self.width = width
+        self.max_frames = int(segment_seconds * rate) if segment_seconds else None
+        if segment_bytes:
+            frames = int(segment_bytes // (channels * width))
+            self.max_frames = min(self.max_frames, frames) if self.max_frames else frames
+
+        self.queue = queue.Queue(maxsize=max_blocks)
+        self.overruns = 0
+        self.dropped = 0
+        # frames handed to put, dropped ones included: the position of the next block
+        self.captured = 0
+        self.pool = None
+        if compress:
+            if can_compress():
+                self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+            else:
+                print("Warning: neither soundfile nor the flac tool is available, segments stay WAV")
+
+        self.segment = None
+        self.segment_path = None
+        self.segment_start = None
+        self.segment_frames = 0
+        self.start_time = None
+        self.frames = 0
+        self.thread = None
+        self.pending = []
+
+    def put(self, data):
+        """
+        Queue a block of interleaved frames without blocking the audio thread
+        """
+        position = self.captured
+        frames = len(data) // (self.channels * self.width)
+        self.captured += frames
+        try:
+            self.queue.put_nowait((position, data))
+        except queue.Full:
+            self.overruns += 1
+            self.dropped += frames
+
+    def start(self, start_time=None):
+        self.start_time = time.time() if start_time is None else start_time
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.pool is not None:
+            concurrent.futures.wait(self.pending)
+            self.pool.shutdown()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            position, data = item
+            self.write(data, position)
+        self._close_segment()
+
+    def write(self, data, position=None):
+        """
+        Append a block, position is its first frame counted from the start, if known
+        """
+        if position is not None and position != self.frames:
+            # blocks were dropped: end the segment at the gap, the next one starts after it
+            self._close_segment()
+            self.frames = position
+
+        frame_size = self.channels * self.width
+        while data:
+            if self.segment is None:
+                self._open_segment()
+
+            room = len(data) // frame_size
+            if self.max_frames:
+                room = min(room, self.max_frames - self.segment_frames)
+            self.segment.writeframesraw(data[:room * frame_size])
+            data = data[room * frame_size:]
+            self.segment_frames += room
+            self.frames += room
+
+            if self.max_frames and self.segment_frames >= self.max_frames:
+                self._close_segment()
+
+    def _open_segment(self):
+        # segment times follow the sample count, dropped blocks included, so they never drift from the audio
+        self.segment_start = self.start_time + self.frames / float(self.rate)
+        name = time.strftime('%Y%m%d-%H%M%S', time.localtime(self.segment_start))
+        name = '{}.{:03d}.wav'.format(name, int(self.segment_start * 1000) % 1000)
+        self.segment_path = os.path.join(self.directory, name)
+        self.segment = wave.open(self.segment_path, 'wb')
+        self.segment.setnchannels(self.channels)
+        self.segment.setsampwidth(self.width)
+        self.segment.setframerate(self.rate)
+        self.segment_frames = 0
+
+    def _close_segment(self):
+        if self.segment is None:
+            return
+
+        self.segment.close()
+        entry = {'path': os.path.basename(self.segment_path), 'start': self.segment_start,
+                 'frames': self.segment_frames, 'rate': self.rate, 'channels': self.channels}
+        with open(os.path.join(self.directory, INDEX), 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+        if self.pool is not None:
+            self.pending = [p for p in self.pending if not p.done()]
+            self.pending.append(self.pool.submit(compress_segment, self.segment_path))
+
+        self.segment = None
+
+
+def _resolve(directory, name):
+    path = os.path.join(directory, name)
+    if not os.path.exists(path):
+        # compressed after the index entry was written
+        flac = os.path.splitext(path)[0] + '.flac'
+        if os.path.exists(flac):
+            return flac
+    return path
+
+
+def _read_frames(path, start, count, channels):
+    if path.endswith('.flac'):
+        if soundfile is None:
+            raise RuntimeError('soundfile is needed to read {}'.format(path))
+        data, _ = soundfile.read(path, start=start, frames=count, dtype='int16', always_2d=True)
+        return data
+
+    wf = wave.open(path, 'rb')
+    try:
+        wf.setpos(start)
+        data = wf.readframes(count)
+    finally:
+        wf.close()
+    return np.frombuffer(data, dtype='int16').reshape(-1, channels)
+
+
+def read_range(directory, start, stop):
+    """
+    Audio between two timestamps as a (frames, channels) int16 array
+
+    Only the segments overlapping [start, stop) are opened, and only the needed
+    frames are read from them.
+    """
+    with open(os.path.join(directory, INDEX)) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+
+    blocks = []
+    for entry in sorted(entries, key=lambda e: e['start']):
+        rate = entry['rate']
+        end = entry['start'] + entry['frames'] / float(rate)
+        if end <= start or entry['start'] >= stop:
+            continue
+
+        first = max(0, int(round((start - entry['start']) * rate)))
+        last = min(entry['frames'], int(round((stop - entry['start']) * rate)))
+        blocks.append(_read_frames(_resolve(directory, entry['path']), first, last - first, entry['channels']))
+
+    if not blocks:
+        return np.zeros((0, RESPEAKER_CHANNELS), dtype='int16')
+    return np.concatenate(blocks)
+
+
+class RotatingRecorder:
+    def __init__(self, device_index, directory, rate=RESPEAKER_RATE, channels=RESPEAKER_CHANNELS,
+                 pyaudio_instance=None, **kwargs):
+        self.pyaudio_instance = pyaudio_instance if pyaudio_instance else pyaudio.PyAudio()
+        self.writer = SegmentWriter(directory, rate=rate, channels=channels, **kwargs)
+        self.stream = self.pyaudio_instance.open(
+            start=False,
+            rate=rate,
+            format=self.pyaudio_instance.get_format_from_width(RESPEAKER_WIDTH),
+            channels=channels,
+            input=True,
+            input_device_index=device_index,
+            frames_per_buffer=CHUNK,
+            stream_callback=self._callback)
+
+    def _callback(self, in_data, frame_count, time_info, status):
+        self.writer.put(in_data)
+        return None, pyaudio.paContinue
+
+    def start(self, start_time=None):
+        self.writer.start(start_time)
+        self.stream.start_stream()
+
+    def stop(self):
+        self.stream.stop_stream()
+        self.stream.close()
+        self.writer.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record ReSpeaker arrays continuously into rotating segments')
+    parser.add_argument('--device', type=int, action='append', help='input device index, repeat for several arrays')
+    parser.add_argument('--dir', default='recordings', help='output directory, one sub-directory per array')
+    parser.add_argument('--rate', type=int, default=RESPEAKER_RATE)
+    parser.add_argument('--channels', type=int, default=RESPEAKER_CHANNELS)
+    parser.add_argument('--segment-seconds', type=float, default=600)
+    parser.add_argument('--segment-mb', type=float, default=None)
+    parser.add_argument('--flac', action='store_true', help='compress finished segments to FLAC')
+    parser.add_argument('--workers', type=int, default=2)
+    args = parser.parse_args()
+
+    devices = args.device
+    if not devices:
+        devices = [int(device['index']) for device in get_mic_index()]
+    if not devices:
+        print("\033[91mNo microphone array found.\033[0m")
+        sys.exit(1)
+
+    p = pyaudio.PyAudio()
+    recorders = []
+    start_time = time.time()
+    for i, index in enumerate(devices):
+        recorder = RotatingRecorder(
+            index, os.path.join(args.dir, 'array{}'.format(i + 1)), rate=args.rate, channels=args.channels,
+            pyaudio_instance=p, segment_seconds=args.segment_seconds,
+            segment_bytes=args.segment_mb * 1e6 if args.segment_mb else None,
+            compress=args.flac, workers=args.workers)
+        recorders.append(recorder)
+
+    for recorder in recorders:
+        recorder.start(start_time)
+
+    print("* recording {} arrays, Ctrl+C to stop".format(len(recorders)))
+    while True:
+        try:
+            time.sleep(1)
+        except KeyboardInterrupt:
+            break
+
+    for recorder in recorders:
+        recorder.stop()
+        if recorder.writer.overruns:
+            print("{}: {} blocks dropped ({:.1f}s)".format(
+                recorder.writer.directory, recorder.writer.overruns, recorder.writer.dropped / float(args.rate)))
+
+    p.terminate()
+    print("* done recording")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""
+Event-triggered recording with a pre-roll buffer
+
+The last --pre-roll seconds of audio are kept in a preallocated ring buffer.
+When a trigger fires (firmware VOICEACTIVITY, an RMS threshold on the raw mics
+or a keyword from KWS) a clip is started with the pre-roll attached, extended
+while triggers keep firing, and closed --post-roll seconds after the last one.
+Each clip is saved as a WAV file with a JSON sidecar holding the trigger, its
+time, the keywords spotted during the clip and the DOA at that moment. The DOA
+comes from the TuningWatcher, the only thread talking to the device.
+
+    python record_triggered.py --rms 800 --vad --dir clips
+"""
+import os
+import sys
+import json
+import time
+import wave
+import argparse
+import threading
+import collections
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+import pyaudio
+
+# Add parent directory to sys.path
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, parent_dir)
+
+from tuning import find
+from watch import TuningWatcher
+from get_index import get_mic_index
+
+RESPEAKER_RATE = 16000
+RESPEAKER_CHANNELS = 6
+RESPEAKER_WIDTH = 2
+CHUNK = 1024
+
+
+class RingBuffer:
+    def __init__(self, frames, channels):
+        self.data = np.zeros((frames, channels), dtype='int16')
+        self.position = 0
+        self.filled = 0
+
+    def write(self, block):
+        capacity = len(self.data)
+        block = block[-capacity:]
+        n = len(block)
+        end = self.position + n
+        if end <= capacity:
+            self.data[self.position:end] = block
+        else:
+            split = capacity - self.position
+            self.data[self.position:] = block[:split]
+            self.data[:n - split] = block[split:]
+        self.position = end % capacity
+        self.filled = min(capacity, self.filled + n)
+
+    def clear(self):
+        self.position = 0
+        self.filled = 0
+
+    def read(self):
+        """
+        Buffered frames, oldest first
+        """
+        if self.filled < len(self.data):
+            return self.data[:self.filled].copy()
+        return np.concatenate([self.data[self.position:], self.data[:self.position]])
+
+
+class RMSTrigger:
+    name = 'rms'
+
+    def __init__(self, threshold, channels=(1, 2, 3, 4)):
+        self.threshold = threshold
+        self.channels = list(channels)
+
+    def check(self, block):
+        mono = block[:, self.channels].astype('float32')
+        return np.sqrt(np.mean(mono * mono)) >= self.threshold
+
+
+class VoiceActivityTrigger:
+    """
+    Fires while the firmware flags voice activity, VOICEACTIVITY is polled by a TuningWatcher
+    """
+    name = 'vad'
+
+    def __init__(self, watcher, parameter='VOICEACTIVITY', period=0.02):
+        self.watcher = watcher
+        self.parameter = parameter
+        watcher.watch(parameter, period)
+
+    def check(self, block):
+        return bool(self.watcher.value(self.parameter))
+
+
+class KeywordTrigger:
+    """
+    Feeds one channel to a KWS element and fires on detected keywords, those since the last check kept in detected
+    """
+    name = 'kws'
+
+    def __init__(self, kws, channel=0):
+        self.kws = kws
+        self.channel = channel
+        # appended on the KWS thread, drained here
+        self.keywords = collections.deque()
+        self.detected = []
+        kws.set_callback(self._on_detected)
+
+    def _on_detected(self, keyword):
+        self.keywords.append(keyword)
+
+    def check(self, block):
+        self.kws.put(np.ascontiguousarray(block[:, self.channel]).tobytes())
+        self.detected = []
+        while self.keywords:
+            self.detected.append(self.keywords.popleft())
+        return bool(self.detected)
+
+
+class TriggeredRecorder:
+    def __init__(self, directory, triggers, rate=RESPEAKER_RATE, channels=RESPEAKER_CHANNELS,
+                 pre_roll=2.0, post_roll=2.0, max_seconds=60.0, watcher=None, doa_period=0.05):
+        """
+        Args:
+            directory: where clips and their .json metadata go
+            triggers: list of triggers, each with a name and check(block) -> bool
+            pre_roll: seconds of audio kept before a trigger
+            post_roll: seconds recorded after the last trigger
+            max_seconds: longest clip, a new one is started past it
+            watcher: TuningWatcher of the array, DOAANGLE is polled through it for the metadata
+            doa_period: DOAANGLE polling period in seconds
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.directory = directory
+        self.triggers = triggers
+        self.rate = rate
+        self.channels = channels
+        self.post_roll = int(post_roll * rate)
+        self.max_frames = int(max_seconds * rate)
+        self.watcher = watcher
+        if watcher is not None:
+            watcher.watch('DOAANGLE', doa_period)
+        self.ring = RingBuffer(int(pre_roll * rate), channels)
+
+        self.clip = None
+        self.clip_frames = 0
+        self.quiet_frames = 0
+        self.metadata = None
+        self.frames = 0
+        self.start_time = None
+        self.clips = 0
+
+        self.queue = queue.Queue()
+        self.writer = queue.Queue()
+        self.threads = []
+        self.done = True
+
+    def put(self, data):
+        self.queue.put(data)
+
+    def start(self):
+        self.done = False
+        self.start_time = time.time()
+        self.threads = []
+        for target in (self.run, self.write_clips):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """
+        Close the current clip and wait until every clip is written
+        """
+        self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.done = True
+
+    def run(self):
+        while not self.done:
+            data = self.queue.get()
+            if data is None:
+                break
+            self.process(np.frombuffer(data, dtype='int16').reshape(-1, self.channels))
+
+        self._finish()
+        self.writer.put(None)
+
+    def process(self, block):
+        fired = [t for t in self.triggers if t.check(block)]
+        keywords = [keyword for t in fired for keyword in getattr(t, 'detected', ())]
+        fired = [t.name for t in fired]
+        now = self.start_time + self.frames / float(self.rate)
+
+        if fired and self.clip is None:
+            pre = self.ring.read()
+            self.clip = [pre]
+            self.clip_frames = len(pre)
+            self.metadata = {
+                'trigger': fired,
+                'trigger_time': now,
+                'start': now - len(pre) / float(self.rate),
+                'pre_roll': len(pre) / float(self.rate),
+                'keywords': [],
+                'doa': self.watcher.value('DOAANGLE') if self.watcher is not None else None,
+                'rate': self.rate,
+                'channels': self.channels,
+            }
+
+        if self.clip is not None:
+            self.metadata['keywords'].extend(keywords)
+            self.clip.append(block.copy())
+            self.clip_frames += len(block)
+            self.quiet_frames = 0 if fired else self.quiet_frames + len(block)
+            if self.quiet_frames >= self.post_roll or self.clip_frames >= self.max_frames:
+                self._finish()
+                # already saved, the pre-roll of the next clip starts after it
+                self.ring.clear()
+                self.frames += len(block)
+                return
+
+        self.ring.write(block)
+        self.frames += len(block)
+
+    def _finish(self):
+        if self.clip is None:
+            return
+
+        self.metadata['frames'] = self.clip_frames
+        self.writer.put((self.clip, self.metadata))
+        self.clip = None
+        self.clips += 1
+
+    def write_clips(self):
+        while True:
+            item = self.writer.get()
+            if item is None:
+                break
+
+            blocks, metadata = item
+            name = time.strftime('%Y%m%d-%H%M%S', time.localtime(metadata['trigger_time']))
+            name = '{}.{:03d}'.format(name, int(metadata['trigger_time'] * 1000) % 1000)
+            wf = wave.open(os.path.join(self.directory, name + '.wav'), 'wb')
+            wf.setnchannels(self.channels)
+            wf.setsampwidth(RESPEAKER_WIDTH)
+            wf.setframerate(self.rate)
+            for block in blocks:
+                wf.writeframes(block.tobytes())
+            wf.close()
+
+            with open(os.path.join(self.directory, name + '.json'), 'w') as f:
+                json.dump(metadata, f, indent=2)
+
+            sys.stdout.write("saved {}.wav: {:.1f}s, trigger {}{}, DOA {}\n".format(
+                name, metadata['frames'] / float(self.rate), ','.join(metadata['trigger']),
+                ' ({})'.format(', '.join(metadata['keywords'])) if metadata['keywords'] else '', metadata['doa']))
+            sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record clips around sound events with a pre-roll')
+    parser.add_argument('--device', type=int, default=None, help='input device index')
+    parser.add_argument('--dir', default='clips')
+    parser.add_argument('--pre-roll', type=float, default=2.0, help='seconds kept before a trigger')
+    parser.add_argument('--post-roll', type=float, default=2.0, help='seconds recorded after the last trigger')
+    parser.add_argument('--rms', type=float, default=None, help='RMS threshold of the raw mics')
+    parser.add_argument('--vad', action='store_true', help='trigger on firmware VOICEACTIVITY')
+    parser.add_argument('--kws', action='store_true', help='trigger on keywords (pocketsphinx)')
+    args = parser.parse_args()
+
+    device = args.device
+    if device is None:
+        mics = get_mic_index()
+        if not mics:
+            print("\033[91mNo microphone array found.\033[0m")
+            sys.exit(1)
+        device = int(mics[0]['index'])
+
+    dev = find()
+    watcher = TuningWatcher(dev) if dev else None
+
+    triggers = []
+    if args.rms is not None:
+        triggers.append(RMSTrigger(args.rms))
+    if args.vad:
+        if watcher is None:
+            print("No device found for --vad")
+            sys.exit(1)
+        triggers.append(VoiceActivityTrigger(watcher))
+    if args.kws:
+        sys.path.insert(0, os.path.join(parent_dir, 'test'))
+        from kws import KWS
+
+        kws = KWS()
+        kws.start()
+        triggers.append(KeywordTrigger(kws))
+    if not triggers:
+        parser.error('select at least one of --rms, --vad or --kws')
+
+    recorder = TriggeredRecorder(args.dir, triggers, pre_roll=args.pre_roll, post_roll=args.post_roll,
+                                 watcher=watcher)
+
+    p = pyaudio.PyAudio()
+
+    def callback(in_data, frame_count, time_info, status):
+        recorder.put(in_data)
+        return None, pyaudio.paContinue
+
+    stream = p.open(
+        start=False,
+        rate=RESPEAKER_RATE,
+        format=p.get_format_from_width(RESPEAKER_WIDTH),
+        channels=RESPEAKER_CHANNELS,
+        input=True,
+        input_device_index=device,
+        frames_per_buffer=CHUNK,
+        stream_callback=callback)
+
+    if watcher is not None:
+        watcher.start()
+    recorder.start()
+    stream.start_stream()
+
+    print("* waiting for triggers, Ctrl+C to stop")
+    while True:
+        try:
+            time.sleep(1)
+        except KeyboardInterrupt:
+            break
+
+    stream.stop_stream()
+    stream.close()
+    recorder.stop()
+    if watcher is not None:
+        watcher.stop()
+    p.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic acoustic scenes for the multi-array localizers
+
+Places point sources in a room and renders what every ReSpeaker array would
+capture with the 6 channels firmware: fractional-delay, 1/r attenuated copies
+of the source signal on the 4 raw microphone channels, with optional additive
+noise and a synthetic reverberation tail. The ideal DOAANGLE integer of every
+array is returned alongside, so localizers can be scored against ground truth.
+
+All scenes of a batch are rendered at once in the frequency domain, which keeps
+the generator at several thousand scenes per minute.
+"""
+import sys
+import os
+import math
+import time
+import wave
+import argparse
+
+import numpy as np
+
+# Add parent directory to sys.path
+parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, parent_dir)
+
+from location_3arrays_orthogonal import ThreeArrayLocalization3D
+from odas_config import load_geometry
+
+# Local-to-world rotation of each array, columns are the array's x, y and normal axes
+# - Array 1: XY plane, DOA measured from +X towards +Y
+# - Array 2: XZ plane, DOA measured from +X towards +Z
+# - Array 3: YZ plane, DOA measured from +Y towards +Z
+ARRAY_ROTATIONS = np.array([
+    [[1, 0, 0], [0, 1, 0], [0, 0, 1]],
+    [[1, 0, 0], [0, 0, -1], [0, 1, 0]],
+    [[0, 0, 1], [1, 0, 0], [0, 1, 0]],
+], dtype=float)
+
+
+def ideal_doa(sources, centers, rotations):
+    """
+    DOAANGLE integers each array would report for each source
+
+    Args:
+        sources: (n, 3) source positions
+        centers: (A, 3) array centers
+        rotations: (A, 3, 3) local-to-world rotations
+
+    Returns:
+        (n, A) int array of angles in [0, 360)
+    """
+    rel = sources[:, None, :] - centers[None, :, :]
+    local = np.einsum('aji,naj->nai', rotations, rel)
+    angle = np.degrees(np.arctan2(local[..., 1], local[..., 0]))
+    return np.mod(np.rint(angle), 360).astype(int)
+
+
+class SceneGenerator:
+    def __init__(self, room=(5.0, 5.0, 3.0), duration=0.1, snr_db=None, rt60=None,
+                 reverb_level=0.3, min_distance=0.5, centers=None, rotations=None,
+                 geometry=None, seed=None):
+        """
+        Args:
+            room: (x, y, z) room size in meters, the room spans [0, size] on each axis
+            duration: length of each scene in seconds
+            snr_db: signal to noise ratio of the additive white noise, None for no noise
+            rt60: reverberation time in seconds, None for an anechoic room
+            reverb_level: energy of the reverberation tail relative to the direct path
+            min_distance: minimum distance between a source and any array center
+            centers: (A, 3) array centers, defaults to ThreeArrayLocalization3D
+            rotations: (A, 3, 3) local-to-world rotation of each array
+            geometry: ArrayGeometry shared by the arrays, defaults to odas.cfg
+            seed: random seed
+        """
+        if centers is None:
+            localizer = ThreeArrayLocalization3D()
+            centers = [localizer.array1_center, localizer.array2_center, localizer.array3_center]
+
+        if geometry is None:
+            geometry = load_geometry()
+
+        self.geometry = geometry
+        self.room = np.asarray(room, dtype=float)
+        self.rate = rate = geometry.rate
+        self.samples = int(round(duration * rate))
+        self.snr_db = snr_db
+        self.rt60 = rt60
+        self.reverb_level = reverb_level
+        self.min_distance = min_distance
+        self.speed_of_sound = speed_of_sound = geometry.speed_of_sound
+        self.centers = np.asarray(centers, dtype=float)
+        self.rotations = ARRAY_ROTATIONS if rotations is None else np.asarray(rotations, dtype=float)
+        self.random = np.random.default_rng(seed)
+
+        # (A, M, 3) microphone positions in world coordinates
+        self.mics = self.centers[:, None, :] + np.einsum('aij,mj->ami', self.rotations, geometry.mics)
+
+        # FFT length covering the scene, the longest propagation delay and the reverberation tail
+        max_delay = np.linalg.norm(self.room) / speed_of_sound
+        tail = int(rt60 * rate) if rt60 else 0
+        self.tail = tail
+        self.nfft = 1 << int(math.ceil(math.log(self.samples + max_delay * rate + tail + 1, 2)))
+        self.freqs = np.fft.rfftfreq(self.nfft, 1.0 / rate)
+
+    @property
+    def channels(self):
+        return 6
+
+    def sample_sources(self, n):
+        """
+        Draw n source positions uniformly in the room, at least min_distance away from every array
+        """
+        sources = np.empty((n, 3))
+        filled = 0
+        while filled < n:
+            candidates = self.random.uniform(0, 1, (2 * (n - filled), 3)) * self.room
+            dist = np.linalg.norm(candidates[:, None, :] - self.centers[None, :, :], axis=-1)
+            candidates = candidates[np.all(dist >= self.min_distance, axis=1)][:n - filled]
+            sources[filled:filled + len(candidates)] = candidates
+            filled += len(candidates)
+
+        return sources
+
+    def render(self, sources, signals=None):
+        """
+        Render the captures of every array for a batch of sources
+
+        Args:
+            sources: (n, 3) source positions
+            signals: (n, samples) source signals, white noise if None
+
+        Returns:
+            audio: (n, A, samples, 6) int16 interleavable frames, ready for a 6 channel WAV
+            doa: (n, A) ideal DOAANGLE integers
+        """
+        sources = np.atleast_2d(np.asarray(sources, dtype=float))
+        n = len(sources)
+        if signals is None:
+            signals = self.random.standard_normal((n, self.samples)).astype(np.float32)
+
+        spectrum = np.fft.rfft(signals, self.nfft, axis=-1).astype(np.complex64)
+
+        # (n, A, M) propagation distance and delay of every microphone
+        dist = np.linalg.norm(sources[:, None, None, :] - self.mics[None], axis=-1)
+        delay = dist / self.speed_of_sound
+        gain = 1.0 / np.maximum(dist, 0.1)
+
+        # fractional delay and attenuation as one complex gain per bin
+        phase = np.exp((-2j * np.pi * self.freqs).astype(np.complex64) * delay[..., None].astype(np.float32))
+        transfer = phase * gain[..., None].astype(np.float32)
+
+        if self.rt60:
+            t = np.arange(self.tail) / float(self.rate)
+            envelope = np.exp(-6.9 * t / self.rt60).astype(np.float32)
+            envelope *= math.sqrt(self.reverb_level / np.sum(envelope ** 2))
+            tail = self.random.standard_normal(dist.shape + (self.tail,)).astype(np.float32) * envelope
+            # the tail starts with the direct path and decays with the same attenuation
+            transfer += np.fft.rfft(tail, self.nfft, axis=-1) * transfer
+
+        mics = np.fft.irfft(spectrum[:, None, None, :] * transfer, self.nfft, axis=-1)[..., :self.samples]
+
+        if self.snr_db is not None:
+            power = np.mean(mics ** 2, axis=(-2, -1), keepdims=True)
+            scale = np.sqrt(power / (10 ** (self.snr_db / 10.0)))
+            mics += self.random.standard_normal(mics.shape).astype(np.float32) * scale
+
+        peak = np.max(np.abs(mics), axis=(1, 2, 3), keepdims=True)
+        mics *= 16384.0 / np.maximum(peak, 1e-12)
+
+        audio = np.zeros((n, len(self.centers), self.samples, 6), dtype=np.int16)
+        audio[..., self.geometry.channels] = np.swapaxes(mics, 2, 3)
+        # channel 0 stands in for the processed output, channel 5 (playback) stays silent
+        audio[..., 0] = np.mean(mics, axis=2)
+
+        return audio, ideal_doa(sources, self.centers, self.rotations)
+
+    def generate(self, n, batch_size=256):
+        """
+        Yield (sources, audio, doa) batches until n scenes have been rendered
+        """
+        for start in range(0, n, batch_size):
+            sources = self.sample_sources(min(batch_size, n - start))
+            audio, doa = self.render(sources)
+            yield sources, audio, doa
+
+
+def write_wav(directory, sources, audio, doa, rate=16000, offset=0):
+    """
+    Write every array of every scene to <directory>/scene<i>_array<a>.wav and
+    append the ground truth to <directory>/scenes.csv
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    index = os.path.join(directory, 'scenes.csv')
+    new = not os.path.exists(index)
+    with open(index, 'a') as f:
+        if new:
+            f.write('scene,x,y,z,{}\n'.format(','.join('doa{}'.format(a + 1) for a in range(audio.shape[1]))))
+
+        for i in range(len(audio)):
+            for a in range(audio.shape[1]):
+                wf = wave.open(os.path.join(directory, 'scene{}_array{}.wav'.format(offset + i, a + 1)), 'wb')
+                wf.setnchannels(audio.shape[-1])
+                wf.setsampwidth(2)
+                wf.setframerate(rate)
+                wf.writeframes(audio[i, a].tobytes())
+                wf.close()
+
+            f.write('{},{:.4f},{:.4f},{:.4f},{}\n'.format(
+                offset + i, sources[i, 0], sources[i, 1], sources[i, 2],
+                ','.join(str(d) for d in doa[i])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render synthetic scenes for the 3 orthogonal arrays')
+    parser.add_argument('-n', '--scenes', type=int, default=2000, help='number of scenes')
+    parser.add_argument('--duration', type=float, default=0.1, help='scene length in seconds')
+    parser.add_argument('--snr', type=float, default=None, help='SNR in dB of additive noise')
+    parser.add_argument('--rt60', type=float, default=None, help='reverberation time in seconds')
+    parser.add_argument('--batch', type=int, default=256, help='scenes rendered per batch')
+    parser.add_argument('--wav', default=None, help='directory to write WAV files and scenes.csv')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    generator = SceneGenerator(duration=args.duration, snr_db=args.snr, rt60=args.rt60, seed=args.seed)
+
+    count = 0
+    start = time.time()
+    for sources, audio, doa in generator.generate(args.scenes, args.batch):
+        if args.wav:
+            write_wav(args.wav, sources, audio, doa, generator.rate, offset=count)
+        count += len(audio)
+    elapsed = time.time() - start
+
+    sys.stdout.write("Rendered {} scenes x {} arrays in {:.2f}s: {:.0f} scenes/min\n".format(
+        count, len(generator.centers), elapsed, count / elapsed * 60))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+"""
+Constant-velocity Kalman tracker for DOA angles and 2D/3D positions
+
+All tracks live in stacked NumPy arrays (state, covariance, counters), so
+prediction, gating and correction run for every track at once. Works on
+
+- DOA streams in degrees (dim=1, angular=True): innovations and states wrap around 360
+- positions from the localizers (dim=2 or 3), e.g. ThreeArrayLocalization3D
+
+Observations falling well outside every track's gate (twice the gating
+distance) give birth to tentative tracks, which are confirmed after `confirm`
+hits and die after `max_misses` misses.
+"""
+
+import collections
+
+import numpy as np
+
+
+Track = collections.namedtuple('Track', ['id', 'position', 'velocity', 'std'])
+
+
+class KalmanTracker:
+    def __init__(self, dim=1, angular=True, sigma_q=30.0, sigma_r=5.0, gate=3.0,
+                 confirm=3, max_misses=10, max_tracks=16):
+        """
+        Args:
+            dim: 1 for DOA angles, 2 or 3 for positions
+            angular: wrap positions to [0, 360) degrees, only for dim=1
+            sigma_q: acceleration noise (units/s^2) of the constant-velocity model
+            sigma_r: measurement noise (units)
+            gate: gating distance in standard deviations (Mahalanobis)
+            confirm: hits before a track is reported
+            max_misses: consecutive misses before a track dies
+            max_tracks: capacity of the track arrays
+        """
+        if angular and dim != 1:
+            raise ValueError('angular tracking needs dim=1')
+
+        self.dim = dim
+        self.angular = angular
+        self.sigma_q = sigma_q
+        self.sigma_r = sigma_r
+        self.gate = gate
+        self.confirm = confirm
+        self.max_misses = max_misses
+        self.max_tracks = max_tracks
+
+        n = 2 * dim
+        self.x = np.zeros((max_tracks, n))
+        self.P = np.zeros((max_tracks, n, n))
+        self.time = np.zeros(max_tracks)
+        self.ids = np.full(max_tracks, -1)
+        self.hits = np.zeros(max_tracks, dtype=int)
+        self.misses = np.zeros(max_tracks, dtype=int)
+        self.alive = np.zeros(max_tracks, dtype=bool)
+        self.next_id = 0
+
+        self.H = np.hstack([np.eye(dim), np.zeros((dim, dim))])
+        self.R = np.eye(dim) * sigma_r ** 2
+
+    def _wrap(self, d):
+        if self.angular:
+            return (d + 180.0) % 360.0 - 180.0
+        return d
+
+    def _transition(self, dt):
+        """
+        Stacked transition and process noise matrices for time steps dt (T,)
+        """
+        d = self.dim
+        eye = np.eye(d)
+        T = len(dt)
+        F = np.tile(np.eye(2 * d), (T, 1, 1))
+        F[:, :d, d:] = dt[:, None, None] * eye
+
+        q = self.sigma_q ** 2
+        Q = np.empty((T, 2 * d, 2 * d))
+        Q[:, :d, :d] = (q * dt ** 3 / 3)[:, None, None] * eye
+        Q[:, :d, d:] = (q * dt ** 2 / 2)[:, None, None] * eye
+        Q[:, d:, :d] = Q[:, :d, d:]
+        Q[:, d:, d:] = (q * dt)[:, None, None] * eye
+        return F, Q
+
+    def predict(self, t):
+        """
+        Propagate every live track to time t
+        """
+        idx = np.flatnonzero(self.alive)
+        if not len(idx):
+            return
+
+        dt = np.maximum(t - self.time[idx], 0.0)
+        F, Q = self._transition(dt)
+        self.x[idx] = np.einsum('tij,tj->ti', F, self.x[idx])
+        self.P[idx] = F @ self.P[idx] @ np.swapaxes(F, 1, 2) + Q
+        self.time[idx] = t
+        if self.angular:
+            self.x[idx, 0] %= 360.0
+
+    def update(self, observations, t):
+        """
+        Fold the observations made at time t into the tracks
+
+        Args:
+            observations: (K, dim) array, or a sequence of angles when dim=1
+            t: timestamp in seconds
+
+        Returns:
+            list of Track for the confirmed tracks
+        """
+        z = np.asarray(observations, dtype=float).reshape(-1, self.dim)
+        self.predict(t)
+
+        idx = np.flatnonzero(self.alive)
+        assigned_obs = np.zeros(len(z), dtype=bool)
+        assigned_tracks = np.zeros(len(idx), dtype=bool)
+        near_track = np.zeros(len(z), dtype=bool)
+
+        if len(idx) and len(z):
+            # (T, K, d) innovations and (T, d, d) innovation covariances
+            y = self._wrap(z[None, :, :] - self.x[idx, None, :self.dim])
+            S = self.P[idx, :self.dim, :self.dim] + self.R
+            S_inv = np.linalg.inv(S)
+            dist = np.sqrt(np.einsum('tki,tij,tkj->tk', y, S_inv, y))
+            near_track = np.any(dist <= 2 * self.gate, axis=0)
+
+            # greedy nearest-neighbour assignment inside the gate
+            order = np.argsort(dist, axis=None)
+            rows, cols = np.unravel_index(order, dist.shape)
+            inside = dist[rows, cols] <= self.gate
+            track_of_obs = np.full(len(z), -1)
+            for r, c in zip(rows[inside], cols[inside]):
+                if not assigned_tracks[r] and not assigned_obs[c]:
+                    assigned_tracks[r] = True
+                    assigned_obs[c] = True
+                    track_of_obs[c] = r
+
+            # vectorized correction of all assigned tracks
+            obs = np.flatnonzero(track_of_obs >= 0)
+            rows = track_of_obs[obs]
+            if len(obs):
+                sel = idx[rows]
+                K = self.P[sel] @ self.H.T @ S_inv[rows]
+                innovation = y[rows, obs]
+                self.x[sel] += np.einsum('tij,tj->ti', K, innovation)
+                self.P[sel] = (np.eye(2 * self.dim) - K @ self.H) @ self.P[sel]
+                if self.angular:
+                    self.x[sel, 0] %= 360.0
+
+        hit = idx[assigned_tracks]
+        miss = idx[~assigned_tracks]
+        self.hits[hit] += 1
+        self.misses[hit] = 0
+        self.misses[miss] += 1
+        self.alive[miss[self.misses[miss] > self.max_misses]] = False
+
+        for obs in z[~assigned_obs & ~near_track]:
+            self._birth(obs, t)
+
+        return self.tracks()
+
+    def _birth(self, z, t):
+        free = np.flatnonzero(~self.alive)
+        if not len(free):
+            return
+
+        i = free[0]
+        d = self.dim
+        self.x[i] = 0.0
+        self.x[i, :d] = z % 360.0 if self.angular else z
+        self.P[i] = 0.0
+        self.P[i, :d, :d] = np.eye(d) * self.sigma_r ** 2
+        # an unknown velocity: allow a source to move a few gate widths per second
+        self.P[i, d:, d:] = np.eye(d) * (self.gate * self.sigma_r) ** 2
+        self.time[i] = t
+        self.ids[i] = self.next_id
+        self.hits[i] = 1
+        self.misses[i] = 0
+        self.alive[i] = True
+        self.next_id += 1
+
+    def tracks(self):
+        """
+        Confirmed tracks as a list of Track
+        """
+        idx = np.flatnonzero(self.alive & (self.hits >= self.confirm))
+        d = self.dim
+        std = np.sqrt(np.diagonal(self.P[idx, :d, :d], axis1=1, axis2=2))
+        return [Track(int(self.ids[i]), self.x[i, :d].copy(), self.x[i, d:].copy(), s)
+                for i, s in zip(idx, std)]
+
+    def next_interval(self, tolerance, max_interval=1.0, min_interval=0.0):
+        """
+        How long the confirmed tracks can be predicted before their position
+        standard deviation grows beyond tolerance
+
+        A poller can sleep this long between reads and keep the same accuracy.
+        Returns min_interval when there is no confirmed track.
+        """
+        idx = np.flatnonzero(self.alive & (self.hits >= self.confirm))
+        if not len(idx):
+            return min_interval
+
+        dt = np.geomspace(1e-3, max_interval, 64)
+        d = self.dim
+        P = self.P[idx]
+        pp = np.diagonal(P[:, :d, :d], axis1=1, axis2=2)
+        pv = np.diagonal(P[:, :d, d:], axis1=1, axis2=2)
+        vv = np.diagonal(P[:, d:, d:], axis1=1, axis2=2)
+        q = self.sigma_q ** 2
+
+        # (T, dt) worst-axis predicted variance after dt seconds
+        var = (pp[:, None, :] + 2 * dt[None, :, None] * pv[:, None, :]
+               + dt[None, :, None] ** 2 * vv[:, None, :] + q * dt[None, :, None] ** 3 / 3).max(axis=2)
+        ok = np.all(var <= tolerance ** 2, axis=0)
+        if not ok[0]:
+            return min_interval
+
+        # variance grows with dt, so the last acceptable step is the answer
+        return max(min_interval, dt[np.flatnonzero(ok)[-1]])
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+
+"""
+Ingest the ODAS tracked/potential JSON socket streams
+
+With odas.cfg, odaslive pushes `ssl.potential` frames to 127.0.0.1:9001 and
+`sst.tracked` frames to 127.0.0.1:9000. Each frame is a pretty-printed JSON
+object, and frames are concatenated without any delimiter:
+
+    {
+        "timeStamp": 45,
+        "src": [
+            { "id": 3, "tag": "dynamic", "x": 0.512, "y": -0.829, "z": 0.223, "activity": 0.978 },
+            ...
+        ]
+    }
+
+OdasParser splits the byte stream into frames incrementally (frames may be cut
+anywhere by the socket reads) and copies them into a preallocated NumPy record
+array, returning a (frames, sources) view per feed. OdasStream wraps it around a
+socket, as a generator or an async iterator. odaslive connects to its sinks, so
+by default the stream listens; use listen=False to connect to a server instead.
+"""
+
+import sys
+import json
+import codecs
+import time
+import socket
+import asyncio
+import threading
+
+import numpy as np
+
+
+TRACKED = np.dtype([('timestamp', '<u8'), ('id', '<i8'), ('tag', 'U16'),
+                    ('x', '<f4'), ('y', '<f4'), ('z', '<f4'), ('activity', '<f4')])
+
+POTENTIAL = np.dtype([('timestamp', '<u8'), ('x', '<f4'), ('y', '<f4'), ('z', '<f4'), ('E', '<f4')])
+
+PORTS = {'tracked': 9000, 'potential': 9001}
+
+
+class OdasParser:
+    def __init__(self, kind='tracked', sources=None, capacity=64):
+        """
+        Args:
+            kind: 'tracked' or 'potential'
+            sources: sources per frame (nTracks / nPots), taken from the first frame if None
+            capacity: frames preallocated, grown if a single feed completes more frames
+        """
+        if kind not in PORTS:
+            raise ValueError('unknown stream {}'.format(kind))
+
+        self.kind = kind
+        self.dtype = TRACKED if kind == 'tracked' else POTENTIAL
+        self.fields = [name for name in self.dtype.names if name != 'timestamp']
+        self.sources = sources
+        self.capacity = capacity
+        self.records = None if sources is None else np.zeros((capacity, sources), dtype=self.dtype)
+        self.pending = ''
+        # a multi-byte character can be split across two reads
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.frames = 0
+
+    def _split(self):
+        """
+        Cut complete top-level objects off the pending text
+        """
+        text = self.pending
+        objects = []
+        depth = 0
+        start = 0
+        in_string = False
+        escape = False
+        i = 0
+        n = len(text)
+        while i < n:
+            c = text[i]
+            if in_string:
+                if escape:
+                    escape = False
+                elif c == '\\':
+                    escape = True
+                elif c == '"':
+                    in_string = False
+            elif c == '"':
+                in_string = True
+            elif c == '{':
+                if depth == 0:
+                    start = i
+                depth += 1
+            elif c == '}':
+                depth -= 1
+                if depth == 0:
+                    objects.append(text[start:i + 1])
+                    # restart from an empty buffer state after each frame
+                    start = i + 1
+            elif depth == 0:
+                # skip whitespace between frames quickly
+                j = text.find('{', i)
+                if j < 0:
+                    i = n
+                    start = n
+                    break
+                i = j
+                continue
+            i += 1
+
+        self.pending = text[start:] if depth else ''
+        return objects
+
+    def feed(self, data):
+        """
+        Parse the next bytes of the stream
+
+        Returns:
+            (frames, sources) record array view of the frames completed by this
+            data, only valid until the next call
+        """
+        self.pending += self.decoder.decode(data) if isinstance(data, bytes) else data
+        objects = self._split()
+        if not objects:
+            return np.zeros((0, self.sources or 0), dtype=self.dtype)
+
+        frames = [json.loads(o) for o in objects]
+        if self.records is None:
+            self.sources = len(frames[0]['src'])
+            self.records = np.zeros((self.capacity, self.sources), dtype=self.dtype)
+        if len(frames) > len(self.records):
+            self.records = np.zeros((len(frames), self.sources), dtype=self.dtype)
+
+        out = self.records[:len(frames)]
+        out[...] = np.zeros((), dtype=self.dtype)
+        for i, frame in enumerate(frames):
+            out['timestamp'][i] = frame['timeStamp']
+            row = out[i]
+            for k, src in enumerate(frame['src'][:self.sources]):
+                row[k] = (frame['timeStamp'],) + tuple(src[name] for name in self.fields)
+
+        self.frames += len(frames)
+        return out
+
+
+class OdasStream:
+    def __init__(self, kind='tracked', port=None, host='127.0.0.1', listen=True, sources=None):
+        """
+        Args:
+            kind: 'tracked' or 'potential'
+            port: defaults to the odas.cfg port of the stream (9000 / 9001)
+            host: address to listen on or connect to
+            listen: wait for odaslive to connect (its sinks are socket clients),
+                False to connect to a server
+            sources: sources per frame, detected from the first frame if None
+        """
+        self.kind = kind
+        self.port = PORTS[kind] if port is None else port
+        self.host = host
+        self.listen = listen
+        self.sources = sources
+
+    def _connect(self):
+        if self.listen:
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind((self.host, self.port))
+            server.listen(1)
+            connection, _ = server.accept()
+            server.close()
+        else:
+            connection = socket.create_connection((self.host, self.port))
+        return connection
+
+    def __iter__(self):
+        """
+        Generate a (frames, sources) record array per socket read
+        """
+        parser = OdasParser(self.kind, self.sources)
+        connection = self._connect()
+        try:
+            while True:
+                data = connection.recv(65536)
+                if not data:
+                    break
+                records = parser.feed(data)
+                if len(records):
+                    yield records
+        finally:
+            connection.close()
+
+    async def _open(self):
+        if not self.listen:
+            return await asyncio.open_connection(self.host, self.port)
+
+        connected = asyncio.get_running_loop().create_future()
+
+        def on_connect(reader, writer):
+            if not connected.done():
+                connected.set_result((reader, writer))
+
+        server = await asyncio.start_server(on_connect, self.host, self.port)
+        try:
+            return await connected
+        finally:
+            server.close()
+
+    async def __aiter__(self):
+        """
+        Async version of __iter__
+        """
+        parser = OdasParser(self.kind, self.sources)
+        reader, writer = await self._open()
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                records = parser.feed(data)
+                if len(records):
+                    yield records
+        finally:
+            writer.close()
+
+
+def fake_frame(kind, timestamp, sources, random):
+    """
+    One frame formatted like odaslive does
+    """
+    xyz = random.standard_normal((sources, 3))
+    xyz /= np.linalg.norm(xyz, axis=1, keepdims=True)
+    lines = ['{{\n    "timeStamp": {},\n    "src": [\n'.format(timestamp)]
+    for k in range(sources):
+        if kind == 'tracked':
+            lines.append('        {{ "id": {}, "tag": "dynamic", "x": {:.3f}, "y": {:.3f}, "z": {:.3f}, "activity": {:.3f} }}'.format(
+                k + 1, xyz[k, 0], xyz[k, 1], xyz[k, 2], random.random()))
+        else:
+            lines.append('        {{ "x": {:.3f}, "y": {:.3f}, "z": {:.3f}, "E": {:.3f} }}'.format(
+                xyz[k, 0], xyz[k, 1], xyz[k, 2], random.random()))
+        lines.append(',\n' if k < sources - 1 else '\n')
+    lines.append('    ]\n}\n')
+    return ''.join(lines).encode('utf-8')
+
+
+class FakeOdas:
+    """
+    Stand-in for odaslive: serves frames on a local socket, at a fixed rate or as fast as possible
+    """
+
+    def __init__(self, kind='tracked', port=0, host='127.0.0.1', sources=4, rate=125.0, frames=None, seed=None):
+        self.kind = kind
+        self.sources = sources
+        self.rate = rate
+        self.frames = frames
+        self.random = np.random.default_rng(seed)
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(1)
+        self.port = self.server.getsockname()[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        connection, _ = self.server.accept()
+        # pre-render a pool of frames, a real-time rate then only costs the socket writes
+        pool = [fake_frame(self.kind, 0, self.sources, self.random) for _ in range(64)]
+        timestamp = 0
+        deadline = time.monotonic()
+        try:
+            while self.frames is None or timestamp < self.frames:
+                frame = pool[timestamp % len(pool)].replace(b'"timeStamp": 0,', '"timeStamp": {},'.format(timestamp).encode(), 1)
+                connection.sendall(frame)
+                timestamp += 1
+                if self.rate:
+                    deadline += 1.0 / self.rate
+                    delay = deadline - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+        except (OSError, socket.error):
+            pass
+        finally:
+            connection.close()
+            self.server.close()
+
+
+def main():
+    """
+    Benchmark the parser against a fake odaslive sending as fast as it can
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Consume ODAS tracked/potential streams')
+    parser.add_argument('kind', nargs='?', default='tracked', choices=['tracked', 'potential'])
+    parser.add_argument('--fake', type=int, default=0, metavar='FRAMES',
+                        help='benchmark against a fake ODAS server sending FRAMES frames')
+    parser.add_argument('--sources', type=int, default=4)
+    args = parser.parse_args()
+
+    if not args.fake:
+        for records in OdasStream(args.kind):
+            for frame in records:
+                sys.stdout.write('{}\n'.format(frame))
+        return
+
+    fake = FakeOdas(args.kind, sources=args.sources, rate=0, frames=args.fake, seed=0)
+    fake.start()
+
+    frames = 0
+    start = time.time()
+    for records in OdasStream(args.kind, port=fake.port, listen=False):
+        frames += len(records)
+    elapsed = time.time() - start
+
+    sys.stdout.write("parsed {} {} frames x {} sources in {:.2f}s: {:.0f} frames/s ({:.0f}x the 125 frames/s of odas.cfg)\n".format(
+        frames, args.kind, args.sources, elapsed, frames / elapsed, frames / elapsed / 125.0))
+
+
+if __name__ == '__main__':
+    main()
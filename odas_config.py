@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+
+"""
+Load odas.cfg and compile the array geometry for the host-side localizers
+
+odas.cfg is a libconfig file: `name = value;` settings, `{ }` groups, `( )`
+lists, `[ ]` arrays and #, // or /* */ comments. parse() turns it into plain
+dicts, lists and numbers; load_geometry() compiles the parts the localizers
+need (mic positions, pairs, baselines, maximum TDOA per pair, frame sizes,
+speed of sound, channel mapping) into an ArrayGeometry.
+
+Geometries are cached in memory per (path, mtime) and on disk as .npz keyed by
+the config content, so the precomputation runs once per config and is shared
+by every process using it.
+"""
+
+import os
+import re
+import sys
+import hashlib
+import tempfile
+import itertools
+
+import numpy as np
+
+
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'odas.cfg')
+
+CACHE_DIR = os.path.join(tempfile.gettempdir(), 'odas_geometry')
+
+TOKEN = re.compile(r'''
+    (?P<space>\s+|\#[^\n]*|//[^\n]*|/\*.*?\*/)
+  | (?P<string>"(?:[^"\\]|\\.)*")
+  | (?P<number>[+-]?(?:0[xX][0-9a-fA-F]+|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)L?)
+  | (?P<bool>\b(?:true|false|TRUE|FALSE|True|False)\b)
+  | (?P<name>[A-Za-z\*][-A-Za-z0-9_\*]*)
+  | (?P<punct>[=:;,{}()\[\]])
+''', re.VERBOSE | re.DOTALL)
+
+ESCAPE = re.compile(r'\\(?:x([0-9a-fA-F]{2})|(.))', re.DOTALL)
+
+ESCAPES = {'n': '\n', 'r': '\r', 't': '\t', 'f': '\f', '"': '"', '\\': '\\'}
+
+
+class ConfigError(ValueError):
+    pass
+
+
+def _unescape(literal):
+    """
+    Text of a string token without its quotes, with the libconfig escapes replaced
+    """
+    def replace(match):
+        if match.group(1):
+            return chr(int(match.group(1), 16))
+        return ESCAPES.get(match.group(2), match.group(0))
+
+    return ESCAPE.sub(replace, literal[1:-1])
+
+
+def _tokenize(text):
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        match = TOKEN.match(text, pos)
+        if not match:
+            line = text.count('\n', 0, pos) + 1
+            raise ConfigError('unexpected character {!r} at line {}'.format(text[pos], line))
+        kind = match.lastgroup
+        if kind != 'space':
+            tokens.append((kind, match.group(kind)))
+        pos = match.end()
+    return tokens
+
+
+class _Parser:
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def take(self, expected=None):
+        token = self.peek()
+        if expected is not None and token[1] != expected:
+            raise ConfigError('expected {!r}, got {!r}'.format(expected, token[1]))
+        self.pos += 1
+        return token
+
+    def settings(self, end=None):
+        group = {}
+        while self.peek()[1] != end:
+            kind, name = self.take()
+            if kind != 'name':
+                raise ConfigError('expected a setting name, got {!r}'.format(name))
+            if self.peek()[1] not in ('=', ':'):
+                raise ConfigError('expected = or : after {}'.format(name))
+            self.take()
+            group[name] = self.value()
+            if self.peek()[1] in (';', ','):
+                self.take()
+        return group
+
+    def value(self):
+        kind, text = self.take()
+        if text == '{':
+            group = self.settings('}')
+            self.take('}')
+            return group
+        if text in ('(', '['):
+            end = ')' if text == '(' else ']'
+            items = []
+            while self.peek()[1] != end:
+                items.append(self.value())
+                if self.peek()[1] == ',':
+                    self.take()
+            self.take(end)
+            return items
+        if kind == 'string':
+            # adjacent string literals are concatenated
+            literals = [text]
+            while self.peek()[0] == 'string':
+                literals.append(self.take()[1])
+            return ''.join(_unescape(literal) for literal in literals)
+        if kind == 'number':
+            text = text.rstrip('L')
+            if text.lower().lstrip('+-').startswith('0x'):
+                return int(text, 16)
+            if re.match(r'^[+-]?\d+$', text):
+                return int(text)
+            return float(text)
+        if kind == 'bool':
+            return text.lower() == 'true'
+        raise ConfigError('unexpected {!r}'.format(text))
+
+
+def parse(text):
+    """
+    Parse libconfig text into nested dicts and lists
+    """
+    parser = _Parser(_tokenize(text))
+    return parser.settings()
+
+
+class ArrayGeometry:
+    """
+    Geometry of one array compiled from odas.cfg
+
+    Attributes:
+        mics: (M, 3) microphone positions relative to the array center, meters
+        directions: (M, 3) microphone directivity axes
+        angles: (M, 2) directivity cone angles in degrees
+        channels: (M,) 0-based channel of each microphone in the 6 channels stream
+        pairs: (P, 2) indices of every microphone pair
+        baselines: (P, 3) vector from the first to the second microphone of each pair
+        max_tdoa: (P,) largest possible delay of each pair in seconds
+        max_lag: (P,) largest possible delay of each pair in samples
+    """
+
+    ARRAYS = ('mics', 'directions', 'angles', 'channels', 'pairs', 'baselines', 'max_tdoa', 'max_lag')
+
+    def __init__(self, mics, directions, angles, channels, rate, hop_size, frame_size, speed_of_sound):
+        self.mics = np.asarray(mics, dtype=float)
+        self.directions = np.asarray(directions, dtype=float)
+        self.angles = np.asarray(angles, dtype=float)
+        self.channels = np.asarray(channels, dtype=int)
+        self.rate = rate
+        self.hop_size = hop_size
+        self.frame_size = frame_size
+        self.speed_of_sound = speed_of_sound
+
+        self.pairs = np.array(list(itertools.combinations(range(len(self.mics)), 2)), dtype=int).reshape(-1, 2)
+        self.baselines = self.mics[self.pairs[:, 1]] - self.mics[self.pairs[:, 0]]
+        self.max_tdoa = np.linalg.norm(self.baselines, axis=1) / speed_of_sound
+        self.max_lag = self.max_tdoa * rate
+
+        for name in self.ARRAYS:
+            getattr(self, name).flags.writeable = False
+
+    @property
+    def center(self):
+        return self.mics.mean(axis=0)
+
+    def world(self, center, rotation=None):
+        """
+        (M, 3) microphone positions of an array placed at center with a local-to-world rotation
+        """
+        mics = self.mics if rotation is None else self.mics @ np.asarray(rotation).T
+        return np.asarray(center) + mics
+
+    def save(self, path):
+        np.savez(path, rate=self.rate, hop_size=self.hop_size, frame_size=self.frame_size,
+                 speed_of_sound=self.speed_of_sound, mics=self.mics, directions=self.directions,
+                 angles=self.angles, channels=self.channels)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['mics'], data['directions'], data['angles'], data['channels'], int(data['rate']),
+                       int(data['hop_size']), int(data['frame_size']), float(data['speed_of_sound']))
+
+    def __repr__(self):
+        return 'ArrayGeometry({} mics, {} pairs, {} Hz, hop {}, frame {}, c={})'.format(
+            len(self.mics), len(self.pairs), self.rate, self.hop_size, self.frame_size, self.speed_of_sound)
+
+
+def compile_geometry(config):
+    """
+    Build an ArrayGeometry from a parsed odas.cfg
+    """
+    general = config['general']
+    mics = general['mics']
+    # mapping.map lists the 1-based channels of the raw stream feeding each mic
+    mapping = config.get('mapping', {}).get('map', list(range(1, len(mics) + 1)))
+
+    return ArrayGeometry(
+        mics=[m['mu'] for m in mics],
+        directions=[m.get('direction', (0.0, 0.0, 1.0)) for m in mics],
+        angles=[m.get('angle', (180.0, 180.0)) for m in mics],
+        channels=[c - 1 for c in mapping],
+        rate=int(general['samplerate']['mu']),
+        hop_size=int(general['size']['hopSize']),
+        frame_size=int(general['size']['frameSize']),
+        speed_of_sound=float(general['speedofsound']['mu']))
+
+
+_cache = {}
+
+
+def load_geometry(path=DEFAULT_CONFIG, cache_dir=CACHE_DIR):
+    """
+    ArrayGeometry of an odas.cfg, cached in memory and on disk
+
+    Args:
+        path: odas.cfg path
+        cache_dir: directory of the .npz cache shared by processes, None to disable
+    """
+    path = os.path.abspath(path)
+    key = (path, os.path.getmtime(path))
+    geometry = _cache.get(key)
+    if geometry is not None:
+        return geometry
+
+    with open(path, 'rb') as f:
+        raw = f.read()
+
+    cached = None
+    if cache_dir:
+        cached = os.path.join(cache_dir, hashlib.sha1(raw).hexdigest() + '.npz')
+        if os.path.exists(cached):
+            try:
+                geometry = ArrayGeometry.load(cached)
+            except (OSError, ValueError, KeyError):
+                geometry = None
+
+    if geometry is None:
+        geometry = compile_geometry(parse(raw.decode('utf-8')))
+        if cached:
+            try:
+                if not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                # write then rename, concurrent processes never see a partial file
+                fd, tmp = tempfile.mkstemp(suffix='.npz', dir=cache_dir)
+                with os.fdopen(fd, 'wb') as f:
+                    geometry.save(f)
+                os.replace(tmp, cached)
+            except OSError:
+                pass
+
+    _cache[key] = geometry
+    return geometry
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_CONFIG
+    geometry = load_geometry(path)
+    print(geometry)
+    print('{:8} {:>24} {:>10} {:>8}'.format('pair', 'baseline (m)', 'tdoa (us)', 'lag'))
+    for pair, baseline, tdoa, lag in zip(geometry.pairs, geometry.baselines, geometry.max_tdoa, geometry.max_lag):
+        print('{:8} {:>24} {:10.1f} {:8.2f}'.format(
+            '{}-{}'.format(*pair), '({:+.3f},{:+.3f},{:+.3f})'.format(*baseline), tdoa * 1e6, lag))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+"""
+Multi-target particle-filter tracker for source directions
+
+Host-side counterpart of the `sst.particle` stage in odas.cfg. Every track is a
+cloud of unit vectors on the sphere with a velocity, and each particle follows
+one of three dynamic models (stationary, constant velocity, acceleration) drawn
+with the st/ve/ac ratios every step:
+
+    a = exp(-alpha * dt),  b = beta * sqrt(1 - a^2)
+    v = a * v + b * N(0, 1),  x = normalize(x + dt * v)
+
+Particles of all tracks are stored as (tracks, particles, ...) arrays, so the
+prediction, weighting and systematic resampling steps have no Python loop over
+particles. Observations can be DOAANGLE integers (azimuths in degrees) or
+direction / position vectors from any of the localizers.
+"""
+
+import sys
+import time
+
+import numpy as np
+
+from kalman_tracker import Track
+
+
+def to_directions(observations):
+    """
+    Observations as (K, 3) unit vectors
+
+    Args:
+        observations: azimuths in degrees (K,), (azimuth, elevation) in degrees (K, 2)
+            or direction / position vectors (K, 3)
+    """
+    z = np.asarray(observations, dtype=float)
+    if z.ndim == 1:
+        z = z[:, None]
+
+    if z.shape[1] == 3:
+        return z / np.maximum(np.linalg.norm(z, axis=1, keepdims=True), 1e-12)
+
+    azimuth = np.radians(z[:, 0])
+    elevation = np.radians(z[:, 1]) if z.shape[1] > 1 else np.zeros(len(z))
+    return np.stack([np.cos(elevation) * np.cos(azimuth),
+                     np.cos(elevation) * np.sin(azimuth),
+                     np.sin(elevation)], axis=1)
+
+
+def to_azimuth(direction):
+    """
+    Azimuth in degrees [0, 360) of unit vectors (..., 3)
+    """
+    direction = np.asarray(direction)
+    return np.degrees(np.arctan2(direction[..., 1], direction[..., 0])) % 360.0
+
+
+class ParticleTracker:
+    def __init__(self, particles=1000, max_tracks=8,
+                 alpha=(2.0, 0.05, 0.5), beta=(0.04, 0.2, 0.2), ratio=(0.5, 0.3, 0.2),
+                 sigma_r2=0.01, p_false=0.1, n_min=0.7, gate=0.3,
+                 confirm=3, max_misses=50, seed=None):
+        """
+        Args:
+            particles: particles per track (nParticles)
+            max_tracks: capacity of the track arrays
+            alpha, beta, ratio: (stationary, velocity, acceleration) model parameters
+                (st_/ve_/ac_ in odas.cfg)
+            sigma_r2: observation variance on the unit sphere
+            p_false: probability an assigned observation is a false detection
+            n_min: resample when the effective sample size drops below n_min * particles
+            gate: minimum mean likelihood for an observation to be assigned to a track
+            confirm: hits before a track is reported
+            max_misses: consecutive steps without observation before a track dies
+            seed: random seed
+        """
+        self.P = particles
+        self.max_tracks = max_tracks
+        self.alpha = np.asarray(alpha, dtype=float)
+        self.beta = np.asarray(beta, dtype=float)
+        self.ratio = np.cumsum(ratio) / np.sum(ratio)
+        self.sigma_r2 = sigma_r2
+        self.p_false = p_false
+        self.n_min = n_min
+        self.gate = gate
+        self.confirm = confirm
+        self.max_misses = max_misses
+        self.random = np.random.default_rng(seed)
+
+        self.x = np.zeros((max_tracks, particles, 3))
+        self.v = np.zeros((max_tracks, particles, 3))
+        self.w = np.full((max_tracks, particles), 1.0 / particles)
+        self.time = np.zeros(max_tracks)
+        self.ids = np.full(max_tracks, -1)
+        self.hits = np.zeros(max_tracks, dtype=int)
+        self.misses = np.zeros(max_tracks, dtype=int)
+        self.alive = np.zeros(max_tracks, dtype=bool)
+        self.next_id = 0
+        self.resampled = 0
+
+    def predict(self, t):
+        """
+        Propagate the particles of every live track to time t
+        """
+        idx = np.flatnonzero(self.alive)
+        if not len(idx):
+            return
+
+        dt = np.maximum(t - self.time[idx], 0.0)[:, None]
+        # (T, 3) coefficients of each model, then picked per particle
+        a = np.exp(-self.alpha * dt)
+        b = self.beta * np.sqrt(1 - a ** 2)
+        state = np.searchsorted(self.ratio, self.random.random((len(idx), self.P)))
+        a = np.take_along_axis(a, state, axis=1)
+        b = np.take_along_axis(b, state, axis=1)
+
+        x = self.x[idx]
+        v = a[..., None] * self.v[idx] + b[..., None] * self.random.standard_normal(x.shape)
+        x = x + dt[..., None] * v
+        x /= np.linalg.norm(x, axis=-1, keepdims=True)
+        # keep velocities tangent to the sphere
+        v -= np.sum(v * x, axis=-1, keepdims=True) * x
+
+        self.x[idx] = x
+        self.v[idx] = v
+        self.time[idx] = t
+
+    def likelihood(self, idx, z):
+        """
+        (T, P, K) likelihood of every observation for every particle of tracks idx
+        """
+        # both are unit vectors: |x - z|^2 = 2 - 2 x.z
+        d2 = 2.0 - 2.0 * np.einsum('tpi,ki->tpk', self.x[idx], z)
+        return (1 - self.p_false) * np.exp(-0.5 * d2 / self.sigma_r2) + self.p_false
+
+    def resample(self, rows):
+        """
+        Systematic resampling of the given track rows, vectorized over tracks
+        """
+        R, P = len(rows), self.P
+        offset = np.arange(R)[:, None]
+        c = np.cumsum(self.w[rows], axis=1)
+        c /= c[:, -1:]
+        u = (self.random.random((R, 1)) + np.arange(P)) / P
+        # one searchsorted for all rows: shift row r into [r, r + 1)
+        j = np.searchsorted((c + offset).ravel(), (u + offset).ravel()).reshape(R, P) - offset * P
+        j = np.minimum(j, P - 1)
+
+        self.x[rows] = np.take_along_axis(self.x[rows], j[..., None], axis=1)
+        self.v[rows] = np.take_along_axis(self.v[rows], j[..., None], axis=1)
+        self.w[rows] = 1.0 / P
+        self.resampled += R
+
+    def update(self, observations, t):
+        """
+        Fold the observations made at time t into the tracks
+
+        Args:
+            observations: see to_directions
+            t: timestamp in seconds
+
+        Returns:
+            list of Track for the confirmed tracks, position being a unit vector
+            and std the angular spread in degrees
+        """
+        z = to_directions(observations) if len(observations) else np.zeros((0, 3))
+        self.predict(t)
+
+        idx = np.flatnonzero(self.alive)
+        assigned_obs = np.zeros(len(z), dtype=bool)
+        assigned_tracks = np.zeros(len(idx), dtype=bool)
+
+        if len(idx) and len(z):
+            lik = self.likelihood(idx, z)
+            score = np.einsum('tp,tpk->tk', self.w[idx], lik)
+
+            obs_of_track = np.full(len(idx), -1)
+            order = np.argsort(-score, axis=None)
+            rows, cols = np.unravel_index(order, score.shape)
+            inside = score[rows, cols] >= self.gate
+            for r, c in zip(rows[inside], cols[inside]):
+                if not assigned_tracks[r] and not assigned_obs[c]:
+                    assigned_tracks[r] = True
+                    assigned_obs[c] = True
+                    obs_of_track[r] = c
+
+            r = np.flatnonzero(assigned_tracks)
+            if len(r):
+                sel = idx[r]
+                w = self.w[sel] * lik[r, :, obs_of_track[r]]
+                w /= np.sum(w, axis=1, keepdims=True)
+                self.w[sel] = w
+
+                neff = 1.0 / np.sum(w ** 2, axis=1)
+                low = sel[neff < self.n_min * self.P]
+                if len(low):
+                    self.resample(low)
+
+        hit = idx[assigned_tracks]
+        miss = idx[~assigned_tracks]
+        self.hits[hit] += 1
+        self.misses[hit] = 0
+        self.misses[miss] += 1
+        self.alive[miss[self.misses[miss] > self.max_misses]] = False
+
+        for obs in z[~assigned_obs]:
+            self._birth(obs, t)
+
+        return self.tracks()
+
+    def _birth(self, z, t):
+        free = np.flatnonzero(~self.alive)
+        if not len(free):
+            return
+
+        i = free[0]
+        x = z + self.random.standard_normal((self.P, 3)) * np.sqrt(self.sigma_r2)
+        self.x[i] = x / np.linalg.norm(x, axis=1, keepdims=True)
+        self.v[i] = 0.0
+        self.w[i] = 1.0 / self.P
+        self.time[i] = t
+        self.ids[i] = self.next_id
+        self.hits[i] = 1
+        self.misses[i] = 0
+        self.alive[i] = True
+        self.next_id += 1
+
+    def tracks(self):
+        """
+        Confirmed tracks as a list of Track
+        """
+        idx = np.flatnonzero(self.alive & (self.hits >= self.confirm))
+        w = self.w[idx, :, None]
+        mean = np.sum(w * self.x[idx], axis=1)
+        velocity = np.sum(w * self.v[idx], axis=1)
+        mean /= np.maximum(np.linalg.norm(mean, axis=1, keepdims=True), 1e-12)
+        spread = np.sqrt(np.sum(w[..., 0] * np.sum((self.x[idx] - mean[:, None]) ** 2, axis=-1), axis=1))
+        return [Track(int(self.ids[i]), m, vel, np.degrees(s))
+                for i, m, vel, s in zip(idx, mean, velocity, spread)]
+
+
+def main():
+    """
+    Benchmark: 8 talkers tracked with 1000 particles each at a 125 Hz hop rate
+    """
+    tracks, particles, rate, steps = 8, 1000, 125.0, 500
+
+    tracker = ParticleTracker(particles=particles, max_tracks=tracks, seed=0)
+    random = np.random.default_rng(1)
+    start_azimuth = np.arange(tracks) * 360.0 / tracks
+    speed = random.uniform(-20, 20, tracks)
+
+    errors = []
+    elapsed = 0.0
+    for step in range(steps):
+        t = step / rate
+        truth = (start_azimuth + speed * t) % 360
+        observations = truth + random.normal(0, 3, tracks)
+
+        begin = time.time()
+        result = tracker.update(observations, t)
+        elapsed += time.time() - begin
+
+        if step > steps // 2:
+            for track in result:
+                diff = (to_azimuth(track.position) - truth + 180) % 360 - 180
+                errors.append(np.min(np.abs(diff)))
+
+    per_step = elapsed / steps
+    sys.stdout.write("{} tracks x {} particles: {:.2f} ms/step, budget {:.2f} ms at {:.0f} Hz ({:.1f}x real time)\n".format(
+        tracks, particles, per_step * 1000, 1000 / rate, rate, 1 / rate / per_step))
+    sys.stdout.write("{} confirmed tracks, mean azimuth error {:.2f} deg, {} track resamples\n".format(
+        len(tracker.tracks()), np.mean(errors), tracker.resampled))
+
+
+if __name__ == '__main__':
+    main()
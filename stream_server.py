@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+"""
+Publish localization results to local subscribers
+
+Same deployment pattern as the potential/tracked sinks in odas.cfg: records are
+streamed over local sockets, TCP (host, port) or a Unix socket path. Every
+subscriber has its own bounded buffer and writer thread, so a slow client only
+drops its own oldest records and never stalls the localizer calling publish().
+
+Records carry a timestamp, a device id, the raw DOA, a position and a
+confidence, framed as JSON lines or as fixed-width little-endian binary.
+"""
+
+import sys
+import os
+import json
+import time
+import socket
+import struct
+import threading
+import collections
+
+
+# timestamp, device, doa, x, y, z, confidence
+RECORD = struct.Struct('<dHhffff')
+
+FIELDS = ('timestamp', 'device', 'doa', 'x', 'y', 'z', 'confidence')
+
+
+def encode(record, fmt='json'):
+    """
+    Frame one record (a dict with FIELDS, missing ones default to -1 / NaN)
+    """
+    if fmt == 'json':
+        return (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+
+    nan = float('nan')
+    return RECORD.pack(
+        record.get('timestamp', 0.0), record.get('device', 0), record.get('doa', -1),
+        record.get('x', nan), record.get('y', nan), record.get('z', nan), record.get('confidence', nan))
+
+
+def _make_socket(address):
+    if isinstance(address, str):
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    return socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+
+class Subscriber:
+    def __init__(self, connection, maxlen):
+        self.connection = connection
+        self.buffer = collections.deque(maxlen=maxlen)
+        self.condition = threading.Condition()
+        self.dropped = 0
+        self.sent = 0
+        self.done = False
+
+    def put(self, frame):
+        with self.condition:
+            if len(self.buffer) == self.buffer.maxlen:
+                self.dropped += 1
+            self.buffer.append(frame)
+            self.condition.notify()
+
+    def run(self):
+        try:
+            while not self.done:
+                with self.condition:
+                    while not self.buffer and not self.done:
+                        self.condition.wait()
+                    frames = list(self.buffer)
+                    self.buffer.clear()
+
+                if frames:
+                    self.connection.sendall(b''.join(frames))
+                    self.sent += len(frames)
+        except (OSError, socket.error):
+            pass
+        finally:
+            self.done = True
+            self.connection.close()
+
+    def close(self):
+        with self.condition:
+            self.done = True
+            self.condition.notify()
+
+
+class StreamServer:
+    def __init__(self, address=('127.0.0.1', 9100), fmt='json', maxlen=1024):
+        """
+        Args:
+            address: (host, port) for TCP or a path for a Unix socket
+            fmt: 'json' for JSON lines, 'binary' for fixed-width RECORD frames
+            maxlen: records buffered per subscriber before the oldest are dropped
+        """
+        if fmt not in ('json', 'binary'):
+            raise ValueError('unknown format {}'.format(fmt))
+
+        self.address = address
+        self.fmt = fmt
+        self.maxlen = maxlen
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.published = 0
+        self.done = True
+
+        if isinstance(address, str) and os.path.exists(address):
+            os.unlink(address)
+
+        self.server = _make_socket(address)
+        if not isinstance(address, str):
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(address)
+        self.server.listen(16)
+
+        if not isinstance(address, str):
+            self.address = self.server.getsockname()
+
+    def start(self):
+        self.done = False
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        while not self.done:
+            try:
+                connection, _ = self.server.accept()
+            except (OSError, socket.error):
+                break
+
+            subscriber = Subscriber(connection, self.maxlen)
+            with self.lock:
+                self.subscribers.append(subscriber)
+
+            thread = threading.Thread(target=subscriber.run)
+            thread.daemon = True
+            thread.start()
+
+    def publish(self, record):
+        """
+        Fan a record out to every subscriber without blocking
+        """
+        frame = encode(record, self.fmt)
+        with self.lock:
+            self.subscribers = [s for s in self.subscribers if not s.done]
+            subscribers = list(self.subscribers)
+
+        for subscriber in subscribers:
+            subscriber.put(frame)
+        self.published += 1
+
+    @property
+    def dropped(self):
+        with self.lock:
+            return sum(s.dropped for s in self.subscribers)
+
+    def stop(self):
+        self.done = True
+        with self.lock:
+            for subscriber in self.subscribers:
+                subscriber.close()
+        self.server.close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+
+def subscribe(address=('127.0.0.1', 9100), fmt='json'):
+    """
+    Connect to a StreamServer and generate its records as dicts
+    """
+    connection = _make_socket(address)
+    connection.connect(address)
+    pending = b''
+    try:
+        while True:
+            data = connection.recv(65536)
+            if not data:
+                break
+            pending += data
+
+            if fmt == 'json':
+                lines = pending.split(b'\n')
+                pending = lines.pop()
+                for line in lines:
+                    yield json.loads(line.decode('utf-8'))
+            else:
+                n = len(pending) // RECORD.size
+                for values in RECORD.iter_unpack(pending[:n * RECORD.size]):
+                    yield dict(zip(FIELDS, values))
+                pending = pending[n * RECORD.size:]
+    finally:
+        connection.close()
+
+
+def main():
+    """
+    Benchmark: publish records to several local subscribers and report records/s
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Measure the stream server throughput')
+    parser.add_argument('--format', default='binary', choices=['json', 'binary'])
+    parser.add_argument('--subscribers', type=int, default=4)
+    parser.add_argument('--records', type=int, default=200000)
+    parser.add_argument('--unix', default=None, help='Unix socket path instead of TCP')
+    args = parser.parse_args()
+
+    server = StreamServer(args.unix or ('127.0.0.1', 0), fmt=args.format, maxlen=65536)
+    server.start()
+
+    counts = [0] * args.subscribers
+
+    def consume(i):
+        for record in subscribe(server.address, args.format):
+            counts[i] += 1
+
+    for i in range(args.subscribers):
+        thread = threading.Thread(target=consume, args=(i,))
+        thread.daemon = True
+        thread.start()
+
+    while len(server.subscribers) < args.subscribers:
+        time.sleep(0.01)
+
+    record = {'timestamp': 0.0, 'device': 1, 'doa': 90, 'x': 1.0, 'y': 2.0, 'z': 0.5, 'confidence': 0.1}
+    start = time.time()
+    for i in range(args.records):
+        record['timestamp'] = start + i * 1e-4
+        server.publish(record)
+    publish_time = time.time() - start
+
+    deadline = time.time() + 30
+    while sum(counts) + server.dropped < args.records * args.subscribers and time.time() < deadline:
+        time.sleep(0.01)
+    elapsed = time.time() - start
+
+    sys.stdout.write("published {} records in {:.2f}s ({:.0f} records/s)\n".format(
+        args.records, publish_time, args.records / publish_time))
+    sys.stdout.write("delivered {} records to {} subscribers in {:.2f}s ({:.0f} records/s), {} dropped\n".format(
+        sum(counts), args.subscribers, elapsed, sum(counts) / elapsed, server.dropped))
+
+    server.stop()
+
+
+if __name__ == '__main__':
+    main()
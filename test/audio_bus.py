@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+
+"""
+Shared-memory audio bus, so several processes can consume one array
+
+Only one process can open the PyAudio input stream of an array. The capture
+daemon owns it and copies every block once into a ring of slots in
+multiprocessing.shared_memory; any number of local processes attach to the ring
+by name and read the slots in place.
+
+Ring layout, all little endian:
+
+    header   magic, rate, channels, block frames, slots, writer pid, head sequence
+    meta     one (sequence, frames, timestamp) entry per slot
+    data     (slots, block frames, channels) int16
+
+The writer marks a slot with sequence -1 while it fills it and publishes the
+new sequence number last. A reader knows which sequence it expects next: if the
+head is more than a ring ahead, or the slot no longer holds that sequence, the
+reader has been lapped and counts the lost blocks as overruns. Views returned by
+read() point into shared memory, so a reader holding one for a while can check
+valid(seq) afterwards.
+
+BusSource publishes each block as a BusFrame, a Frame-like view of the slot, so
+fanning out to any number of elements copies nothing. Elements working on the
+frame as it passes check frame.valid() after use; elements that queue it copy
+it on the way in (FrameQueue does), and BusSource(copy=True) publishes plain
+Frames for sinks that need bytes, e.g. FileSink.
+
+    python audio_bus.py                        # capture daemon, bus respeaker0
+    python audio_bus.py --device 3 --device 5  # respeaker0 and respeaker1
+    python audio_bus.py --read respeaker0      # print RMS and overruns
+    python rms.py respeaker0                   # RMS element on the bus
+"""
+
+import os
+import sys
+import time
+import threading
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+from voice_engine.element import Element
+from frame import Frame, FrameViews
+
+
+MAGIC = b'RSPBUS1\0'
+HEADER = np.dtype([('magic', 'S8'), ('rate', '<u4'), ('channels', '<u4'), ('block_frames', '<u4'),
+                   ('slots', '<u4'), ('pid', '<u4'), ('head', '<i8')])
+META = np.dtype([('seq', '<i8'), ('frames', '<u4'), ('reserved', '<u4'), ('timestamp', '<f8')])
+
+
+def _layout(buffer, channels, block_frames, slots):
+    header = np.ndarray((), dtype=HEADER, buffer=buffer)
+    meta = np.ndarray((slots,), dtype=META, buffer=buffer, offset=HEADER.itemsize)
+    data = np.ndarray((slots, block_frames, channels), dtype='int16', buffer=buffer,
+                      offset=HEADER.itemsize + slots * META.itemsize)
+    return header, meta, data
+
+
+def _writer_pid(buffer):
+    """
+    PID of the live writer of a ring, None if the segment is not a bus or its writer is gone
+    """
+    if len(buffer) < HEADER.itemsize:
+        return None
+    header = np.ndarray((), dtype=HEADER, buffer=buffer)
+    magic, pid = bytes(header['magic']), int(header['pid'])
+    del header
+    if magic != MAGIC or not pid:
+        return None
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return None
+    except PermissionError:
+        pass
+    return pid
+
+
+class BusWriter(Element):
+    def __init__(self, name, rate=16000, channels=6, block_frames=1024, slots=64):
+        """
+        Create the ring, a sink for the capture Source
+
+        Args:
+            name: shared memory name readers attach to
+            block_frames: frames per slot, larger blocks take several slots
+            slots: blocks kept, readers lagging more than this lose blocks
+        """
+        super(BusWriter, self).__init__()
+
+        self.name = name
+        self.channels = channels
+        self.block_frames = block_frames
+        self.slots = slots
+
+        size = HEADER.itemsize + slots * (META.itemsize + block_frames * channels * 2)
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # left behind by a writer that crashed, refuse to steal a live one
+            stale = shared_memory.SharedMemory(name=name)
+            try:
+                pid = _writer_pid(stale.buf)
+            finally:
+                stale.close()
+            if pid is not None:
+                # attaching registered it, this process must not unlink a live bus at exit
+                resource_tracker.unregister(stale._name, 'shared_memory')
+                raise RuntimeError('bus {} is written by process {}'.format(name, pid))
+            stale.unlink()
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self.header, self.meta, self.data = _layout(self.shm.buf, channels, block_frames, slots)
+        self.meta['seq'] = -1
+        self.header['head'] = -1
+        self.header['rate'] = rate
+        self.header['channels'] = channels
+        self.header['block_frames'] = block_frames
+        self.header['slots'] = slots
+        self.header['pid'] = os.getpid()
+        self.header['magic'] = MAGIC
+
+    def put(self, data, timestamp=None):
+        samples = np.frombuffer(data, dtype='int16').reshape(-1, self.channels)
+        if timestamp is None:
+            # capture time of a Frame, arrival time of plain bytes
+            timestamp = getattr(data, 'timestamp', None)
+            if timestamp is None:
+                timestamp = time.time()
+        head = int(self.header['head'])
+        for start in range(0, len(samples), self.block_frames):
+            block = samples[start:start + self.block_frames]
+            head += 1
+            slot = head % self.slots
+            meta = self.meta[slot]
+            meta['seq'] = -1
+            self.data[slot, :len(block)] = block
+            meta['frames'] = len(block)
+            meta['timestamp'] = timestamp
+            meta['seq'] = head
+            self.header['head'] = head
+
+        super(BusWriter, self).put(data)
+
+    def close(self):
+        del self.header, self.meta, self.data
+        self.shm.close()
+        self.shm.unlink()
+
+
+class BusReader:
+    def __init__(self, name, backlog=0):
+        """
+        Attach to a ring
+
+        Args:
+            name: shared memory name of the BusWriter
+            backlog: start this many blocks before the newest one instead of at the next block
+        """
+        # the writer owns the segment, this process' resource tracker must not unlink it at exit
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            self.shm = shared_memory.SharedMemory(name=name)
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+
+        header = np.ndarray((), dtype=HEADER, buffer=self.shm.buf)
+        if header['magic'] != MAGIC:
+            raise ValueError('{} is not an audio bus'.format(name))
+
+        self.rate = int(header['rate'])
+        self.channels = int(header['channels'])
+        self.block_frames = int(header['block_frames'])
+        self.slots = int(header['slots'])
+        self.header, self.meta, self.data = _layout(self.shm.buf, self.channels, self.block_frames, self.slots)
+
+        self.next = int(self.header['head']) + 1 - min(backlog, self.slots - 1)
+        self.next = max(self.next, 0)
+        self.overruns = 0
+        self.poll_interval = self.block_frames / float(self.rate) / 4
+
+    def read(self, timeout=None):
+        """
+        Next block as a (frames, channels) int16 view of the shared memory
+
+        Returns:
+            (seq, timestamp, view), or None on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            head = int(self.header['head'])
+            if head < self.next:
+                if deadline is not None and time.monotonic() >= deadline:
+                    return None
+                time.sleep(self.poll_interval)
+                continue
+
+            oldest = head - self.slots + 1
+            if self.next < oldest:
+                self.overruns += oldest - self.next
+                self.next = oldest
+
+            seq = self.next
+            meta = self.meta[seq % self.slots]
+            frames, timestamp = int(meta['frames']), float(meta['timestamp'])
+            if meta['seq'] != seq:
+                # lapped while looking at it
+                self.overruns += 1
+                self.next += 1
+                continue
+
+            self.next += 1
+            return seq, timestamp, self.data[seq % self.slots, :frames]
+
+    def valid(self, seq):
+        """
+        Whether the view of block seq still holds that block
+        """
+        return self.meta[seq % self.slots]['seq'] == seq
+
+    @property
+    def lag(self):
+        """
+        Blocks written but not read yet
+        """
+        return int(self.header['head']) + 1 - self.next
+
+    def close(self):
+        del self.header, self.meta, self.data
+        self.shm.close()
+
+
+class BusFrame(FrameViews):
+    """
+    Block of a bus whose samples are a read-only view of its slot, valid until the writer laps it
+    """
+    shared = True
+
+    def __init__(self, reader, seq, view, timestamp):
+        self.reader = reader
+        self.seq = seq
+        self.channels = reader.channels
+        self.rate = reader.rate
+        self.timestamp = timestamp
+        view = view.view()
+        view.setflags(write=False)
+        self._cache = {'samples': view}
+
+    def __len__(self):
+        return self._cache['samples'].nbytes
+
+    def valid(self):
+        """
+        Whether the slot still holds this block, check after using the samples
+        """
+        return self.reader.valid(self.seq)
+
+    def copy(self):
+        """
+        Frame with its own bytes, None if the block was lapped before it was copied
+        """
+        frame = Frame(self.samples.tobytes(), self.channels, self.rate, self.timestamp)
+        if not self.valid():
+            self.reader.overruns += 1
+            return None
+        return frame
+
+
+class BusSource(Element):
+    def __init__(self, name, backlog=0, copy=False):
+        """
+        Pipeline source publishing the blocks of a bus
+
+        Args:
+            copy: publish Frames with their own bytes instead of BusFrames
+        """
+        super(BusSource, self).__init__()
+
+        self.reader = BusReader(name, backlog)
+        self.copy = copy
+        self.rate = self.reader.rate
+        self.channels = self.reader.channels
+        self.done = True
+        self.thread = None
+
+    @property
+    def overruns(self):
+        return self.reader.overruns
+
+    def start(self):
+        self.done = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.done = True
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        while not self.done:
+            block = self.reader.read(timeout=0.1)
+            if block is None:
+                continue
+
+            seq, timestamp, view = block
+            frame = BusFrame(self.reader, seq, view, timestamp)
+            if self.copy:
+                frame = frame.copy()
+                if frame is None:
+                    continue
+
+            super(BusSource, self).put(frame)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Publish ReSpeaker captures on shared memory, or read one')
+    parser.add_argument('--device', type=int, action='append', help='input device index, repeat for several arrays')
+    parser.add_argument('--name', default='respeaker', help='bus name prefix, the array number is appended')
+    parser.add_argument('--frames', type=int, default=1024, help='frames per block')
+    parser.add_argument('--slots', type=int, default=64, help='blocks kept in each ring')
+    parser.add_argument('--read', metavar='BUS', help='attach to a bus and print the RMS of each block')
+    args = parser.parse_args()
+
+    if args.read:
+        reader = BusReader(args.read)
+        try:
+            while True:
+                seq, timestamp, view = reader.read()
+                rms = np.sqrt(np.mean(np.square(view[:, 1:5].astype(np.float32)), axis=0))
+                print('{} {:.3f} rms {} overruns {}'.format(seq, timestamp, np.round(rms).tolist(), reader.overruns))
+        except KeyboardInterrupt:
+            pass
+        reader.close()
+        return
+
+    from rms import Source
+
+    devices = args.device or [None]
+    sources, writers = [], []
+    for i, index in enumerate(devices):
+        src = Source(frames_size=args.frames, device_index=index)
+        writer = BusWriter('{}{}'.format(args.name, i), src.rate, src.channels, args.frames, args.slots)
+        src.pipeline(writer)
+        sources.append(src)
+        writers.append(writer)
+        print('* array {} on bus {}'.format(i, writer.name))
+
+    for src in sources:
+        src.pipeline_start()
+
+    while True:
+        try:
+            time.sleep(1)
+        except KeyboardInterrupt:
+            break
+
+    for src in sources:
+        src.pipeline_stop()
+    for writer in writers:
+        writer.close()
+
+
+if __name__ == '__main__':
+    main()
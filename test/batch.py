@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+
+"""
+Batch processing of directories of recordings on a process pool
+
+    python batch.py recordings/ --chain rms,doa,kws,locate -o results.npz
+
+Every WAV found is a recording, except that the arrays of one capture
+(<name>_array1.wav, <name>_array2.wav, ... as written by scene_generator.py,
+see --group) form a single recording. Each recording runs through the chain:
+
+    rms     per channel RMS and peak in dBFS
+    doa     host DOA of every array: SRP-PHAT over the azimuth on the mic pairs
+            of odas.cfg, energy-weighted over the file, with its peak strength
+    kws     keywords spotted by the KWS decoder of kws.py on one channel,
+            resampled to 16 kHz if needed
+    locate  position triangulated from the DOA of the arrays (needs doa),
+            from --poses or the orthogonal arrays of the 3 arrays setup
+
+Recordings are spread over a process pool, each worker building the chain
+once. Results are appended to a JSON lines journal next to the output as they
+come in, so an interrupted batch resumes with the recordings left (a recording
+whose files changed runs again). At the end the journal is turned into one
+columnar .npz: one array per column, one row per recording, per-array columns
+padded with NaN to the largest number of arrays.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import wave
+import argparse
+import multiprocessing
+
+import numpy as np
+
+from frame import Frame
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from odas_config import load_geometry
+
+
+GROUP = r'(?P<key>.+)_array(?P<index>\d+)\.wav$'
+
+
+def read_wav(path):
+    wf = wave.open(path, 'rb')
+    try:
+        if wf.getsampwidth() != 2:
+            raise ValueError('{}: only 16 bit samples are supported'.format(path))
+        return Frame(wf.readframes(wf.getnframes()), wf.getnchannels(), wf.getframerate())
+    finally:
+        wf.close()
+
+
+class RMSStage:
+    name = 'rms'
+
+    def __call__(self, frame):
+        x = frame.float32 / 32768.0
+        with np.errstate(divide='ignore'):
+            return {'rms_db': 10 * np.log10(np.mean(x ** 2, axis=0)),
+                    'peak_db': 20 * np.log10(np.max(np.abs(x), axis=0))}
+
+
+class DOAStage:
+    name = 'doa'
+
+    def __init__(self, resolution=1.0, geometry=None):
+        """
+        Args:
+            resolution: azimuth step in degrees
+            geometry: ArrayGeometry, defaults to odas.cfg
+        """
+        geometry = geometry or load_geometry()
+        self.mics = geometry.channels
+        self.pairs = geometry.pairs
+        self.frame_size = geometry.frame_size
+        self.rate = geometry.rate
+
+        self.azimuths = np.arange(0.0, 360.0, resolution)
+        theta = np.radians(self.azimuths)
+        u = np.stack([np.cos(theta), np.sin(theta), np.zeros_like(theta)], axis=1)
+        # mic j hears a far-field source from u b.u/c earlier than mic i
+        tau = -(geometry.baselines @ u.T) / geometry.speed_of_sound
+        freqs = np.fft.rfftfreq(self.frame_size, 1.0 / self.rate)
+        self.steering = np.exp(2j * np.pi * freqs[:, None, None] * tau[None]).astype(np.complex64)
+
+    def __call__(self, frame):
+        if frame.rate != self.rate:
+            raise ValueError('doa needs {} Hz recordings, got {} Hz'.format(self.rate, frame.rate))
+        X = frame.spectrum(self.frame_size)[:, :, self.mics]
+        if not len(X):
+            return {'doa': np.nan, 'doa_strength': 0.0}
+
+        cross = X[:, :, self.pairs[:, 1]] * np.conj(X[:, :, self.pairs[:, 0]])
+        cross /= np.maximum(np.abs(cross), 1e-12)
+        power = np.real(np.einsum('fbp,bpg->fg', cross, self.steering))
+
+        # louder frames count more, silence barely
+        energy = np.sum(np.abs(X) ** 2, axis=(1, 2))
+        weights = energy / max(np.sum(energy), 1e-12)
+        srp = weights @ power / float(self.steering.shape[0] * self.steering.shape[1])
+        best = int(np.argmax(srp))
+        return {'doa': self.azimuths[best], 'doa_strength': float(srp[best])}
+
+
+class KWSStage:
+    name = 'kws'
+
+    def __init__(self, channel=0, chunk=1024):
+        from kws import create_decoder
+
+        self.decoder = create_decoder()
+        self.channel = channel
+        self.chunk = chunk
+
+    def __call__(self, frame):
+        samples = frame.channel(self.channel)
+        if frame.rate != 16000:
+            from resampler import PolyphaseResampler
+
+            # zeros flush the tail out of the filter, whose delay is dropped
+            resampler = PolyphaseResampler(frame.rate, 16000)
+            padded = np.concatenate([samples, np.zeros(resampler.span * resampler.down, dtype=samples.dtype)])
+            out = resampler.process(padded[:, None])[:, 0]
+            delay = int(round(resampler.delay))
+            out = out[delay:delay + int(len(samples) * resampler.up // resampler.down)]
+            samples = np.clip(np.rint(out), -32768, 32767).astype(np.int16)
+        data = np.ascontiguousarray(samples).tobytes()
+
+        keywords = []
+        self.decoder.start_utt()
+        for start in range(0, len(data), 2 * self.chunk):
+            self.decoder.process_raw(data[start:start + 2 * self.chunk], False, False)
+            hypothesis = self.decoder.hyp()
+            if hypothesis:
+                keywords.append('{}@{:.2f}'.format(hypothesis.hypstr.strip(), start / 2 / 16000.0))
+                self.decoder.end_utt()
+                self.decoder.start_utt()
+        self.decoder.end_utt()
+        return {'keywords': ';'.join(keywords), 'keyword_count': len(keywords)}
+
+
+class LocateStage:
+    name = 'locate'
+
+    def __init__(self, poses=None):
+        sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'experiment')))
+        from location_n_arrays import MultiArrayLocalizer
+
+        if poses:
+            with open(poses) as f:
+                self.localizer = MultiArrayLocalizer.from_poses(json.load(f), seed=0)
+        else:
+            self.localizer = MultiArrayLocalizer.orthogonal(seed=0)
+
+    def __call__(self, columns):
+        doa = np.asarray(columns['doa'], dtype=float)
+        if len(doa) != self.localizer.arrays:
+            # not a capture of the localizer's arrays, e.g. a lone recording
+            return {'position': np.full(self.localizer.dim, np.nan), 'residual': np.nan}
+        position, inliers, residual = self.localizer.triangulate(doa, np.asarray(columns['doa_strength']))
+        return {'position': position, 'residual': residual}
+
+
+STAGES = {'rms': RMSStage, 'doa': DOAStage, 'kws': KWSStage}
+
+
+def build_chain(names, options):
+    """
+    Per-file stages and the per-recording locate stage, if any
+    """
+    unknown = set(names) - set(STAGES) - {'locate'}
+    if unknown:
+        raise ValueError('unknown stages: {}'.format(', '.join(sorted(unknown))))
+    if 'locate' in names and 'doa' not in names:
+        raise ValueError('locate needs the doa stage')
+
+    stages = []
+    for name in names:
+        if name == 'kws':
+            stages.append(KWSStage(options.get('kws_channel', 0)))
+        elif name in STAGES:
+            stages.append(STAGES[name]())
+    locate = LocateStage(options.get('poses')) if 'locate' in names else None
+    return stages, locate
+
+
+def find_recordings(paths, group=GROUP):
+    """
+    (key, files) of every recording under paths, arrays of one capture grouped by the regex group
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in names if name.lower().endswith('.wav'))
+        else:
+            files.append(path)
+
+    pattern = re.compile(group) if group else None
+    recordings = {}
+    for path in sorted(set(files)):
+        match = pattern.search(path) if pattern else None
+        if match:
+            recordings.setdefault(match.group('key'), []).append((int(match.group('index')), path))
+        else:
+            recordings[path] = [(0, path)]
+    return [(key, [path for _, path in sorted(members)]) for key, members in sorted(recordings.items())]
+
+
+def stamp(files):
+    return [[os.path.getsize(path), os.path.getmtime(path)] for path in files]
+
+
+_chain = None
+
+
+def _init(names, options):
+    global _chain
+    _chain = build_chain(names, options)
+
+
+def _process(job):
+    key, files = job
+    stages, locate = _chain
+    start = time.time()
+    entry = {'key': key, 'files': files, 'stamp': stamp(files), 'columns': {}, 'error': None}
+    try:
+        per_array = {}
+        duration = 0.0
+        for path in files:
+            frame = read_wav(path)
+            duration = max(duration, frame.frames / float(frame.rate))
+            per_array.setdefault('rate', []).append(frame.rate)
+            per_array.setdefault('channels', []).append(frame.channels)
+            for stage in stages:
+                for name, value in stage(frame).items():
+                    per_array.setdefault(name, []).append(value)
+
+        # per-array values, (arrays, ...) in every row, NaN-padded when the arrays differ in channels
+        columns = {name: _column(values) for name, values in per_array.items()}
+        if locate is not None:
+            columns.update(locate(per_array))
+        columns['duration'] = duration
+        for name, value in columns.items():
+            entry['columns'][name] = np.asarray(value).tolist() if not isinstance(value, str) else value
+    except Exception as e:
+        entry['error'] = '{}: {}'.format(type(e).__name__, e) if str(e) else repr(e)
+    entry['seconds'] = time.time() - start
+    return entry
+
+
+def load_journal(path):
+    entries = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the line an interrupted run was writing
+                    continue
+                entries[entry['key']] = entry
+    return entries
+
+
+def _column(values):
+    """
+    One array from the values of every row, None for rows without it
+    """
+    # text of several arrays, e.g. keywords, joins into one string per row
+    values = ['|'.join(v) if isinstance(v, list) and v and all(isinstance(x, str) for x in v) else v for v in values]
+    present = [v for v in values if v is not None]
+    if present and all(isinstance(v, str) for v in present):
+        return np.array(['' if v is None else v for v in values])
+
+    arrays = [None if v is None else np.asarray(v, dtype=float) for v in values]
+    ndim = max(a.ndim for a in arrays if a is not None)
+    arrays = [None if a is None else a.reshape((1,) * (ndim - a.ndim) + a.shape) for a in arrays]
+    shape = tuple(np.max([a.shape for a in arrays if a is not None], axis=0)) if ndim else ()
+    out = np.full((len(values),) + shape, np.nan)
+    for i, a in enumerate(arrays):
+        if a is not None:
+            out[(i,) + tuple(slice(0, n) for n in a.shape)] = a
+    return out
+
+
+def write_columns(path, entries):
+    names = sorted(set(name for entry in entries for name in entry['columns']))
+    columns = {name: _column([entry['columns'].get(name) for entry in entries]) for name in names}
+    columns['key'] = np.array([entry['key'] for entry in entries])
+    columns['files'] = np.array([';'.join(entry['files']) for entry in entries])
+    columns['error'] = np.array([entry['error'] or '' for entry in entries])
+    columns['seconds'] = np.array([entry.get('seconds', np.nan) for entry in entries])
+
+    # write then rename, a reader never sees a partial file
+    tmp = path + '.tmp.npz'
+    np.savez(tmp, **columns)
+    os.replace(tmp, path)
+    return columns
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a processing chain over directories of recordings')
+    parser.add_argument('paths', nargs='+', help='WAV files or directories searched recursively')
+    parser.add_argument('-c', '--chain', default='rms,doa', help='comma separated stages: rms, doa, kws, locate')
+    parser.add_argument('-o', '--output', default='results.npz', help='columnar output, the journal is OUTPUT.jsonl')
+    parser.add_argument('-w', '--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--group', default=GROUP, help='regex with key and index groups joining the arrays of a capture, '
+                                                        'empty for one file per recording')
+    parser.add_argument('--poses', default=None, help='JSON array poses for locate, see location_n_arrays.py')
+    parser.add_argument('--kws-channel', type=int, default=0)
+    parser.add_argument('--restart', action='store_true', help='ignore the journal of a previous run')
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.chain.split(',') if name.strip()]
+    options = {'poses': args.poses, 'kws_channel': args.kws_channel}
+    # fail here rather than in every worker
+    try:
+        build_chain(names, options)
+    except (ValueError, ImportError) as e:
+        parser.error(str(e))
+
+    recordings = find_recordings(args.paths, args.group)
+    journal = os.path.splitext(args.output)[0] + '.jsonl'
+    if args.restart and os.path.exists(journal):
+        os.remove(journal)
+    done = load_journal(journal)
+    pending = [(key, files) for key, files in recordings
+               if key not in done or done[key]['files'] != files or done[key]['stamp'] != stamp(files)]
+    print('{} recordings, {} done by a previous run, {} to process with {} workers'.format(
+        len(recordings), len(recordings) - len(pending), len(pending), args.workers))
+
+    start = time.time()
+    audio = 0.0
+    errors = 0
+    pool = multiprocessing.Pool(args.workers, _init, (names, options))
+    try:
+        with open(journal, 'a') as f:
+            for i, entry in enumerate(pool.imap_unordered(_process, pending)):
+                f.write(json.dumps(entry) + '\n')
+                f.flush()
+                done[entry['key']] = entry
+                audio += entry['columns'].get('duration', 0.0)
+                if entry['error']:
+                    errors += 1
+                    print('{}: {}'.format(entry['key'], entry['error']))
+                if (i + 1) % 100 == 0:
+                    elapsed = time.time() - start
+                    print('{} / {} recordings, {:.1f} per second'.format(i + 1, len(pending), (i + 1) / elapsed))
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        print('interrupted, run again to resume')
+        return
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    elapsed = time.time() - start
+    columns = write_columns(args.output, [done[key] for key, _ in recordings])
+    print('{} recordings in {:.1f}s: {:.1f} recordings/s, {:.0f}x real time, {} errors'.format(
+        len(pending), elapsed, len(pending) / max(elapsed, 1e-9), audio / max(elapsed, 1e-9), errors))
+    print('{}: {}'.format(args.output, ', '.join('{} {}'.format(name, columns[name].shape) for name in sorted(columns))))
+
+
+if __name__ == '__main__':
+    main()
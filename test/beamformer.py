@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+
+"""
+Streaming STFT beamformer steered by the DOA
+
+Delay-and-sum or MVDR on the 4 raw channels of the 6 channels firmware, with
+50% overlap-add of sqrt-Hann frames (hopSize/frameSize of odas.cfg). The frame
+buffers are preallocated and reused, and the per-bin weights are cached: they
+are only recomputed when the steering direction moves by more than a threshold
+(or, for MVDR, every few hops as the noise covariance adapts). STFTBeamformer
+processes several arrays in one vectorized pass; Beamformer wraps one array as
+a pipeline element whose mono output can feed KWS or a FileSink.
+"""
+
+import os
+import sys
+import threading
+
+import numpy as np
+
+from voice_engine.element import Element
+from frame import Frame, FrameQueue
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from odas_config import load_geometry
+
+
+def unit_vector(azimuth, elevation=0.0):
+    azimuth = np.radians(azimuth)
+    elevation = np.radians(elevation)
+    return np.stack([np.cos(elevation) * np.cos(azimuth),
+                     np.cos(elevation) * np.sin(azimuth),
+                     np.sin(elevation) * np.ones_like(azimuth)], axis=-1)
+
+
+class STFTBeamformer:
+    def __init__(self, arrays=1, mode='ds', geometry=None, threshold=5.0,
+                 alpha=0.98, loading=1e-3, mvdr_update=16):
+        """
+        Args:
+            arrays: arrays processed together
+            mode: 'ds' for delay-and-sum, 'mvdr' for minimum variance distortionless response
+            geometry: ArrayGeometry, defaults to odas.cfg
+            threshold: steering changes below this many degrees keep the cached weights
+            alpha: forgetting factor of the MVDR covariance
+            loading: diagonal loading of the MVDR covariance, relative to its trace
+            mvdr_update: hops between MVDR weight updates
+        """
+        if mode not in ('ds', 'mvdr'):
+            raise ValueError('unknown mode {}'.format(mode))
+
+        geometry = geometry or load_geometry()
+        self.geometry = geometry
+        self.arrays = arrays
+        self.mode = mode
+        self.threshold = np.cos(np.radians(threshold))
+        self.alpha = alpha
+        self.loading = loading
+        self.mvdr_update = mvdr_update
+
+        self.frame_size = N = geometry.frame_size
+        self.hop = H = geometry.hop_size
+        if 2 * H != N:
+            raise ValueError('overlap-add needs hopSize = frameSize / 2')
+        M = len(geometry.mics)
+        self.bins = N // 2 + 1
+        # bins beamformed, the rest is left out when shedding load
+        self.band = self.bins
+        self.freqs = np.fft.rfftfreq(N, 1.0 / geometry.rate)
+        self.window = np.sqrt(0.5 - 0.5 * np.cos(2 * np.pi * np.arange(N) / N)).astype(np.float32)
+
+        # reused buffers: the tail of the previous input and the overlap of the previous output
+        self.history = np.zeros((arrays, N - H, M), dtype=np.float32)
+        self.overlap = np.zeros((arrays, H), dtype=np.float32)
+        self.frames = np.zeros((arrays, 0, N, M), dtype=np.float32)
+
+        self.direction = np.full((arrays, 3), np.nan)
+        self.steering = np.zeros((arrays, self.bins, M), dtype=np.complex64)
+        self.weights = np.zeros((arrays, self.bins, M), dtype=np.complex64)
+        self.covariance = np.tile(np.eye(M, dtype=np.complex64), (arrays, self.bins, 1, 1))
+        self.hops = 0
+        self.updates = 0
+
+        self.steer(np.zeros(arrays))
+
+    def steer(self, azimuth, elevation=0.0):
+        """
+        Point every array to its azimuth (degrees, in the array plane)
+
+        Weights are only recomputed for arrays whose direction moved by more
+        than the threshold.
+        """
+        u = unit_vector(np.broadcast_to(azimuth, (self.arrays,)).astype(float),
+                        np.broadcast_to(elevation, (self.arrays,)).astype(float))
+        cos = np.sum(u * self.direction, axis=1)
+        moved = ~(cos >= self.threshold)
+        if not np.any(moved):
+            return
+
+        self.direction[moved] = u[moved]
+        # a mic at r hears a far-field source from u r.u/c earlier than the center
+        advance = (u[moved] @ self.geometry.mics.T) / self.geometry.speed_of_sound
+        self.steering[moved] = np.exp(2j * np.pi * self.freqs[None, :, None] * advance[:, None, :])
+        self._update_weights(np.flatnonzero(moved))
+
+    def set_mode(self, mode):
+        if mode not in ('ds', 'mvdr'):
+            raise ValueError('unknown mode {}'.format(mode))
+        if mode != self.mode:
+            self.mode = mode
+            self._update_weights(np.arange(self.arrays))
+
+    def set_band(self, max_freq=None):
+        """
+        Only beamform the bins up to max_freq Hz, None for all
+        """
+        self.band = self.bins if max_freq is None else int(np.searchsorted(self.freqs, max_freq, side='right'))
+
+    def _update_weights(self, arrays):
+        d = self.steering[arrays]
+        M = d.shape[-1]
+        if self.mode == 'ds':
+            self.weights[arrays] = d / M
+        else:
+            R = self.covariance[arrays]
+            trace = np.real(np.trace(R, axis1=-2, axis2=-1))[..., None, None]
+            R = R + self.loading * trace / M * np.eye(M)
+            Rd = np.linalg.solve(R, d[..., None])[..., 0]
+            self.weights[arrays] = Rd / np.sum(np.conj(d) * Rd, axis=-1, keepdims=True)
+        self.updates += len(arrays)
+
+    def process(self, block):
+        """
+        Beamform a block of samples
+
+        Args:
+            block: (arrays, n, M) float32 samples of the raw mics, n a multiple of the hop size
+
+        Returns:
+            (arrays, n) float32 beamformed samples, delayed by one hop
+        """
+        A, n, M = block.shape
+        N, H = self.frame_size, self.hop
+        F = n // H
+        if F * H != n:
+            raise ValueError('block length must be a multiple of {}'.format(H))
+
+        if self.frames.shape[1] != F:
+            self.frames = np.zeros((A, F, N, M), dtype=np.float32)
+
+        # frames k covers [history | block][k*H : k*H + N]
+        stream = np.concatenate([self.history, block], axis=1)
+        for k in range(2):
+            self.frames[:, :, k * H:(k + 1) * H] = stream[:, k * H:k * H + F * H].reshape(A, F, H, M)
+        self.history[...] = stream[:, -(N - H):]
+
+        self.frames *= self.window[None, None, :, None]
+        B = self.band
+        X = np.fft.rfft(self.frames, axis=2)[:, :, :B]
+
+        if self.mode == 'mvdr':
+            # block-averaged covariance, weights refreshed every mvdr_update hops
+            block_covariance = np.einsum('afbi,afbj->abij', X, np.conj(X)) / F
+            self.covariance[:, :B] = self.alpha * self.covariance[:, :B] + (1 - self.alpha) * block_covariance
+            self.hops += F
+            if self.hops >= self.mvdr_update:
+                self.hops = 0
+                self._update_weights(np.arange(A))
+
+        Y = np.zeros((A, F, self.bins), dtype=np.complex64)
+        Y[:, :, :B] = np.einsum('abm,afbm->afb', np.conj(self.weights[:, :B]), X)
+        y = np.fft.irfft(Y, N, axis=2).astype(np.float32) * self.window
+
+        out = np.empty((A, F, H), dtype=np.float32)
+        out[:, 0] = y[:, 0, :H] + self.overlap
+        out[:, 1:] = y[:, 1:, :H] + y[:, :-1, H:]
+        self.overlap[...] = y[:, -1, H:]
+        return out.reshape(A, n)
+
+
+class Beamformer(Element):
+    def __init__(self, mode='ds', channels=6, doa=None, direction=0.0, threshold=5.0):
+        """
+        Args:
+            mode: 'ds' or 'mvdr'
+            channels: channels of the interleaved input
+            doa: optional callable returning the current azimuth, e.g.
+                lambda: watcher.value('DOAANGLE') with a TuningWatcher
+            direction: initial azimuth in degrees
+            threshold: steering changes below this many degrees keep the cached weights
+        """
+        super(Beamformer, self).__init__()
+
+        self.channels = channels
+        self.doa = doa
+        self.mode = mode
+        self.core = STFTBeamformer(1, mode, threshold=threshold)
+        # load shedding steps of scheduler.py
+        self.quality_levels = (('mvdr',) if mode == 'mvdr' else ()) + ('ds', 'ds below 4 kHz')
+        self.mics = self.core.geometry.channels
+        self.core.steer(direction)
+        self.pending = np.zeros((0, len(self.mics)), dtype=np.float32)
+
+        self.queue = FrameQueue()
+        self.done = True
+
+    def set_direction(self, azimuth):
+        self.core.steer(azimuth)
+
+    def set_quality(self, level):
+        name = self.quality_levels[level]
+        self.core.set_mode('mvdr' if name == 'mvdr' else 'ds')
+        self.core.set_band(4000.0 if name == 'ds below 4 kHz' else None)
+
+    def put(self, data):
+        self.queue.put(data)
+
+    def start(self):
+        self.done = False
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.done = True
+
+    def run(self):
+        H = self.core.hop
+        while not self.done:
+            frame = Frame.wrap(self.queue.get(), self.channels)
+
+            if self.doa is not None:
+                azimuth = self.doa()
+                if azimuth is not None:
+                    self.core.steer(azimuth)
+
+            self.pending = np.concatenate([self.pending, frame.float32[:, self.mics]])
+            n = len(self.pending) // H * H
+            if not n:
+                continue
+
+            out = self.core.process(self.pending[None, :n])[0]
+            self.pending = self.pending[n:]
+
+            super(Beamformer, self).put(np.clip(out, -32768, 32767).astype('int16').tobytes())
+
+
+def benchmark(arrays=4, seconds=10.0, mode='mvdr'):
+    import time
+
+    core = STFTBeamformer(arrays, mode)
+    rate = core.geometry.rate
+    block = 1024
+    data = np.random.default_rng(0).standard_normal((arrays, block, len(core.geometry.mics))).astype(np.float32)
+
+    blocks = int(seconds * rate / block)
+    start = time.time()
+    for i in range(blocks):
+        core.steer(np.full(arrays, (i * 0.5) % 360))
+        core.process(data)
+    elapsed = time.time() - start
+    print('{} {} arrays, {:.0f}s of audio in {:.2f}s: {:.1f}x real time, {} weight updates'.format(
+        mode, arrays, seconds, elapsed, seconds / elapsed, core.updates))
+
+
+def main():
+    import time
+    import datetime
+
+    if len(sys.argv) > 1 and sys.argv[1] == '--bench':
+        for mode in ('ds', 'mvdr'):
+            for arrays in (1, 4, 8):
+                benchmark(arrays, mode=mode)
+        return
+
+    from voice_engine.file_sink import FileSink
+    from rms import Source
+
+    src = Source(frames_size=1600)
+    beamformer = Beamformer(mode='mvdr', direction=float(sys.argv[1]) if len(sys.argv) > 1 else 0.0)
+
+    filename = 'beamformed.' + datetime.datetime.now().strftime("%Y%m%d.%H:%M:%S") + '.wav'
+    sink = FileSink(filename, channels=1, rate=src.rate)
+
+    src.pipeline(beamformer, sink)
+
+    src.pipeline_start()
+
+    while True:
+        try:
+            time.sleep(1)
+        except KeyboardInterrupt:
+            break
+
+    src.pipeline_stop()
+
+
+if __name__ == '__main__':
+    main()
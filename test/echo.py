@@ -1,11 +1,8 @@
 
 
 import threading
+import time
 import sys
-if sys.version_info[0] < 3:
-    import Queue as queue
-else:
-    import queue
 
 import numpy as np
 import audioop
@@ -13,6 +10,7 @@ import pyaudio
 
 from voice_engine.element import Element
 from voice_engine.file_sink import FileSink
+from frame import Frame, FrameQueue
 from kws import KWS
 from player import Player
 
@@ -52,7 +50,8 @@ class Source(Element):
         )
 
     def _callback(self, in_data, frame_count, time_info, status):
-        super(Source, self).put(in_data)
+        # decoded once here, every element downstream shares the frame and its cached views
+        super(Source, self).put(Frame(in_data, self.channels, self.rate, time.time()))
 
         return None, pyaudio.paContinue
 
@@ -64,11 +63,16 @@ class Source(Element):
 
 
 class Route(Element):
+    # load shedding steps of scheduler.py, fewer channels fed to the keyword spotters
+    quality_levels = ('all channels', 'raw mics', 'processed channel')
+    routes = ([0, 1, 2, 3, 4, 5], [1, 2, 3, 4], [0])
+
     def __init__(self):
         super(Route, self).__init__()
 
         self.channels = 6
         self.detect_mask = 0
+        self.active = self.routes[0]
 
         self.kws_list = []
         for ch in range(self.channels):
@@ -84,7 +88,7 @@ class Route(Element):
             kws.on_detected = callback_gen(ch)
             kws.start()
 
-        self.queue = queue.Queue()
+        self.queue = FrameQueue()
         self.done = True
 
     def put(self, data):
@@ -102,19 +106,18 @@ class Route(Element):
         for ch in range(self.channels):
             self.kws_list[ch].stop()
 
+    def set_quality(self, level):
+        self.active = self.routes[level]
+
     def on_data(self, data):
         pass
 
     def run(self):
         while not self.done:
-            data = self.queue.get()
-            data = np.fromstring(data, dtype='int16')
-
-            rms_data = []
-            rms_data_db = []
-            for ch in range(self.channels):
-                mono = data[ch::self.channels]
-                self.kws_list[ch].put(mono.tostring())
+            frame = Frame.wrap(self.queue.get(), self.channels)
+
+            for ch in self.active:
+                self.kws_list[ch].put(frame.channel_bytes(ch))
 
 
 def main():
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+"""
+Decoded audio block shared by every element of a pipeline
+
+Source publishes each block once as a Frame. A Frame is still the raw bytes, so
+FileSink, KWS and anything else expecting bytes keep working, but consumers
+that need samples use its views instead of decoding again:
+
+    frame.samples           (n, channels) int16 view of the bytes, no copy
+    frame.channel(1)        strided int16 view of one channel, no copy
+    frame.channel_bytes(1)  contiguous bytes of one channel, e.g. for KWS
+    frame.float32           (n, channels) float32 samples
+    frame.spectrum(256)     Hann windowed rfft of the channels
+
+Everything but the views is computed on first use and cached on the frame, so
+a second consumer asking for the same representation gets it for free. Cached
+arrays are read-only since they are shared between threads.
+
+FrameViews holds these views for Frame and for audio_bus.BusFrame, a frame
+whose samples stay in the shared memory ring of the bus instead of being copied.
+
+FrameQueue is the input queue of elements that LoadScheduler (scheduler.py)
+watches: it knows the capture time of its oldest frame and its backlog in bytes.
+It copies shared frames on the way in, since their slot is reused later.
+"""
+
+import sys
+import collections
+
+if sys.version_info[0] < 3:
+    import Queue as queue
+else:
+    import queue
+
+import numpy as np
+
+
+class FrameViews(object):
+    """
+    Sample views and cached representations of a block, given len(), channels and _cache
+    """
+    # whether the samples live in a buffer that gets reused, see FrameQueue
+    shared = False
+
+    @property
+    def frames(self):
+        return len(self) // (2 * self.channels)
+
+    @property
+    def samples(self):
+        samples = self._cache.get('samples')
+        if samples is None:
+            samples = np.frombuffer(self, dtype='int16').reshape(-1, self.channels)
+            self._cache['samples'] = samples
+        return samples
+
+    def channel(self, ch):
+        return self.samples[:, ch]
+
+    def channel_bytes(self, ch):
+        key = ('bytes', ch)
+        data = self._cache.get(key)
+        if data is None:
+            data = np.ascontiguousarray(self.channel(ch)).tobytes()
+            self._cache[key] = data
+        return data
+
+    @property
+    def float32(self):
+        """
+        Samples as float32, in int16 units
+        """
+        data = self._cache.get('float32')
+        if data is None:
+            data = self.samples.astype(np.float32)
+            data.setflags(write=False)
+            self._cache['float32'] = data
+        return data
+
+    def spectrum(self, frame_size=None, hop_size=None):
+        """
+        Hann windowed rfft of every channel
+
+        Args:
+            frame_size: FFT length, defaults to the whole block
+            hop_size: step between FFT frames, defaults to frame_size
+
+        Returns:
+            (frames, frame_size // 2 + 1, channels) complex64 array
+        """
+        frame_size = frame_size or self.frames
+        hop_size = hop_size or frame_size
+        key = ('spectrum', frame_size, hop_size)
+        spectrum = self._cache.get(key)
+        if spectrum is None:
+            count = max(0, (self.frames - frame_size) // hop_size + 1)
+            strides = self.float32.strides
+            frames = np.lib.stride_tricks.as_strided(
+                self.float32, (count, frame_size, self.channels), (hop_size * strides[0],) + strides,
+                writeable=False)
+            window = np.hanning(frame_size).astype(np.float32)
+            spectrum = np.fft.rfft(frames * window[None, :, None], axis=1).astype(np.complex64)
+            spectrum.setflags(write=False)
+            self._cache[key] = spectrum
+        return spectrum
+
+
+class Frame(FrameViews, bytes):
+    def __new__(cls, data, channels=6, rate=16000, timestamp=None):
+        frame = super(Frame, cls).__new__(cls, data)
+        frame.channels = channels
+        frame.rate = rate
+        frame.timestamp = timestamp
+        frame._cache = {}
+        return frame
+
+    @classmethod
+    def wrap(cls, data, channels=6, rate=16000):
+        """
+        Return data as a Frame, without copying if it is one already (or a BusFrame)
+        """
+        if isinstance(data, FrameViews):
+            return data
+        return cls(data, channels, rate)
+
+
+class FrameQueue(queue.Queue):
+    """
+    Queue of frames keeping the timestamp and size of every queued frame
+    """
+    def put(self, item, block=True, timeout=None):
+        if getattr(item, 'shared', False):
+            # the element keeps the frame past the reuse of its slot, so it gets its own bytes
+            item = item.copy()
+            if item is None:
+                return
+        queue.Queue.put(self, item, block, timeout)
+
+    def _init(self, maxsize):
+        queue.Queue._init(self, maxsize)
+        # filled and emptied by _put and _get, which run under the queue's lock
+        self.stamps = collections.deque()
+        self.bytes = 0
+
+    def _put(self, item):
+        queue.Queue._put(self, item)
+        self.stamps.append((getattr(item, 'timestamp', None), len(item)))
+        self.bytes += len(item)
+
+    def _get(self):
+        _, size = self.stamps.popleft()
+        self.bytes -= size
+        return queue.Queue._get(self)
+
+    def oldest(self):
+        """
+        Capture time of the frame at the head, None when empty or not stamped
+        """
+        try:
+            return self.stamps[0][0]
+        except IndexError:
+            return None
@@ -15,6 +15,28 @@ except ImportError:
 from voice_engine.element import Element
 from pocketsphinx.pocketsphinx import Decoder
 
+
+def create_decoder():
+    """
+    Keyword spotting decoder on the keywords of pocketsphinx-data
+    """
+    pocketsphinx_data = os.path.join(os.path.dirname(__file__), 'pocketsphinx-data')
+    hmm = os.path.join(pocketsphinx_data, 'hmm')
+    dic = os.path.join(pocketsphinx_data, 'dictionary.txt')
+    kws_list = os.path.join(pocketsphinx_data, 'keywords.txt')
+
+    config = Decoder.default_config()
+    config.set_string('-hmm', hmm)
+    config.set_string('-dict', dic)
+    config.set_string('-kws', kws_list)
+    # config.set_int('-samprate', SAMPLE_RATE) # uncomment if rate is not 16000. use config.set_float() on ubuntu
+    config.set_int('-nfft', 512)
+    config.set_float('-vad_threshold', 2.7)
+    config.set_string('-logfn', os.devnull)
+
+    return Decoder(config)
+
+
 class KWS(Element):
     def __init__(self):
         super(KWS, self).__init__()
@@ -39,21 +61,7 @@ class KWS(Element):
         self.on_detected = callback
 
     def run(self):
-        pocketsphinx_data = os.path.join(os.path.dirname(__file__), 'pocketsphinx-data')
-        hmm = os.path.join(pocketsphinx_data, 'hmm')
-        dic = os.path.join(pocketsphinx_data, 'dictionary.txt')
-        kws_list = os.path.join(pocketsphinx_data, 'keywords.txt')
-
-        config = Decoder.default_config()
-        config.set_string('-hmm', hmm)
-        config.set_string('-dict', dic)
-        config.set_string('-kws', kws_list)
-        # config.set_int('-samprate', SAMPLE_RATE) # uncomment if rate is not 16000. use config.set_float() on ubuntu
-        config.set_int('-nfft', 512)
-        config.set_float('-vad_threshold', 2.7)
-        config.set_string('-logfn', os.devnull)
-
-        decoder = Decoder(config)
+        decoder = create_decoder()
 
         decoder.start_utt()
 
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+"""
+Streaming polyphase resampler for mixing arrays captured at different rates
+
+record2local.py opens the device at its defaultSampleRate while everything in
+test/ expects 16 kHz, so a 48 kHz (or 44.1 kHz) array cannot join the other
+streams as is. Resampler converts by the rational ratio up/down closest to
+rate_out / rate_in:
+
+- one Kaiser-windowed sinc low-pass is designed per (up, down, zero crossings,
+  beta) and cached; its polyphase bank is laid out as a (up, span) matrix so
+  that every group of up output samples, which consumes down input samples, is
+  one matrix product with a strided view of the input
+- every channel (and every stream stacked as channels) goes through the same
+  product, so many 6 channel streams are converted in one pass
+- the last input samples the filter still needs are carried between blocks,
+  so blocked output matches resampling the whole signal at once
+
+The output is delayed by the filter, delay gives it in output samples.
+
+The fraction is limited to max_denominator, and a ratio it cannot represent
+within tolerance raises instead of being rounded to a nearby one. The bank
+holds up x (down + taps) coefficients, so a ratio like a 50 ppm clock drift
+(16000 -> 16000.8 Hz, 20001/20000) would take hundreds of millions of them:
+raising max_denominator only suits ratios of moderate terms, drift between
+array clocks is corrected by DriftCorrector in experiment/clock_sync.py.
+"""
+
+import sys
+import threading
+from fractions import Fraction
+
+import numpy as np
+
+from voice_engine.element import Element
+from frame import Frame, FrameQueue
+
+
+_banks = {}
+
+
+def polyphase_bank(up, down, zero_crossings=16, beta=8.0):
+    """
+    Cached (up, span) matrix of the low-pass filter and the span's first input offset
+
+    Output m = q * up + r is bank[r] dotted with input q * down + offset + [0, span).
+    """
+    key = (up, down, zero_crossings, beta)
+    cached = _banks.get(key)
+    if cached is not None:
+        return cached
+
+    # low-pass at the upsampled rate, cut at the lower of the two Nyquist frequencies
+    M = max(up, down)
+    length = 2 * zero_crossings * M + 1
+    n = np.arange(length) - (length - 1) / 2.0
+    h = np.sinc(n / M) * np.kaiser(length, beta) * (float(up) / M)
+
+    # output m sees input i through tap m * down - i * up
+    r = np.arange(up)
+    first = -((length - 1) // up)
+    last = ((up - 1) * down) // up
+    s = np.arange(first, last + 1)
+    taps = r[:, None] * down - s[None, :] * up
+    valid = (taps >= 0) & (taps < length)
+    bank = np.where(valid, h[np.clip(taps, 0, length - 1)], 0.0).astype(np.float32)
+
+    _banks[key] = bank, first
+    return bank, first
+
+
+class PolyphaseResampler:
+    def __init__(self, rate_in, rate_out, channels=1, zero_crossings=16, beta=8.0, max_denominator=1000,
+                 tolerance=1e-6):
+        """
+        Args:
+            rate_in, rate_out: sample rates, their ratio is approximated by a fraction
+            channels: channels converted together
+            zero_crossings: half length of the filter in zero crossings of the lower rate
+            beta: Kaiser window parameter, higher for more stop band attenuation
+            max_denominator: largest up or down factor of the fraction
+            tolerance: largest relative error of the approximated output rate
+        """
+        exact = Fraction(rate_out) / Fraction(rate_in)
+        ratio = exact.limit_denominator(max_denominator)
+        error = abs(float(ratio / exact) - 1.0)
+        if error > tolerance:
+            raise ValueError('{} -> {} Hz approximated by {}/{} is off by {:.1e}, raise max_denominator or '
+                             'correct clock drift with DriftCorrector'.format(
+                                 rate_in, rate_out, ratio.numerator, ratio.denominator, error))
+        self.up, self.down = ratio.numerator, ratio.denominator
+        self.rate_in = rate_in
+        self.rate_out = rate_in * self.up / float(self.down)
+        self.channels = channels
+        self.bank, self.first = polyphase_bank(self.up, self.down, zero_crossings, beta)
+        self.span = self.bank.shape[1]
+        self.delay = zero_crossings * max(self.up, self.down) / float(self.down)
+        self.reset()
+
+    def reset(self):
+        # history[0] is input sample start; zeros stand in for the samples before the stream
+        self.start = self.first
+        self.history = np.zeros((-self.first, self.channels), dtype=np.float32)
+        self.group = 0
+
+    def process(self, block):
+        """
+        Args:
+            block: (n, channels) input samples, any length
+
+        Returns:
+            (m, channels) float32 output samples completed by the block
+        """
+        block = np.asarray(block, dtype=np.float32).reshape(-1, self.channels)
+        buf = np.concatenate([self.history, block])
+        end = self.start + len(buf)
+
+        # group q needs inputs up to q * down + first + span - 1
+        count = (end - self.first - self.span) // self.down + 1 - self.group
+        if count <= 0:
+            self.history = buf
+            return np.zeros((0, self.channels), dtype=np.float32)
+
+        offset = self.group * self.down + self.first - self.start
+        strides = buf.strides
+        view = np.lib.stride_tricks.as_strided(
+            buf[offset:], (count, self.span, self.channels), (self.down * strides[0],) + strides, writeable=False)
+        out = np.matmul(self.bank, view).reshape(count * self.up, self.channels)
+
+        self.group += count
+        keep = self.group * self.down + self.first - self.start
+        self.history = buf[keep:]
+        self.start += keep
+        return out
+
+
+class Resampler(Element):
+    def __init__(self, rate_in, rate_out=16000, channels=6, **kwargs):
+        """
+        Args:
+            rate_in: rate of the incoming frames, e.g. the defaultSampleRate of the device
+            rate_out: rate of the published frames
+            channels: channels of the interleaved input
+            kwargs: PolyphaseResampler arguments
+        """
+        super(Resampler, self).__init__()
+
+        self.channels = channels
+        self.core = PolyphaseResampler(rate_in, rate_out, channels, **kwargs)
+        self.rate = int(round(self.core.rate_out))
+
+        self.queue = FrameQueue()
+        self.done = True
+
+    def put(self, data):
+        self.queue.put(data)
+
+    def start(self):
+        self.done = False
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.done = True
+
+    def run(self):
+        while not self.done:
+            frame = Frame.wrap(self.queue.get(), self.channels, self.core.rate_in)
+
+            out = self.core.process(frame.float32)
+            if not len(out):
+                continue
+
+            data = np.clip(np.rint(out), -32768, 32767).astype(np.int16).tobytes()
+            super(Resampler, self).put(Frame(data, self.channels, self.rate, getattr(frame, 'timestamp', None)))
+
+
+def benchmark(streams=8, seconds=10.0, block=1024):
+    import time
+
+    random = np.random.default_rng(0)
+    for rate_in, rate_out in ((48000, 16000), (44100, 16000), (16000, 48000), (16000, 16000 * 1.001)):
+        channels = streams * 6
+        resampler = PolyphaseResampler(rate_in, rate_out, channels)
+        data = random.standard_normal((int(seconds * rate_in), channels)).astype(np.float32)
+
+        start = time.time()
+        out = [resampler.process(data[i:i + block]) for i in range(0, len(data), block)]
+        elapsed = time.time() - start
+
+        # blocked output equals the whole signal at once
+        whole = PolyphaseResampler(rate_in, rate_out, channels).process(data)
+        blocked = np.concatenate(out)
+        error = np.max(np.abs(blocked - whole[:len(blocked)]))
+
+        # quality on a 1 kHz tone, away from the filter's start
+        t = np.arange(int(rate_in)) / float(rate_in)
+        tone = PolyphaseResampler(rate_in, rate_out).process(np.sin(2 * np.pi * 1000 * t)[:, None])[:, 0]
+        m = np.arange(len(tone))
+        ideal = np.sin(2 * np.pi * 1000 * (m - resampler.delay) / resampler.rate_out)
+        inner = slice(len(tone) // 4, 3 * len(tone) // 4)
+        snr = 10 * np.log10(np.sum(ideal[inner] ** 2) / np.sum((tone[inner] - ideal[inner]) ** 2))
+
+        print('{:>5} -> {:>7.0f} Hz ({}/{}, {} taps per phase): {} streams x 6 channels, {:.0f}s in {:.2f}s, '
+              '{:.0f}x real time, tone SNR {:.0f} dB, blocked vs whole {:.1e}'.format(
+                  rate_in, rate_out, resampler.up, resampler.down, np.count_nonzero(resampler.bank[0]),
+                  streams, seconds, elapsed, seconds / elapsed, snr, error))
+
+    # a ppm-scale drift is refused instead of collapsing to 1/1
+    try:
+        PolyphaseResampler(16000, 16000 * (1 + 50e-6))
+    except ValueError as e:
+        print('16000 -> 16000.8 Hz refused: {}'.format(e))
+
+
+def main():
+    import time
+
+    if len(sys.argv) > 1 and sys.argv[1] == '--bench':
+        benchmark()
+        return
+
+    from voice_engine.file_sink import FileSink
+    from rms import Source
+
+    # e.g. a 48 kHz array joining 16 kHz pipelines
+    rate_in = int(sys.argv[1]) if len(sys.argv) > 1 else 48000
+    src = Source(rate=rate_in, frames_size=rate_in // 10)
+    resampler = Resampler(rate_in, 16000, src.channels)
+    sink = FileSink('resampled.wav', channels=src.channels, rate=resampler.rate)
+
+    src.pipeline(resampler, sink)
+
+    src.pipeline_start()
+
+    while True:
+        try:
+            time.sleep(1)
+        except KeyboardInterrupt:
+            break
+
+    src.pipeline_stop()
+
+
+if __name__ == '__main__':
+    main()
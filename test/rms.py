@@ -1,11 +1,8 @@
 
 
 import threading
+import time
 import sys
-if sys.version_info[0] < 3:
-    import Queue as queue
-else:
-    import queue
 
 import numpy as np
 import audioop
@@ -13,10 +10,11 @@ import pyaudio
 
 from voice_engine.element import Element
 from voice_engine.file_sink import FileSink
+from frame import Frame, FrameQueue
 
 
 class Source(Element):
-    def __init__(self, rate=16000, frames_size=None):
+    def __init__(self, rate=16000, frames_size=None, device_index=None):
 
         super(Source, self).__init__()
 
@@ -26,14 +24,14 @@ class Source(Element):
 
         self.pyaudio_instance = pyaudio.PyAudio()
 
-        device_index = None
-        for i in range(self.pyaudio_instance.get_device_count()):
-            dev = self.pyaudio_instance.get_device_info_by_index(i)
-            name = dev['name'].encode('utf-8')
-            print('{}:{} with {} input channels'.format(i, name, dev['maxInputChannels']))
-            if name.find('ReSpeaker 4 Mic Array') >= 0 and dev['maxInputChannels'] == self.channels:
-                device_index = i
-                break
+        if device_index is None:
+            for i in range(self.pyaudio_instance.get_device_count()):
+                dev = self.pyaudio_instance.get_device_info_by_index(i)
+                name = dev['name'].encode('utf-8')
+                print('{}:{} with {} input channels'.format(i, name, dev['maxInputChannels']))
+                if name.find('ReSpeaker 4 Mic Array') >= 0 and dev['maxInputChannels'] == self.channels:
+                    device_index = i
+                    break
 
         if device_index is None:
             raise ValueError('Can not find an input device with {} channel(s)'.format(self.channels))
@@ -50,7 +48,8 @@ class Source(Element):
         )
 
     def _callback(self, in_data, frame_count, time_info, status):
-        super(Source, self).put(in_data)
+        # decoded once here, every element downstream shares the frame and its cached views
+        super(Source, self).put(Frame(in_data, self.channels, self.rate, time.time()))
 
         return None, pyaudio.paContinue
 
@@ -62,13 +61,18 @@ class Source(Element):
 
 
 class RMS(Element):
+    # load shedding steps of scheduler.py, the RMS of every n-th block
+    quality_levels = ('every block', 'every 2nd block', 'every 4th block')
+
     def __init__(self):
         super(RMS, self).__init__()
 
         self.channels = 6
         self.channels_mask = [1, 2, 3, 4]
+        self.step = 1
+        self.count = 0
 
-        self.queue = queue.Queue()
+        self.queue = FrameQueue()
         self.done = True
 
     def put(self, data):
@@ -83,35 +87,40 @@ class RMS(Element):
     def stop(self):
         self.done = True
 
+    def set_quality(self, level):
+        self.step = 1 << level
+
     def on_data(self, data):
         pass
 
     def run(self):
         while not self.done:
-            data = self.queue.get()
-            data = np.fromstring(data, dtype='int16')
-
-            rms_data = []
-            rms_data_db = []
-            for ch in self.channels_mask:
-                mono = data[ch::self.channels]
-                rms = np.sqrt(np.mean(np.square(mono.astype('int32'))))
-                rms_data.append(rms)
-                # rms = 20 * np.log10(rms)
-                # rms_data_db.append(rms)
-            
-            print(rms_data)
+            frame = Frame.wrap(self.queue.get(), self.channels)
 
-            # x = np.fromstring(data, dtype='int16')
+            self.count += 1
+            if self.count % self.step:
+                super(RMS, self).put(frame)
+                continue
+
+            mono = frame.float32[:, self.channels_mask]
+            rms_data = np.sqrt(np.mean(np.square(mono), axis=0)).tolist()
+            # rms_data_db = 20 * np.log10(rms_data)
+
+            print(rms_data)
 
-            super(RMS, self).put(data)
+            super(RMS, self).put(frame)
 
 
 def main():
     import time
     import datetime
 
-    src = Source(frames_size=1600)
+    if len(sys.argv) > 1:
+        # share the capture of audio_bus.py instead of opening the array
+        from audio_bus import BusSource
+        src = BusSource(sys.argv[1])
+    else:
+        src = Source(frames_size=1600)
     rms = RMS()
 
     # filename = '1.quiet.' + datetime.datetime.now().strftime("%Y%m%d.%H:%M:%S") + '.wav'
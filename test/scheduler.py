@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+
+"""
+Load shedding for pipeline elements: give up quality, not real time
+
+Every element reads its input from an unbounded queue, so on an overloaded box
+RMS, Route/KWS, the beamformer or a localizer silently fall further and further
+behind the audio. LoadScheduler watches the lag of every registered stage
+against the audio clock and moves the stage along its quality ladder. The lag
+is the age of the frame at the head of a FrameQueue (Source stamps every Frame
+with its capture time; for plain bytes the backlog is converted to audio time),
+the backlog of a plain queue in blocks, or the lag attribute of stages without
+a queue, which the localizers set to the age of the audio of their last result:
+
+- lag above high for patience checks in a row: one step down
+- lag below low for recover seconds: one step back up
+- at least cooldown seconds between two steps of a stage, so a step has time
+  to show its effect
+- lag above max_lag on the lowest step: the oldest frames are dropped, so the
+  latency stays bounded whatever the load
+
+A stage is any element with a queue or a lag, quality_levels (names, best
+first) and set_quality(level); RMS (skips blocks), Route (fewer KWS channels),
+Beamformer (MVDR to delay-and-sum to fewer bins), SRPLocalizer (fewer
+candidates, no refinement, coarse grid) and TDOAEngine (larger hop) have them.
+Every transition is logged and kept in transitions.
+"""
+
+import sys
+import time
+import logging
+import threading
+import collections
+
+if sys.version_info[0] < 3:
+    import Queue as queue
+else:
+    import queue
+
+import numpy as np
+
+from voice_engine.element import Element
+from frame import Frame, FrameQueue
+
+
+logger = logging.getLogger(__name__)
+
+Transition = collections.namedtuple('Transition', ['time', 'stage', 'old', 'new', 'lag'])
+
+
+class Stage:
+    def __init__(self, element, name, rate, channels, block):
+        self.element = element
+        self.name = name
+        self.rate = rate
+        self.channels = channels
+        self.block = block
+        self.level = 0
+        self.over = 0
+        self.calm_since = None
+        self.changed = 0.0
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.dropped = 0
+
+
+class LoadScheduler:
+    def __init__(self, period=0.1, high=0.25, low=0.05, patience=3, recover=3.0, cooldown=1.0, max_lag=1.0):
+        """
+        Args:
+            period: seconds between checks
+            high: lag in seconds that steps a stage down
+            low: lag below which a stage may step back up
+            patience: checks in a row above high before stepping down
+            recover: seconds below low before stepping up
+            cooldown: seconds between two steps of a stage
+            max_lag: frames older than this are dropped once a stage is at its lowest quality
+        """
+        self.period = period
+        self.high = high
+        self.low = low
+        self.patience = patience
+        self.recover = recover
+        self.cooldown = cooldown
+        self.max_lag = max_lag
+        self.stages = []
+        self.transitions = []
+        self.done = True
+        self.thread = None
+
+    def register(self, element, name=None, rate=16000, channels=None, block=1024):
+        """
+        Watch an element, rate and channels convert a backlog of plain bytes into seconds
+
+        block is the samples per queued item of an element with a plain queue.
+        """
+        if not hasattr(element, 'set_quality') or not getattr(element, 'quality_levels', None):
+            raise ValueError('{} has no quality levels'.format(type(element).__name__))
+        channels = channels or getattr(element, 'channels', 1)
+        stage = Stage(element, name or type(element).__name__, rate, channels, block)
+        self.stages.append(stage)
+        return stage
+
+    def lag(self, stage, now):
+        """
+        Age of the oldest frame waiting for the stage
+        """
+        pending = getattr(stage.element, 'queue', None)
+        if pending is None:
+            return float(getattr(stage.element, 'lag', 0.0))
+        if not isinstance(pending, FrameQueue):
+            return pending.qsize() * stage.block / float(stage.rate)
+        timestamp = pending.oldest()
+        if timestamp is not None:
+            return now - timestamp
+        return pending.bytes / (2.0 * stage.channels * stage.rate)
+
+    def _set(self, stage, level, lag, now):
+        transition = Transition(now, stage.name, stage.level, level, lag)
+        stage.element.set_quality(level)
+        stage.level = level
+        stage.changed = now
+        stage.over = 0
+        stage.calm_since = None
+        self.transitions.append(transition)
+        levels = stage.element.quality_levels
+        logger.info('%s: %s -> %s, lag %.0f ms', stage.name, levels[transition.old], levels[level], lag * 1000)
+
+    def _shed(self, stage, now):
+        """
+        Drop the frames older than max_lag from the queue of the stage
+        """
+        pending = stage.element.queue
+        if isinstance(pending, FrameQueue):
+            def stale():
+                timestamp = pending.oldest()
+                return timestamp is not None and now - timestamp > self.max_lag
+        else:
+            def stale():
+                return pending.qsize() * stage.block > self.max_lag * stage.rate
+
+        dropped = 0
+        while stale():
+            try:
+                pending.get_nowait()
+            except queue.Empty:
+                break
+            dropped += 1
+        if dropped:
+            stage.dropped += dropped
+            logger.warning('%s: dropped %d frames older than %.1f s', stage.name, dropped, self.max_lag)
+
+    def check(self, now=None):
+        """
+        One pass over every stage, called every period by the scheduler thread
+        """
+        now = time.time() if now is None else now
+        for stage in self.stages:
+            lag = self.lag(stage, now)
+            stage.lag = lag
+            stage.max_lag = max(stage.max_lag, lag)
+            lowest = len(stage.element.quality_levels) - 1
+
+            stage.over = stage.over + 1 if lag > self.high else 0
+            if lag < self.low:
+                stage.calm_since = now if stage.calm_since is None else stage.calm_since
+            else:
+                stage.calm_since = None
+
+            settled = now - stage.changed >= self.cooldown
+            if stage.over >= self.patience and stage.level < lowest and settled:
+                self._set(stage, stage.level + 1, lag, now)
+            elif (stage.calm_since is not None and now - stage.calm_since >= self.recover
+                  and stage.level > 0 and settled):
+                self._set(stage, stage.level - 1, lag, now)
+            elif lag > self.max_lag and stage.level == lowest and hasattr(stage.element, 'queue'):
+                self._shed(stage, now)
+
+    def start(self):
+        self.done = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.done = True
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        while not self.done:
+            self.check()
+            time.sleep(self.period)
+
+    def stats(self):
+        return {stage.name: {'level': stage.level, 'lag': stage.lag, 'max_lag': stage.max_lag,
+                             'dropped': stage.dropped} for stage in self.stages}
+
+
+class SyntheticLoad(Element):
+    """
+    Stage whose cost per block halves with every quality step, times a load factor
+    """
+    quality_levels = ('full', 'half', 'quarter')
+
+    def __init__(self, cost):
+        super(SyntheticLoad, self).__init__()
+        self.cost = cost
+        self.factor = 1.0
+        self.level = 0
+        self.lags = []
+        self.queue = FrameQueue()
+        self.done = True
+
+    def set_quality(self, level):
+        self.level = level
+
+    def put(self, data):
+        self.queue.put(data)
+
+    def start(self):
+        self.done = False
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.done = True
+
+    def run(self):
+        while not self.done:
+            try:
+                frame = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            time.sleep(self.cost * self.factor / (1 << self.level))
+            self.lags.append((time.time(), time.time() - frame.timestamp, self.level))
+            super(SyntheticLoad, self).put(frame)
+
+
+def simulate(scheduled, seconds=12.0, block=1024, rate=16000, cost=0.04, overload=3.0):
+    """
+    Feed real-time blocks through a SyntheticLoad that gets overloaded for the middle third
+    """
+    stage = SyntheticLoad(cost)
+    scheduler = LoadScheduler()
+    if scheduled:
+        scheduler.register(stage, 'synthetic', rate)
+        scheduler.start()
+    stage.start()
+
+    duration = block / float(rate)
+    data = np.zeros((block, 6), dtype=np.int16).tobytes()
+    start = time.time()
+    n = int(seconds / duration)
+    for i in range(n):
+        now = time.time() - start
+        stage.factor = overload if seconds / 3 <= now < 2 * seconds / 3 else 1.0
+        stage.put(Frame(data, 6, rate, time.time()))
+        time.sleep(max(0.0, start + (i + 1) * duration - time.time()))
+
+    # let the backlog drain, its lag counts too
+    deadline = time.time() + seconds
+    while (stage.queue.qsize() or len(stage.lags) + sum(st.dropped for st in scheduler.stages) < n) \
+            and time.time() < deadline:
+        time.sleep(0.05)
+    stage.stop()
+    if scheduled:
+        scheduler.stop()
+    lags = np.array([lag for _, lag, _ in stage.lags])
+    return lags, len(stage.lags), n, scheduler
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    for scheduled in (False, True):
+        lags, processed, sent, scheduler = simulate(scheduled)
+        dropped = sum(stage.dropped for stage in scheduler.stages)
+        print('{}: {} of {} blocks processed, {} dropped, lag median {:.0f} ms, max {:.0f} ms, {} transitions'.format(
+            'scheduled' if scheduled else 'unscheduled', processed, sent, dropped,
+            np.median(lags) * 1000, np.max(lags) * 1000, len(scheduler.transitions)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+
+"""
+Host-side voice activity detection gating the expensive stages
+
+The firmware's VOICEACTIVITY flag needs a USB poll per array and only covers
+its own beam; this VAD runs on the raw channels instead. Decisions are taken
+every group of frames (8 x 128 samples, 64 ms, by default) on their averaged
+power spectra, for every channel of every array in one vectorized pass:
+
+- a noise floor tracker like the sne block of odas.cfg (minima controlled
+  recursive averaging): the power spectrum is smoothed over b bins and over
+  time (alphaS), its minimum over L frames is tracked, bins more than delta
+  above that minimum are likely speech and the noise estimate follows the
+  spectrum with rate alphaD only where speech is unlikely. The rates are given
+  per hop as in odas and scaled to the decision rate
+- the a posteriori SNR of the frame against that floor, averaged over the
+  channels of an array
+- the spectral flux, the rise of the noise-normalized log spectrum from the
+  previous decision, which catches onsets the energy alone still misses
+
+A decision is active when the SNR passes snr_db, or half of it with enough
+flux, and stays active for a hangover. VAD is a pipeline element which only passes
+active blocks (plus a pre-roll) downstream, so GCC, SRP or beamforming elements
+after it only run when someone speaks; duty_cycle reports the share that did.
+"""
+
+import os
+import sys
+import time
+import threading
+import collections
+
+import numpy as np
+
+from voice_engine.element import Element
+from frame import Frame, FrameQueue
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from odas_config import load_geometry
+
+
+class SpectralVAD:
+    def __init__(self, arrays=1, channels=4, geometry=None, b=3, alpha_s=0.1, L=150, delta=3.0,
+                 alpha_d=0.1, snr_db=6.0, flux=0.6, hangover=4, group=8, band=(150.0, 6000.0)):
+        """
+        Args:
+            arrays: arrays processed together
+            channels: channels of each array
+            geometry: ArrayGeometry for the rate and hop size, defaults to odas.cfg
+            b, alpha_s, L, delta, alpha_d: noise tracker settings per hop, as in the sne block of odas.cfg
+            snr_db: a posteriori SNR of an active decision
+            flux: mean rise of the log spectrum, in nepers, that lowers the SNR needed to half
+            hangover: decisions a detection keeps the array active
+            group: hops averaged per decision
+            band: Hz range the features are computed on
+        """
+        geometry = geometry or load_geometry()
+        self.arrays = arrays
+        self.channels = channels
+        # non-overlapping hops: the averaged power needs no overlap
+        self.frame_size = N = geometry.hop_size
+        self.group = group
+        self.size = N * group
+        self.b = b
+        self.alpha_s = 1 - (1 - alpha_s) ** group
+        self.alpha_p = 1 - 0.8 ** group
+        self.L = max(1, int(round(L / float(group))))
+        self.delta = delta
+        self.alpha_d = 1 - (1 - alpha_d) ** group
+        self.snr = 10 ** (snr_db / 10.0)
+        self.flux = flux
+        self.hangover = hangover
+
+        freqs = np.fft.rfftfreq(N, 1.0 / geometry.rate)
+        self.band = (freqs >= band[0]) & (freqs <= band[1])
+        self.window = np.hanning(N).astype(np.float32)
+        # frequency smoothing over 2b+1 bins as one banded matrix, edges renormalized
+        bins = int(np.count_nonzero(self.band))
+        taps = np.hanning(2 * b + 3)[1:-1]
+        offset = np.arange(bins)[None, :] - np.arange(bins)[:, None]
+        smoothing = np.where(np.abs(offset) <= b, taps[np.clip(offset + b, 0, 2 * b)], 0.0)
+        self.smoothing = (smoothing / smoothing.sum(axis=0)).astype(np.float32)
+
+        self.history = np.zeros((arrays, 0, channels), dtype=np.float32)
+        self.reset()
+
+    def reset(self):
+        shape = (self.arrays, self.channels, int(np.count_nonzero(self.band)))
+        self.S = np.zeros(shape, dtype=np.float32)
+        self.minimum = np.zeros(shape, dtype=np.float32)
+        self.scratch = np.zeros(shape, dtype=np.float32)
+        self.noise = np.zeros(shape, dtype=np.float32)
+        self.presence = np.zeros(shape, dtype=np.float32)
+        self.previous = np.zeros(shape, dtype=np.float32)
+        self.countdown = np.zeros(self.arrays, dtype=int)
+        self.decisions = 0
+
+    def process(self, block):
+        """
+        Args:
+            block: (arrays, n, channels) float32 samples, any length
+
+        Returns:
+            active: (arrays, decisions) bool per group of hops completed by the block
+            snr: (arrays, decisions) a posteriori SNR in dB
+        """
+        N, G = self.frame_size, self.group
+        stream = np.concatenate([self.history, np.asarray(block, dtype=np.float32)], axis=1)
+        count = stream.shape[1] // self.size
+        self.history = stream[:, count * self.size:]
+        if not count:
+            return np.zeros((self.arrays, 0), dtype=bool), np.zeros((self.arrays, 0))
+
+        # every hop of the block at once up to the averaged power spectra
+        frames = stream[:, :count * self.size].reshape(self.arrays, count, G, N, self.channels)
+        spectra = np.fft.rfft(frames * self.window[:, None], axis=3)[:, :, :, self.band]
+        power = np.mean(spectra.real ** 2 + spectra.imag ** 2, axis=2)
+        power = np.transpose(power, (0, 1, 3, 2)).astype(np.float32) + 1e-6
+        smoothed = power @ self.smoothing
+
+        active = np.zeros((self.arrays, count), dtype=bool)
+        snr = np.zeros((self.arrays, count))
+        for f in range(count):
+            P = power[:, f]
+            if not self.decisions:
+                self.S[...] = self.minimum[...] = self.scratch[...] = self.noise[...] = self.previous[...] = P
+
+            # minima controlled recursive averaging
+            self.S += self.alpha_s * (smoothed[:, f] - self.S)
+            np.minimum(self.minimum, self.S, out=self.minimum)
+            np.minimum(self.scratch, self.S, out=self.scratch)
+            self.decisions += 1
+            if self.decisions % self.L == 0:
+                self.minimum = np.minimum(self.scratch, self.S)
+                self.scratch = self.S.copy()
+            self.presence += self.alpha_p * ((self.S > self.delta * self.minimum) - self.presence)
+            self.noise += self.alpha_d * (1 - self.presence) * (P - self.noise)
+
+            ratio = np.mean(np.sum(P, axis=-1) / np.sum(self.noise, axis=-1), axis=-1)
+            normalized = np.log(P / self.noise)
+            rise = np.mean(np.maximum(normalized - self.previous, 0.0), axis=(-2, -1))
+            self.previous = normalized
+
+            detected = (ratio > self.snr) | ((ratio > np.sqrt(self.snr)) & (rise > self.flux))
+            self.countdown = np.where(detected, self.hangover, np.maximum(self.countdown - 1, 0))
+            active[:, f] = self.countdown > 0
+            snr[:, f] = 10 * np.log10(ratio)
+
+        return active, snr
+
+
+class VAD(Element):
+    def __init__(self, channels=6, preroll=1, on_change=None, **kwargs):
+        """
+        Args:
+            channels: channels of the interleaved input
+            preroll: silent blocks kept and released ahead of the first active one
+            on_change: optional callable(active) when the state flips
+            kwargs: SpectralVAD arguments
+        """
+        super(VAD, self).__init__()
+
+        geometry = load_geometry()
+        self.channels = channels
+        self.core = SpectralVAD(1, len(geometry.channels), geometry, **kwargs)
+        self.mics = geometry.channels
+        self.on_change = on_change
+        self.preroll = collections.deque(maxlen=preroll)
+        self.active = False
+        self.blocks = 0
+        self.passed = 0
+        self.seconds = 0.0
+
+        self.queue = FrameQueue()
+        self.done = True
+
+    @property
+    def duty_cycle(self):
+        """
+        Share of the blocks passed downstream
+        """
+        return self.passed / float(self.blocks) if self.blocks else 0.0
+
+    def put(self, data):
+        self.queue.put(data)
+
+    def start(self):
+        self.done = False
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.done = True
+
+    def run(self):
+        while not self.done:
+            frame = Frame.wrap(self.queue.get(), self.channels)
+
+            start = time.time()
+            active, _ = self.core.process(frame.float32[None, :, self.mics])
+            self.seconds += time.time() - start
+            # a block without a complete hop keeps the previous state
+            active = bool(active.any()) if active.shape[1] else self.active
+            self.blocks += 1
+
+            if active != self.active:
+                self.active = active
+                if self.on_change:
+                    self.on_change(active)
+
+            if not active:
+                self.preroll.append(frame)
+                continue
+
+            while self.preroll:
+                self.passed += 1
+                super(VAD, self).put(self.preroll.popleft())
+            self.passed += 1
+            super(VAD, self).put(frame)
+
+
+def synthesize(arrays, seconds, rate=16000, seed=0):
+    """
+    Noise with speech-like bursts (voiced harmonics at a syllable rate) heard by every array
+
+    Returns:
+        (arrays, n, 4) float32 samples and (n,) bool truth
+    """
+    random = np.random.default_rng(seed)
+    n = int(seconds * rate)
+    t = np.arange(n) / float(rate)
+    truth = np.zeros(n, dtype=bool)
+    speech = np.zeros(n)
+    position = int(random.uniform(1, 3) * rate)
+    while position < n:
+        length = int(random.uniform(0.3, 1.5) * rate)
+        end = min(position + length, n)
+        f0 = random.uniform(100, 250)
+        span = t[position:end]
+        voiced = sum(np.sin(2 * np.pi * k * f0 * span) / k for k in range(1, 20))
+        speech[position:end] = voiced * np.clip(np.sin(2 * np.pi * 4 * span), 0, 1) * random.uniform(300, 2000)
+        truth[position:end] = True
+        position = end + int(random.uniform(1, 6) * rate)
+
+    gains = random.uniform(0.5, 1.0, (arrays, 1, 1))
+    noise = random.standard_normal((arrays, n, 4)) * 60
+    return (speech[None, :, None] * gains + noise).astype(np.float32), truth
+
+
+def benchmark(arrays=8, seconds=120.0, block=1024):
+    from beamformer import STFTBeamformer
+
+    vad = SpectralVAD(arrays)
+    samples, truth = synthesize(arrays, seconds)
+    blocks = samples.shape[1] // block
+
+    gated = []
+    vad_time = 0.0
+    for i in range(blocks):
+        start = time.time()
+        active, _ = vad.process(samples[:, i * block:(i + 1) * block])
+        vad_time += time.time() - start
+        # one decision per block when the block is a group of hops
+        gated.append(active.any(axis=1))
+    gated = np.stack(gated, axis=1)
+    reference = truth[:blocks * block].reshape(blocks, block).any(axis=1)
+
+    recall = np.mean(gated[:, reference])
+    false_alarm = np.mean(gated[:, ~reference])
+
+    # the beamformer as the expensive stage, on every block or only on active ones
+    costs = []
+    for mask in (np.ones_like(gated), gated):
+        stage = STFTBeamformer(1, 'mvdr')
+        start = time.time()
+        for a in range(arrays):
+            for i in np.flatnonzero(mask[a]):
+                stage.process(samples[a:a + 1, i * block:(i + 1) * block])
+        costs.append(time.time() - start)
+
+    print('{} arrays x 4 channels, {:.0f}s: VAD {:.1f} us per block and array ({:.0f}x real time)'.format(
+        arrays, seconds, vad_time / blocks / arrays * 1e6, seconds / vad_time))
+    print('speech in {:.0%} of the blocks: recall {:.1%}, false alarms {:.1%}, duty cycle {:.1%}'.format(
+        np.mean(reference), recall, false_alarm, np.mean(gated)))
+    print('MVDR beamformer downstream: {:.2f}s ungated, {:.2f}s gated ({:.0%} saved)'.format(
+        costs[0], costs[1] + vad_time, 1 - (costs[1] + vad_time) / costs[0]))
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--bench':
+        for arrays in (1, 8):
+            benchmark(arrays)
+        return
+
+    import datetime
+    from voice_engine.file_sink import FileSink
+    from rms import Source
+    from beamformer import Beamformer
+
+    src = Source(frames_size=1600)
+    def on_change(active):
+        print('voice' if active else 'silence')
+
+    vad = VAD(on_change=on_change)
+    beamformer = Beamformer(mode='mvdr')
+
+    filename = 'vad.' + datetime.datetime.now().strftime("%Y%m%d.%H:%M:%S") + '.wav'
+    sink = FileSink(filename, channels=1, rate=src.rate)
+
+    src.pipeline(vad, beamformer, sink)
+
+    src.pipeline_start()
+
+    while True:
+        try:
+            time.sleep(1)
+        except KeyboardInterrupt:
+            break
+
+    src.pipeline_stop()
+    print('duty cycle {:.1%} of {} blocks, VAD {:.2f}s'.format(vad.duty_cycle, vad.blocks, vad.seconds))
+
+
+if __name__ == '__main__':
+    main()
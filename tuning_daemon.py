@@ -0,0 +1,572 @@
+# -*- coding: utf-8 -*-
+
+"""
+Arbitration daemon sharing the USB control interface of the arrays
+
+Only the daemon talks to the devices. Clients (doa.py, tuners, localizers)
+connect to a Unix socket and send JSON lines:
+
+    {"id": 1, "op": "read", "device": 0, "names": ["DOAANGLE"], "max_age": 0.05}
+    {"id": 2, "op": "write", "device": 0, "name": "AGCONOFF", "value": 0}
+    {"id": 3, "op": "devices"}
+    {"id": 4, "op": "stats"}
+
+and get {"id": ..., "values": {...}} / {"id": ..., "value": ...} or
+{"id": ..., "error": "..."} back, one line per request.
+
+Hot parameters (DOAANGLE and VOICEACTIVITY by default) are polled by a
+TuningWatcher and answered from memory without touching the device, as long as
+the last good read is younger than max_age or a few watch periods (a watcher
+falling behind or failing is then read through the worker like any other
+parameter, reporting its error). Other reads
+are served from a cache when younger than max_age, otherwise queued to the
+device worker, which drains every request that arrived meanwhile and reads each
+parameter once for the whole batch. Writes go through the same worker in
+arrival order, so the bus sees one serialized request stream per device.
+
+    python tuning_daemon.py                      # serve every array
+    python tuning_daemon.py DOAANGLE             # read through the daemon
+    python tuning_daemon.py AGCONOFF 0           # write through the daemon
+    python tuning_daemon.py stats
+    python tuning_daemon.py --selftest           # coalescing checks on an in-memory device
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from tuning import PARAMETERS, Tuning
+from watch import TuningWatcher
+
+
+SOCKET = '/tmp/respeaker-tuning.sock'
+
+HOT = {'DOAANGLE': 0.02, 'VOICEACTIVITY': 0.02}
+
+# watched values are served from memory until this many periods old
+STALE_PERIODS = 3
+
+
+class SerializedTuning:
+    """
+    Tuning whose control transfers never overlap, shared by the watcher and the worker
+    """
+    def __init__(self, tuning):
+        self.tuning = tuning
+        self.lock = threading.Lock()
+        self.transfers = 0
+
+    def read(self, name):
+        with self.lock:
+            self.transfers += 1
+            return self.tuning.read(name)
+
+    def write(self, name, value):
+        with self.lock:
+            self.transfers += 1
+            return self.tuning.write(name, value)
+
+
+class Request:
+    def __init__(self, op, names=(), value=None):
+        self.op = op
+        self.names = names
+        self.value = value
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def wait(self, timeout=None):
+        self.done.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class DeviceServer:
+    def __init__(self, tuning, hot=None, ttl=0.05):
+        """
+        Args:
+            tuning: Tuning of the device, only used from here on
+            hot: dict of name: period of parameters polled continuously
+            ttl: default max_age of cached values in seconds
+        """
+        self.tuning = SerializedTuning(tuning)
+        self.ttl = ttl
+        self.cache = {}
+        self.queue = queue.Queue()
+        self.batches = 0
+        self.hits = 0
+        self.misses = 0
+
+        self.watcher = TuningWatcher(self.tuning)
+        for name, period in (HOT if hot is None else hot).items():
+            self.watcher.watch(name, period)
+
+        self.done = True
+        self.thread = None
+
+    def start(self):
+        self.done = False
+        self.watcher.start()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.done = True
+        self.queue.put(None)
+        self.watcher.stop()
+        if self.thread is not None:
+            self.thread.join()
+
+    def read(self, names, max_age=None):
+        """
+        Values of NAMES, from the watcher or the cache when possible
+        """
+        max_age = self.ttl if max_age is None else max_age
+        now = time.monotonic()
+        values = {}
+        missing = []
+        for name in names:
+            if name not in PARAMETERS:
+                raise ValueError('{} is not a valid name'.format(name))
+
+            watch = self.watcher.watches.get(name)
+            if watch is not None:
+                value, updated = watch.value, watch.updated
+                if value is not None and updated is not None and \
+                        now - updated <= max(max_age, STALE_PERIODS * watch.period):
+                    values[name] = value
+                    continue
+
+            cached = self.cache.get(name)
+            if cached is not None and now - cached[1] <= max_age:
+                values[name] = cached[0]
+            else:
+                missing.append(name)
+
+        self.hits += len(values)
+        if missing:
+            self.misses += len(missing)
+            request = Request('read', missing)
+            self.queue.put(request)
+            values.update(request.wait())
+        return values
+
+    def write(self, name, value):
+        if name not in PARAMETERS:
+            raise ValueError('{} is not a valid name'.format(name))
+
+        request = Request('write', (name,), value)
+        self.queue.put(request)
+        return request.wait()
+
+    def run(self):
+        while not self.done:
+            request = self.queue.get()
+            if request is None:
+                break
+
+            # everything that arrived while the previous batch was on the bus
+            batch = [request]
+            while True:
+                try:
+                    request = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    self.done = True
+                    break
+                batch.append(request)
+
+            self.batches += 1
+            self._serve(batch)
+
+    def _serve(self, batch):
+        reads = []
+        for request in batch:
+            if request.op == 'read':
+                reads.append(request)
+                continue
+
+            # keep the arrival order: reads queued before a write see the old value
+            self._serve_reads(reads)
+            reads = []
+            try:
+                name = request.names[0]
+                self.tuning.write(name, request.value)
+                self.cache.pop(name, None)
+                request.result = self.tuning.read(name)
+                self.cache[name] = (request.result, time.monotonic())
+            except Exception as e:
+                request.error = e
+            request.done.set()
+
+        self._serve_reads(reads)
+
+    def _serve_reads(self, reads):
+        names = set()
+        for request in reads:
+            names.update(request.names)
+
+        values = {}
+        errors = {}
+        for name in names:
+            try:
+                values[name] = self.tuning.read(name)
+                self.cache[name] = (values[name], time.monotonic())
+            except Exception as e:
+                errors[name] = e
+
+        # a failing name only fails the requests that asked for it
+        for request in reads:
+            failed = [name for name in request.names if name in errors]
+            if failed:
+                request.error = errors[failed[0]]
+            else:
+                request.result = {name: values[name] for name in request.names}
+            request.done.set()
+
+    def stats(self):
+        return {'transfers': self.tuning.transfers, 'batches': self.batches,
+                'hits': self.hits, 'misses': self.misses, 'watch_ticks': self.watcher.ticks}
+
+
+class TuningDaemon:
+    def __init__(self, devices, path=SOCKET, hot=None, ttl=0.05):
+        """
+        Args:
+            devices: list of Tuning instances, addressed by their index
+            path: Unix socket path
+        """
+        self.servers = [DeviceServer(tuning, hot, ttl) for tuning in devices]
+        self.info = [{'index': i, 'bus': getattr(t.dev, 'bus', None), 'address': getattr(t.dev, 'address', None)}
+                     for i, t in enumerate(devices)]
+        self.path = path
+        self.socket = None
+        self.done = True
+
+    def start(self):
+        if os.path.exists(self.path):
+            # a stale socket of a daemon that died, refuse to steal a live one
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                probe.close()
+                raise RuntimeError('a daemon is already serving {}'.format(self.path))
+            except socket.error:
+                os.remove(self.path)
+
+        for server in self.servers:
+            server.start()
+
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(self.path)
+        self.socket.listen(16)
+        self.done = False
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        while not self.done:
+            try:
+                connection, _ = self.socket.accept()
+            except socket.error:
+                break
+            thread = threading.Thread(target=self.serve, args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    def serve(self, connection):
+        stream = connection.makefile('rwb')
+        try:
+            for line in stream:
+                try:
+                    request = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    continue
+                stream.write((json.dumps(self.handle(request)) + '\n').encode('utf-8'))
+                stream.flush()
+        except socket.error:
+            pass
+        finally:
+            stream.close()
+            connection.close()
+
+    def handle(self, request):
+        response = {'id': request.get('id')}
+        try:
+            op = request.get('op')
+            if op == 'devices':
+                response['devices'] = self.info
+            elif op == 'stats':
+                response['stats'] = [server.stats() for server in self.servers]
+            else:
+                device = request.get('device', 0)
+                if not isinstance(device, int) or device < 0:
+                    raise IndexError(device)
+                server = self.servers[device]
+                if op == 'read':
+                    response['values'] = server.read(request['names'], request.get('max_age'))
+                elif op == 'write':
+                    response['value'] = server.write(request['name'], request['value'])
+                else:
+                    raise ValueError('unknown op {}'.format(op))
+        except IndexError:
+            response['error'] = 'no device {}'.format(request.get('device'))
+        except Exception as e:
+            response['error'] = str(e)
+        return response
+
+    def stop(self):
+        self.done = True
+        if self.socket is not None:
+            self.socket.close()
+            os.remove(self.path)
+        for server in self.servers:
+            server.stop()
+
+
+class RemoteTuning:
+    """
+    Tuning API served by the daemon
+    """
+    def __init__(self, device=0, path=SOCKET, max_age=None):
+        """
+        Args:
+            device: index of the array at the daemon
+            max_age: oldest cached value accepted in seconds, None for the daemon's default
+        """
+        self.device = device
+        self.max_age = max_age
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path)
+        self.stream = self.socket.makefile('rwb')
+        self.lock = threading.Lock()
+        self.next_id = 0
+
+    def request(self, **request):
+        with self.lock:
+            self.next_id += 1
+            request['id'] = self.next_id
+            self.stream.write((json.dumps(request) + '\n').encode('utf-8'))
+            self.stream.flush()
+            line = self.stream.readline()
+        if not line:
+            raise IOError('tuning daemon closed the connection')
+
+        response = json.loads(line.decode('utf-8'))
+        if 'error' in response:
+            raise ValueError(response['error'])
+        return response
+
+    def read_many(self, names):
+        return self.request(op='read', device=self.device, names=list(names), max_age=self.max_age)['values']
+
+    def read(self, name):
+        if name not in PARAMETERS:
+            return
+        return self.read_many([name])[name]
+
+    def write(self, name, value):
+        if name not in PARAMETERS:
+            return
+        return self.request(op='write', device=self.device, name=name, value=value)['value']
+
+    def set_vad_threshold(self, db):
+        self.write('GAMMAVAD_SR', db)
+
+    def is_voice(self):
+        return self.read('VOICEACTIVITY')
+
+    @property
+    def direction(self):
+        return self.read('DOAANGLE')
+
+    def stats(self):
+        return self.request(op='stats')['stats']
+
+    def close(self):
+        self.stream.close()
+        self.socket.close()
+
+
+def find(device=0, path=SOCKET):
+    """
+    RemoteTuning of the device if a daemon is running, None otherwise
+    """
+    try:
+        return RemoteTuning(device, path)
+    except socket.error:
+        return
+
+
+class _FakeTuning:
+    """
+    In-memory device for selftest, slow like a control transfer, failing on FAIL
+
+    Writes wait for gate, which lets a test queue requests behind one.
+    """
+    def __init__(self, fail=(), latency=0.01):
+        self.dev = None
+        self.values = {}
+        self.fail = set(fail)
+        self.latency = latency
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def read(self, name):
+        time.sleep(self.latency)
+        if name in self.fail:
+            raise IOError('usb timeout')
+        return self.values.get(name, 0)
+
+    def write(self, name, value):
+        self.gate.wait()
+        time.sleep(self.latency)
+        self.values[name] = value
+
+
+def selftest(path='/tmp/respeaker-tuning-selftest.sock'):
+    """
+    Two clients in one coalesced batch, one of them reading a failing name, and a stale watched value
+    """
+    device = _FakeTuning(fail=['RT60', 'DOAANGLE'])
+    daemon = TuningDaemon([device], path, hot={}, ttl=0)
+    daemon.start()
+    server = daemon.servers[0]
+    try:
+        # hold the worker on a write until both reads are queued behind it
+        device.gate.clear()
+        server.queue.put(Request('write', ('AGCGAIN',), 1.0))
+        while server.queue.qsize():
+            time.sleep(0.001)
+        results = {}
+
+        def client(name):
+            dev = RemoteTuning(0, path, max_age=0)
+            try:
+                results[name] = dev.read(name)
+            except ValueError as e:
+                results[name] = e
+            finally:
+                dev.close()
+
+        threads = [threading.Thread(target=client, args=(name,)) for name in ('AGCONOFF', 'RT60')]
+        for thread in threads:
+            thread.start()
+        while server.queue.qsize() < 2:
+            time.sleep(0.001)
+        device.gate.set()
+        for thread in threads:
+            thread.join()
+        assert server.batches == 2, server.batches
+
+        assert results['AGCONOFF'] == 0, results
+        assert isinstance(results['RT60'], ValueError) and 'usb timeout' in str(results['RT60']), results
+
+        dev = RemoteTuning(-1, path)
+        try:
+            dev.read('AGCONOFF')
+            raise AssertionError('device -1 was accepted')
+        except ValueError as e:
+            assert 'no device' in str(e), e
+        finally:
+            dev.close()
+
+        # a watcher that stopped updating: its last value is only served while fresh
+        server.watcher.stop()
+        watch = server.watcher.watch('DOAANGLE', 0.02)
+        watch.value, watch.updated = 7, time.monotonic()
+        dev = RemoteTuning(0, path, max_age=0)
+        try:
+            assert dev.read('DOAANGLE') == 7
+            watch.updated -= 1.0
+            dev.read('DOAANGLE')
+            raise AssertionError('a stale DOAANGLE was served')
+        except ValueError as e:
+            assert 'usb timeout' in str(e), e
+        finally:
+            dev.close()
+        print('selftest passed: AGCONOFF {}, RT60 "{}" in one batch, device -1 rejected, '
+              'stale DOAANGLE read from the device'.format(results['AGCONOFF'], results['RT60']))
+    finally:
+        daemon.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Share the ReSpeaker control interface between processes')
+    parser.add_argument('params', nargs='*', help='none to serve, "stats", NAME or NAME VALUE as a client')
+    parser.add_argument('--socket', default=SOCKET)
+    parser.add_argument('--device', type=int, default=0, help='array index for client requests')
+    parser.add_argument('--hot', action='append', metavar='NAME=PERIOD',
+                        help='parameter polled continuously, default DOAANGLE=0.02 and VOICEACTIVITY=0.02')
+    parser.add_argument('--ttl', type=float, default=0.05, help='seconds other values are served from the cache')
+    parser.add_argument('--selftest', action='store_true', help='check the daemon against an in-memory device')
+    args = parser.parse_args()
+
+    if args.selftest:
+        selftest()
+        return
+
+    if args.params:
+        dev = find(args.device, args.socket)
+        if dev is None:
+            print('No tuning daemon on {}'.format(args.socket))
+            sys.exit(1)
+
+        if args.params[0] == 'stats':
+            for i, stats in enumerate(dev.stats()):
+                print('{}: {}'.format(i, stats))
+        else:
+            name = args.params[0].upper()
+            if len(args.params) > 1:
+                dev.write(name, args.params[1])
+            print('{}: {}'.format(name, dev.read(name)))
+        dev.close()
+        return
+
+    import usb.core
+
+    devices = list(usb.core.find(find_all=True, idVendor=0x2886, idProduct=0x0018))
+    if not devices:
+        print('No device found')
+        sys.exit(1)
+    devices.sort(key=lambda d: (d.bus, d.address))
+
+    hot = None
+    if args.hot:
+        hot = {}
+        for item in args.hot:
+            name, period = item.split('=')
+            hot[name.upper()] = float(period)
+
+    daemon = TuningDaemon([Tuning(d) for d in devices], args.socket, hot, args.ttl)
+    daemon.start()
+    print('* serving {} arrays on {}'.format(len(devices), args.socket))
+
+    while True:
+        try:
+            time.sleep(1)
+        except KeyboardInterrupt:
+            break
+
+    daemon.stop()
+    for i, server in enumerate(daemon.servers):
+        print('{}: {}'.format(i, server.stats()))
+        server.tuning.tuning.close()
+
+
+if __name__ == '__main__':
+    main()
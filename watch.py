@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+"""
+Multi-rate parameter watcher for a Tuning device
+
+Each parameter is registered with its own period. Reads falling due within the
+same coalescing window are served in one scheduling tick, so a device is woken
+up once for e.g. DOAANGLE and VOICEACTIVITY at 50 Hz plus AECPATHCHANGE every
+100 ms. Subscribers are only called when a value changes.
+
+A failed read (or a raising subscriber) is logged and counted on its Watch and
+the parameter stays due on its normal period. Until the next good read its
+value is None and watch.error holds the exception, so a stale value is never
+served as a fresh one.
+"""
+
+import sys
+import time
+import logging
+import threading
+
+from tuning import PARAMETERS, find
+
+
+logger = logging.getLogger(__name__)
+
+class Watch:
+    def __init__(self, name, period):
+        self.name = name
+        self.period = float(period)
+        self.due = 0.0
+        self.value = None
+        self.callbacks = []
+
+        # monotonic time of the last good read, last read error and their count
+        self.updated = None
+        self.error = None
+        self.errors = 0
+
+        # jitter statistics: lateness of each read behind its scheduled time
+        self.reads = 0
+        self.missed = 0
+        self.jitter_sum = 0.0
+        self.jitter_max = 0.0
+
+    @property
+    def jitter(self):
+        """
+        (mean, max) lateness in seconds
+        """
+        mean = self.jitter_sum / self.reads if self.reads else 0.0
+        return mean, self.jitter_max
+
+
+class TuningWatcher:
+    def __init__(self, tuning, coalesce=0.002):
+        """
+        Args:
+            tuning: Tuning instance of the device
+            coalesce: reads due within this many seconds of each other share a tick
+        """
+        self.tuning = tuning
+        self.coalesce = coalesce
+        self.watches = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.ticks = 0
+        self.done = True
+
+    def watch(self, name, period, callback=None):
+        """
+        Read the parameter NAME every PERIOD seconds, optionally subscribing CALLBACK
+
+        Registering a parameter again changes its period.
+        """
+        if name not in PARAMETERS:
+            raise ValueError('{} is not a valid name'.format(name))
+        if not period > 0:
+            raise ValueError('period of {} must be positive, got {}'.format(name, period))
+
+        with self.lock:
+            watch = self.watches.get(name)
+            if watch is None:
+                watch = Watch(name, period)
+                watch.due = time.monotonic()
+                self.watches[name] = watch
+            else:
+                watch.period = float(period)
+
+            if callback is not None:
+                watch.callbacks.append(callback)
+
+        self.wakeup.set()
+        return watch
+
+    def unwatch(self, name):
+        with self.lock:
+            self.watches.pop(name, None)
+
+    def subscribe(self, name, callback):
+        """
+        Call callback(name, value, timestamp) whenever the watched parameter NAME changes
+        """
+        with self.lock:
+            self.watches[name].callbacks.append(callback)
+
+    def value(self, name):
+        return self.watches[name].value
+
+    def jitter(self):
+        """
+        Dict of name: (mean, max) read lateness in seconds
+        """
+        with self.lock:
+            return {name: watch.jitter for name, watch in self.watches.items()}
+
+    def tick(self, now=None):
+        """
+        Read every parameter due by now (within the coalescing window)
+
+        Returns:
+            seconds until the next parameter falls due
+        """
+        if now is None:
+            now = time.monotonic()
+
+        with self.lock:
+            due = [w for w in self.watches.values() if w.due <= now + self.coalesce]
+
+        if due:
+            self.ticks += 1
+
+        changed = []
+        for watch in due:
+            started = time.monotonic()
+            try:
+                value = self.tuning.read(watch.name)
+            except Exception as e:
+                value = e
+            timestamp = time.time()
+
+            lateness = max(0.0, started - watch.due)
+            watch.reads += 1
+            watch.jitter_sum += lateness
+            watch.jitter_max = max(watch.jitter_max, lateness)
+
+            watch.due += watch.period
+            if watch.due <= started:
+                # overloaded: skip the missed slots instead of reading in a burst
+                skipped = int((started - watch.due) // watch.period) + 1
+                watch.missed += skipped
+                watch.due += skipped * watch.period
+
+            if isinstance(value, Exception):
+                watch.errors += 1
+                watch.error = value
+                watch.value = None
+                logger.warning('reading %s failed: %s', watch.name, value)
+                continue
+
+            watch.updated = started
+            watch.error = None
+            if value != watch.value:
+                watch.value = value
+                changed.append((watch, value, timestamp))
+
+        for watch, value, timestamp in changed:
+            for callback in list(watch.callbacks):
+                try:
+                    callback(watch.name, value, timestamp)
+                except Exception:
+                    watch.errors += 1
+                    logger.exception('callback of %s failed', watch.name)
+
+        with self.lock:
+            if not self.watches:
+                return None
+            next_due = min(w.due for w in self.watches.values())
+
+        return max(0.0, next_due - time.monotonic())
+
+    def run(self):
+        while not self.done:
+            delay = self.tick()
+            self.wakeup.wait(delay)
+            self.wakeup.clear()
+
+    def start(self):
+        self.done = False
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.done = True
+        self.wakeup.set()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    dev = find()
+    if not dev:
+        print('No device found')
+        sys.exit(1)
+
+    def on_change(name, value, timestamp):
+        sys.stdout.write('{:.3f}\t{:16}\t{}\n'.format(timestamp, name, value))
+        sys.stdout.flush()
+
+    watcher = TuningWatcher(dev)
+    watcher.watch('RT60', 5.0, on_change)
+    watcher.watch('AECPATHCHANGE', 0.1, on_change)
+    watcher.watch('DOAANGLE', 0.02, on_change)
+    watcher.watch('VOICEACTIVITY', 0.02, on_change)
+    watcher.start()
+
+    while True:
+        try:
+            time.sleep(1)
+        except KeyboardInterrupt:
+            break
+
+    watcher.stop()
+
+    print('{:24} {:>10} {:>10} {:>8}'.format('name', 'mean(ms)', 'max(ms)', 'missed'))
+    for name, (mean, worst) in sorted(watcher.jitter().items()):
+        print('{:24} {:10.3f} {:10.3f} {:8}'.format(name, mean * 1000, worst * 1000, watcher.watches[name].missed))
+    print('{} ticks'.format(watcher.ticks))
+
+    dev.close()
+
+
+if __name__ == '__main__':
+    main()